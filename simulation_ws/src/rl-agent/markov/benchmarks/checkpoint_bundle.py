@@ -0,0 +1,129 @@
+"""
+Benchmark of the checkpoint transfers with and without CHECKPOINT_BUNDLE: a synthetic checkpoint is saved by one
+data store and loaded by another, and the objects, bytes and time of each direction are reported. Runs against a
+real bucket, or any S3 compatible endpoint (moto_server, MinIO) with --endpoint-url. Every object written is
+deleted at the end. Run with python -m markov.benchmarks.checkpoint_bundle --bucket <bucket>
+"""
+import argparse
+import filecmp
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from markov.s3_boto_data_store import S3BotoDataStore, S3BotoDataStoreParameters, S3_ENDPOINT_URL, \
+    CHECKPOINT_METADATA_FILENAME, S3_MAX_KEYS_PER_DELETE
+
+# (number of files, float32 values per data shard): a few large shards, and many small ones
+CHECKPOINT_LAYOUTS = [(12, 250000), (200, 5000)]
+
+
+def write_checkpoint(checkpoint_dir, number, num_files, num_values):
+    """
+    Write a checkpoint laid out like the ones TF saves: data shards of normally distributed float32 weights, an
+    index, a meta graph and the metadata file
+    """
+    name = "%d_Step-%d.ckpt" % (number, number * 100)
+    rng = np.random.RandomState(number)
+    num_shards = num_files - 2
+    for shard in range(num_shards):
+        weights = (rng.randn(num_values) * 0.05).astype(np.float32)
+        weights.tofile(os.path.join(checkpoint_dir, "%s.data-%05d-of-%05d" % (name, shard, num_shards)))
+    with open(os.path.join(checkpoint_dir, name + ".index"), 'wb') as f:
+        f.write(rng.bytes(2000))
+    with open(os.path.join(checkpoint_dir, name + ".meta"), 'wb') as f:
+        f.write(b"graph-def " * 20000)
+    with open(os.path.join(checkpoint_dir, CHECKPOINT_METADATA_FILENAME), 'w') as f:
+        f.write('model_checkpoint_path: "%s"\nall_model_checkpoint_paths: "%s"\n' % (name, name))
+
+
+def make_data_store(args, s3_folder, checkpoint_dir, bundle):
+    params = S3BotoDataStoreParameters(aws_region=args.region, bucket_name=args.bucket, s3_folder=s3_folder,
+                                       checkpoint_dir=checkpoint_dir, endpoint_url=args.endpoint_url,
+                                       notify_file=None, bundle=bundle)
+    data_store = S3BotoDataStore(params)
+    # Set by rl_coach when training, no frozen graph is exported here
+    data_store.graph_manager = None
+    return data_store
+
+
+def delete_prefix(data_store, prefix):
+    s3_client = data_store._get_client()
+    keys = [{"Key": obj["Key"]} for obj in data_store._list_objects(s3_client, prefix)]
+    for start in range(0, len(keys), S3_MAX_KEYS_PER_DELETE):
+        s3_client.delete_objects(Bucket=data_store.params.bucket,
+                                 Delete={"Objects": keys[start:start + S3_MAX_KEYS_PER_DELETE]})
+
+
+def run(args, num_files, num_values, bundle):
+    """
+    :return: (number of objects, bytes in S3, seconds to save, seconds to load)
+    """
+    s3_folder = "%s/%s-%d-files" % (args.s3_folder, "bundle" if bundle else "per-file", num_files)
+    work_dir = tempfile.mkdtemp(prefix="checkpoint-bundle-benchmark-")
+    writer_dir = os.path.join(work_dir, "writer")
+    reader_dir = os.path.join(work_dir, "reader")
+    os.makedirs(writer_dir)
+    write_checkpoint(writer_dir, 1, num_files, num_values)
+    writer = make_data_store(args, s3_folder, writer_dir, bundle)
+    reader = make_data_store(args, s3_folder, reader_dir, bundle)
+    try:
+        delete_prefix(writer, writer.key_prefix)
+        start_time = time.time()
+        writer.save_to_store()
+        save_time = time.time() - start_time
+        objects = list(writer._list_objects(writer._get_client(), writer.key_prefix))
+
+        start_time = time.time()
+        reader.load_from_store()
+        load_time = time.time() - start_time
+        for filename in os.listdir(writer_dir):
+            if not filecmp.cmp(os.path.join(writer_dir, filename), os.path.join(reader_dir, filename),
+                               shallow=False):
+                raise RuntimeError("%s differs after the transfer" % filename)
+        return len(objects), sum(obj["Size"] for obj in objects), save_time, load_time
+    finally:
+        writer._retention_executor.shutdown()
+        reader._retention_executor.shutdown()
+        delete_prefix(writer, writer.key_prefix)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bucket',
+                        help='(string) S3 bucket the checkpoints are written to.',
+                        type=str,
+                        required=True)
+    parser.add_argument('--s3-folder',
+                        help='(string) Prefix of the objects written by the benchmark.',
+                        type=str,
+                        default='benchmarks/checkpoint-bundle')
+    parser.add_argument('--endpoint-url',
+                        help='(string) S3 compatible endpoint, e.g. http://localhost:5000 for moto_server.',
+                        type=str,
+                        default=S3_ENDPOINT_URL)
+    parser.add_argument('--region',
+                        help='(string) AWS region of the bucket.',
+                        type=str,
+                        default='us-east-1')
+    parser.add_argument('--repeats',
+                        help='(int) Number of transfers per layout and mode, the median is reported.',
+                        type=int,
+                        default=3)
+    args = parser.parse_args()
+
+    print("%5s %-8s %7s %10s %8s %8s %8s" % ("files", "mode", "objects", "MB", "save s", "load s", "sync s"))
+    for num_files, num_values in CHECKPOINT_LAYOUTS:
+        for bundle in (False, True):
+            runs = [run(args, num_files, num_values, bundle) for _ in range(args.repeats)]
+            num_objects, num_bytes = runs[0][:2]
+            save_time = np.median([save for _, _, save, _ in runs])
+            load_time = np.median([load for _, _, _, load in runs])
+            print("%5d %-8s %7d %10.1f %8.2f %8.2f %8.2f" %
+                  (num_files, "bundle" if bundle else "per-file", num_objects, num_bytes / 1e6, save_time,
+                   load_time, save_time + load_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+Benchmark of the evaluation startup: time to the first action and peak RSS when loading the frozen graph with
+FrozenPolicy, against restoring the training checkpoint into a session as graph_manager.create_graph does (without
+the environment and the rl_coach agents it also builds). Each path runs in a fresh process, so the import of
+TensorFlow is included and the peak RSS is its own.
+Run with python -m markov.benchmarks.frozen_policy -c <directory with the checkpoint and model.pb>
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+MODE_FROZEN = "frozen"          # FrozenPolicy on model.pb
+MODE_CHECKPOINT = "checkpoint"  # Meta graph and variables of the latest checkpoint
+
+
+class CheckpointPolicy(object):
+    """
+    The policy of the latest checkpoint, restored with its whole training graph
+    """
+    def __init__(self, model_directory, output_name):
+        import numpy as np
+        import tensorflow as tf
+        checkpoint_path = tf.train.latest_checkpoint(model_directory)
+        if checkpoint_path is None:
+            raise ValueError("No checkpoint in {}".format(model_directory))
+        self.session = tf.Session(config=tf.ConfigProto(device_count={"GPU": 0}))
+        saver = tf.train.import_meta_graph(checkpoint_path + ".meta", clear_devices=True)
+        saver.restore(self.session, checkpoint_path)
+        # The observation placeholder is the one the output head depends on
+        policy_graph = tf.graph_util.extract_sub_graph(self.session.graph.as_graph_def(), [output_name])
+        input_names = [node.name for node in policy_graph.node if node.op == "Placeholder"]
+        if len(input_names) != 1:
+            raise ValueError("Cannot tell the observation placeholder among {}".format(input_names))
+        input_tensor = self.session.graph.get_tensor_by_name(input_names[0] + ":0")
+        output_tensor = self.session.graph.get_tensor_by_name(output_name + ":0")
+        self._input = np.zeros([1] + input_tensor.shape.as_list()[1:], dtype=input_tensor.dtype.as_numpy_dtype)
+        self._run = self.session.make_callable(output_tensor, feed_list=[input_tensor])
+        self.observation_shape = self._input.shape[1:]
+        self.observation_dtype = self._input.dtype
+
+    def act(self, observation):
+        import numpy as np
+        self._input[0] = observation
+        return int(np.argmax(self._run(self._input)[0]))
+
+    def close(self):
+        self.session.close()
+
+
+def load(mode, model_directory, output_head, steps):
+    """
+    Load the policy the given way in this process, TensorFlow included, and run it
+    :return: Dict with the seconds until the first action, the peak RSS in MB and the inference latencies
+    """
+    start_time = time.time()
+    import numpy as np
+    from markov.frozen_policy import FrozenPolicy, get_max_rss_in_mb
+    from markov.graph_export import FROZEN_GRAPH_FILENAME, PPO_POLICY_OUTPUT_HEAD
+
+    output_head = output_head or PPO_POLICY_OUTPUT_HEAD
+    if mode == MODE_FROZEN:
+        policy = FrozenPolicy(os.path.join(model_directory, FROZEN_GRAPH_FILENAME), output_name=output_head)
+    else:
+        policy = CheckpointPolicy(model_directory, output_head)
+    observations = np.random.RandomState(0).uniform(0, 255, (steps + 1,) + policy.observation_shape)
+    observations = observations.astype(policy.observation_dtype)
+    policy.act(observations[0])
+    result = {"mode": mode,
+              "load_time_in_second": time.time() - start_time,
+              "max_rss_in_mb": get_max_rss_in_mb()}
+    latencies = []
+    for observation in observations[1:]:
+        step_start_time = time.time()
+        policy.act(observation)
+        latencies.append(time.time() - step_start_time)
+    result["p50_latency_in_ms"] = float(np.percentile(latencies, 50) * 1000)
+    result["p99_latency_in_ms"] = float(np.percentile(latencies, 99) * 1000)
+    result["max_rss_after_steps_in_mb"] = get_max_rss_in_mb()
+    policy.close()
+    return result
+
+
+def run_in_subprocess(mode, args):
+    """
+    :return: Result of load() in a new Python process
+    """
+    command = [sys.executable, "-m", "markov.benchmarks.frozen_policy", "--worker", mode,
+               "-c", args.local_model_directory, "--steps", str(args.steps)]
+    if args.output_head:
+        command += ["--output-head", args.output_head]
+    output = subprocess.check_output(command)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--local-model-directory',
+                        help='(string) Path to a folder containing a checkpoint and its model.pb.',
+                        type=str,
+                        default='./checkpoint')
+    parser.add_argument('--output-head',
+                        help='(string) Name of the output node giving the action probabilities, defaults to the '
+                             'PPO policy head.',
+                        type=str,
+                        default=None)
+    parser.add_argument('--steps',
+                        help='(int) Number of inferences timed after the first one.',
+                        type=int,
+                        default=1000)
+    parser.add_argument('--repeats',
+                        help='(int) Number of processes started per mode, the median is reported.',
+                        type=int,
+                        default=3)
+    parser.add_argument('--worker',
+                        help=argparse.SUPPRESS,
+                        choices=[MODE_FROZEN, MODE_CHECKPOINT],
+                        default=None)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(load(args.worker, args.local_model_directory, args.output_head, args.steps)))
+        return
+
+    # Imported here so that the workers import them in load(), where they are timed
+    import numpy as np
+    keys = ("load_time_in_second", "max_rss_in_mb", "p50_latency_in_ms", "p99_latency_in_ms",
+            "max_rss_after_steps_in_mb")
+    print("%-11s %14s %14s %8s %8s %16s" % ("mode", "first action s", "max RSS MB", "p50 ms", "p99 ms",
+                                            "RSS after steps"))
+    for mode in (MODE_CHECKPOINT, MODE_FROZEN):
+        results = [run_in_subprocess(mode, args) for _ in range(args.repeats)]
+        medians = [np.median([result[key] for result in results]) for key in keys]
+        print("%-11s %14.2f %14.0f %8.3f %8.3f %16.0f" % tuple([mode] + medians))
+
+
+if __name__ == '__main__':
+    main()
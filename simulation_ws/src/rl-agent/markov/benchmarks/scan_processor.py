@@ -0,0 +1,130 @@
+"""
+Benchmark of the LIDAR scan processing: the per-step cost of the original resampling of the scan against
+ScanProcessor, which processes each scan once in the callback, and the latency of waking up a reader waiting for
+the first scan of an episode. Run with python -m markov.benchmarks.scan_processor
+"""
+import argparse
+import threading
+import time
+import numpy as np
+from markov.environments.sensors import ScanProcessor
+
+# Same values as mars_env
+LIDAR_SCAN_MAX_DISTANCE = 4.5
+LIDAR_SECTORS = 8
+SLEEP_WAITING_FOR_IMAGE_TIME_IN_SECOND = 0.01
+# The rover's LIDAR publishes 360 samples
+SCAN_SIZES = [360, 720, 1440]
+
+
+def make_ranges(size, seed=0):
+    """
+    :return: Tuple of floats like LaserScan.ranges, with some NaN, infinite and out of range readings
+    """
+    rng = np.random.RandomState(seed)
+    ranges = rng.uniform(0.2, 6.0, size)
+    ranges[rng.choice(size, size // 20, replace=False)] = np.nan
+    ranges[rng.choice(size, size // 20, replace=False)] = np.inf
+    return tuple(ranges.tolist())
+
+
+def legacy_min_distance(ranges):
+    """
+    The processing the environments did on every step before ScanProcessor
+    """
+    size = len(ranges)
+    x = np.linspace(0, size - 1, 360)
+    xp = np.arange(size)
+    val = np.clip(np.interp(x, xp, ranges), 0, LIDAR_SCAN_MAX_DISTANCE)
+    val[np.isnan(val)] = LIDAR_SCAN_MAX_DISTANCE
+    return np.amin(val)
+
+
+def time_per_call(function, calls):
+    """
+    :return: (median, 95th percentile) seconds per call
+    """
+    function()
+    times = np.empty(calls)
+    for call in range(calls):
+        start_time = time.perf_counter()
+        function()
+        times[call] = time.perf_counter() - start_time
+    return np.median(times), np.percentile(times, 95)
+
+
+def legacy_wakeup_latency(delay):
+    """
+    :return: Seconds between the first scan arriving and the reader seeing it, polling as the environments did
+    """
+    state = {"ranges": None}
+
+    def publish():
+        time.sleep(delay)
+        state["published"] = time.perf_counter()
+        state["ranges"] = make_ranges(360)
+
+    publisher = threading.Thread(target=publish)
+    publisher.start()
+    while not state["ranges"]:
+        time.sleep(SLEEP_WAITING_FOR_IMAGE_TIME_IN_SECOND)
+    seen = time.perf_counter()
+    publisher.join()
+    return seen - state["published"]
+
+
+def processor_wakeup_latency(delay):
+    """
+    :return: Seconds between the first scan arriving and the reader seeing it, waiting on ScanProcessor
+    """
+    processor = ScanProcessor(LIDAR_SCAN_MAX_DISTANCE, LIDAR_SECTORS)
+    ranges = make_ranges(360)
+    state = {}
+
+    def publish():
+        time.sleep(delay)
+        state["published"] = time.perf_counter()
+        processor.update(ranges)
+
+    publisher = threading.Thread(target=publish)
+    publisher.start()
+    processor.wait_for_scan()
+    seen = time.perf_counter()
+    publisher.join()
+    return seen - state["published"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls',
+                        help='(int) Number of calls timed per scan size.',
+                        type=int,
+                        default=5000)
+    parser.add_argument('--episodes',
+                        help='(int) Number of first scans the wake up latency is measured on.',
+                        type=int,
+                        default=50)
+    args = parser.parse_args()
+
+    print("%-6s %-31s %10s %10s" % ("scan", "path", "median us", "p95 us"))
+    for size in SCAN_SIZES:
+        ranges = make_ranges(size)
+        processor = ScanProcessor(LIDAR_SCAN_MAX_DISTANCE, LIDAR_SECTORS)
+        processor.update(ranges)
+        paths = [("legacy, every step", lambda: legacy_min_distance(ranges)),
+                 ("ScanProcessor.update, per scan", lambda: processor.update(ranges)),
+                 ("wait_for_scan, every step", processor.wait_for_scan)]
+        for path, function in paths:
+            median, p95 = time_per_call(function, args.calls)
+            print("%-6d %-31s %10.1f %10.1f" % (size, path, median * 1e6, p95 * 1e6))
+
+    rng = np.random.RandomState(0)
+    delays = rng.uniform(0.001, 0.02, args.episodes)
+    for path, latency in [("legacy polling", legacy_wakeup_latency), ("ScanProcessor", processor_wakeup_latency)]:
+        latencies = np.array([latency(delay) for delay in delays])
+        print("First scan seen by the reader, %s: median %.2f ms, max %.2f ms" %
+              (path, np.median(latencies) * 1000, latencies.max() * 1000))
+
+
+if __name__ == '__main__':
+    main()
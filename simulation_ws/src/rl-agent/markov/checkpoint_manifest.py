@@ -0,0 +1,95 @@
+"""
+Manifests listing the size and content hash of the files of a checkpoint directory, used to only transfer the
+files whose content is not already at the destination
+"""
+import hashlib
+import os
+import threading
+
+MANIFEST_SUFFIX = ".manifest.json"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class FileHashCache(object):
+    """
+    SHA-256 digests of local files. A digest is only recomputed when the size or the modification time of the
+    file changed since it was last hashed.
+    """
+    def __init__(self):
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """
+        :param path: Local file
+        :return: Hex SHA-256 digest of the file's content
+        """
+        signature = _get_signature(path)
+        with self._lock:
+            cached = self._digests.get(path)
+        if cached and cached[0] == signature:
+            return cached[1]
+        digest = hash_file(path)
+        with self._lock:
+            self._digests[path] = (signature, digest)
+        return digest
+
+    def put(self, path, digest):
+        """
+        Remember the digest of a file whose content is known, e.g. because it was just downloaded
+        """
+        with self._lock:
+            self._digests[path] = (_get_signature(path), digest)
+
+    def matches(self, path, digest):
+        """
+        :return: True if the file exists and has the given digest
+        """
+        return os.path.isfile(path) and self.get(path) == digest
+
+
+def hash_file(path):
+    """
+    :return: Hex SHA-256 digest of the file's content
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def build_manifest(directory, hash_cache, exclude=()):
+    """
+    :param directory: Directory to list the files of, recursively
+    :param hash_cache: FileHashCache used to hash the files
+    :param exclude: Relative paths of the files to leave out
+    :return: Dict mapping the path of every file, relative to the directory, to a dict with its size and sha256
+    """
+    files = {}
+    for root, dirs, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            rel_name = os.path.relpath(path, directory)
+            if rel_name in exclude:
+                continue
+            files[rel_name] = {"size": os.path.getsize(path), "sha256": hash_cache.get(path)}
+    return files
+
+
+def index_by_digest(directory, hash_cache):
+    """
+    :return: Dict mapping the digest of every file under the directory to the path of a file with that content
+    """
+    index = {}
+    if os.path.isdir(directory):
+        for root, dirs, filenames in os.walk(directory):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                index.setdefault(hash_cache.get(path), path)
+    return index
+
+
+def _get_signature(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
@@ -0,0 +1,143 @@
+"""
+Background publisher that batches metrics to CloudWatch off the training thread
+"""
+import atexit
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+import boto3
+from botocore.config import Config
+
+# PutMetricData accepts up to 1000 datums per call, fewer can be set for endpoints with a lower limit
+MAX_METRIC_DATA_PER_REQUEST = int(os.environ.get("CLOUDWATCH_MAX_METRIC_DATA_PER_REQUEST", 1000))
+METRICS_QUEUE_SIZE = 1000
+FLUSH_INTERVAL_IN_SECOND = 10
+# Keep a slow endpoint from holding the publisher thread for long
+CLOUDWATCH_CONNECT_TIMEOUT_IN_SECOND = 5
+CLOUDWATCH_READ_TIMEOUT_IN_SECOND = 10
+
+
+class CloudWatchMetricsPublisher(object):
+    """
+    Metrics are put on a bounded queue and a daemon thread sends them with a single reused client, in batches
+    of up to max_metric_data_per_request datums whenever a batch is full or the flush interval elapsed.
+    When the queue is full or a request fails the datums are appended to spill_file as JSON lines if it is set,
+    and dropped otherwise.
+    """
+    def __init__(self, namespace, region_name, spill_file=None, endpoint_url=None,
+                 max_queue_size=METRICS_QUEUE_SIZE, flush_interval_in_second=FLUSH_INTERVAL_IN_SECOND,
+                 max_metric_data_per_request=MAX_METRIC_DATA_PER_REQUEST, create_client=None):
+        """
+        :param namespace: CloudWatch namespace of the metrics
+        :param region_name: AWS region to publish to
+        :param spill_file: Optional local file the datums that cannot be sent are written to
+        :param endpoint_url: Optional CloudWatch endpoint, e.g. a local stub
+        :param max_queue_size: Maximum number of datums waiting to be sent
+        :param flush_interval_in_second: Maximum time a datum waits before being sent
+        :param max_metric_data_per_request: Maximum number of datums sent in a put_metric_data call
+        :param create_client: Callable returning a CloudWatch client, e.g. a stub, defaults to a boto3 client for
+                              region_name and endpoint_url. Called again after a request failed.
+        """
+        self.namespace = namespace
+        self.region_name = region_name
+        self.spill_file = spill_file
+        self.endpoint_url = endpoint_url
+        self.flush_interval_in_second = flush_interval_in_second
+        self.max_metric_data_per_request = max_metric_data_per_request
+        self.create_client = create_client or self._create_boto3_client
+        self.num_sent = 0
+        self.num_dropped = 0
+        self.num_spilled = 0
+        self._client = None
+        self._queue = queue.Queue(max_queue_size)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="cloudwatch-publisher")
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put_metrics(self, metric_data):
+        """
+        Queue datums to be published without blocking
+        :param metric_data: List of MetricData dicts as accepted by put_metric_data, they are not modified
+        """
+        timestamp = datetime.datetime.utcnow()
+        for datum in metric_data:
+            datum = dict(datum)
+            datum.setdefault('Timestamp', timestamp)
+            try:
+                self._queue.put_nowait(datum)
+            except queue.Full:
+                self._discard([datum])
+
+    def close(self, timeout=FLUSH_INTERVAL_IN_SECOND):
+        """
+        Send everything that is queued and stop the publisher thread
+        """
+        if not self._stop.is_set():
+            self._stop.set()
+            try:
+                # Wake the publisher thread up if it is waiting for datums
+                self._queue.put_nowait(None)
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+
+    def _run(self):
+        batch = []
+        deadline = time.time() + self.flush_interval_in_second
+        while True:
+            stopping = self._stop.is_set()
+            try:
+                # Once stopping, drain whatever is left without waiting
+                datum = self._queue.get(block=not stopping, timeout=max(0, deadline - time.time()))
+                if datum is not None:
+                    batch.append(datum)
+            except queue.Empty:
+                pass
+            if batch and (len(batch) >= self.max_metric_data_per_request or time.time() >= deadline or
+                          (stopping and self._queue.empty())):
+                self._send(batch)
+                batch = []
+            if time.time() >= deadline:
+                deadline = time.time() + self.flush_interval_in_second
+            if stopping and not batch and self._queue.empty():
+                return
+
+    def _send(self, batch):
+        try:
+            self._get_client().put_metric_data(MetricData=batch, Namespace=self.namespace)
+            self.num_sent += len(batch)
+        except Exception as err:
+            print("Error publishing metrics to CloudWatch: {}".format(err))
+            # Credentials may have expired, build a new client for the next batch
+            self._client = None
+            self._discard(batch)
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = self.create_client()
+        return self._client
+
+    def _create_boto3_client(self):
+        session = boto3.session.Session()
+        return session.client('cloudwatch', region_name=self.region_name,
+                              endpoint_url=self.endpoint_url,
+                              config=Config(connect_timeout=CLOUDWATCH_CONNECT_TIMEOUT_IN_SECOND,
+                                            read_timeout=CLOUDWATCH_READ_TIMEOUT_IN_SECOND,
+                                            retries={'max_attempts': 2}))
+
+    def _discard(self, metric_data):
+        if self.spill_file:
+            try:
+                with open(self.spill_file, 'a') as spill_file:
+                    for datum in metric_data:
+                        spill_file.write(json.dumps(datum, default=str) + "\n")
+                self.num_spilled += len(metric_data)
+                return
+            except Exception as err:
+                print("Error spilling metrics to {}: {}".format(self.spill_file, err))
+        self.num_dropped += len(metric_data)
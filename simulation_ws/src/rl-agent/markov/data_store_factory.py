@@ -0,0 +1,31 @@
+"""
+Builds the data store the trainer and the rollout workers exchange checkpoints through, from its URL
+"""
+from urllib.parse import urlparse
+from markov.s3_boto_data_store import S3BotoDataStore, S3BotoDataStoreParameters
+from markov.local_data_store import LocalDataStore, LocalDataStoreParameters
+
+
+def create_data_store(url, checkpoint_dir, aws_region, bucket_name=None, s3_folder=None):
+    """
+    :param url: s3://<bucket>/<prefix> for S3, file:///<directory> or a plain path for a directory on a disk shared
+                by the trainer and the rollout workers, None to use S3 with bucket_name and s3_folder
+    :param checkpoint_dir: Local directory the checkpoints are written to or restored from
+    :param aws_region: AWS region of the bucket
+    :return: Tuple of the data store parameters and the data store
+    """
+    if not url:
+        params = S3BotoDataStoreParameters(bucket_name=bucket_name, s3_folder=s3_folder,
+                                           checkpoint_dir=checkpoint_dir, aws_region=aws_region)
+        return params, S3BotoDataStore(params)
+
+    parsed_url = urlparse(url)
+    if parsed_url.scheme == "s3":
+        params = S3BotoDataStoreParameters(bucket_name=parsed_url.netloc, s3_folder=parsed_url.path.lstrip("/"),
+                                           checkpoint_dir=checkpoint_dir, aws_region=aws_region)
+        return params, S3BotoDataStore(params)
+    if parsed_url.scheme in ("file", ""):
+        params = LocalDataStoreParameters(store_dir=parsed_url.netloc + parsed_url.path,
+                                          checkpoint_dir=checkpoint_dir)
+        return params, LocalDataStore(params)
+    raise ValueError("Unsupported data store URL {}, expected s3://<bucket>/<prefix> or file:///<directory>".format(url))
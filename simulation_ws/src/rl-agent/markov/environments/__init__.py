@@ -10,9 +10,38 @@ register(
 )
 
 
+register(
+    id='Rover-TrainingGrounds-Lidar-v2',
+    entry_point='markov.environments.training_env:RoverTrainingGroundsLidarDiscreteEnv',
+    max_episode_steps = MAX_STEPS,
+    reward_threshold = 500
+)
+
+
 register(
     id='Mars-v1',
     entry_point='markov.environments.mars_env:MarsDiscreteEnv',
     max_episode_steps = MAX_STEPS,
     reward_threshold = 2000
-)
\ No newline at end of file
+)
+
+
+# Same as Mars-v1 with a smaller grayscale observation, trained with the mars_grayscale_presets.py preset. The
+# observation_config keys are the arguments of markov.environments.preprocessing.ObservationPipeline (crop, grayscale,
+# width, height, frame_difference, resize_method)
+register(
+    id='Mars-Grayscale-v1',
+    entry_point='markov.environments.mars_env:MarsDiscreteEnv',
+    max_episode_steps = MAX_STEPS,
+    reward_threshold = 2000,
+    kwargs={'observation_config': {'width': 80, 'height': 60, 'grayscale': True}}
+)
+
+
+# Same as Mars-v1 observing LIDAR sector distances, checkpoint distance/bearing and odometry instead of the camera
+register(
+    id='Mars-Lidar-v1',
+    entry_point='markov.environments.mars_env:MarsLidarDiscreteEnv',
+    max_episode_steps = MAX_STEPS,
+    reward_threshold = 2000
+)
@@ -0,0 +1,220 @@
+"""
+Preprocessing of the raw camera frames into observations
+"""
+import numpy as np
+from gym import spaces
+from PIL import Image
+
+# Resize methods
+RESIZE_METHOD_PIL = "pil"        # PIL Image.frombytes + ANTIALIAS resize (the original path)
+RESIZE_METHOD_AREA = "area"      # Average of the source pixels covered by each output pixel
+RESIZE_METHOD_STRIDE = "stride"  # Nearest source pixel, i.e. subsampling with a fixed stride
+
+
+class FrameDownsampler(object):
+    """
+    Downsamples packed RGB8 frames straight from the raw message buffer into a preallocated uint8 array.
+    The frame is viewed with np.frombuffer, so neither the crop nor the reshape copies the pixel data.
+    Intermediate buffers are allocated once per source resolution and reused for every frame.
+    """
+    def __init__(self, out_width, out_height, channels=3, crop=None, method=RESIZE_METHOD_AREA):
+        """
+        :param out_width: Width of the output image in pixels
+        :param out_height: Height of the output image in pixels
+        :param channels: Number of interleaved 8 bit channels in the frame
+        :param crop: Optional (left, top, right, bottom) region of the source frame to keep, in pixels
+        :param method: RESIZE_METHOD_AREA or RESIZE_METHOD_STRIDE
+        """
+        if method not in (RESIZE_METHOD_AREA, RESIZE_METHOD_STRIDE):
+            raise ValueError("Unsupported resize method: {}".format(method))
+        self.out_width = out_width
+        self.out_height = out_height
+        self.channels = channels
+        self.crop = crop
+        self.method = method
+        self.out = np.empty((out_height, out_width, channels), dtype=np.uint8)
+        self._source_size = None
+
+    def __call__(self, data, width, height):
+        """
+        :param data: Raw frame bytes, rows of width * channels bytes
+        :param width: Width of the frame in pixels
+        :param height: Height of the frame in pixels
+        :return: The preallocated output array, overwritten by the next call
+        """
+        if self._source_size != (width, height):
+            self._prepare(width, height)
+        frame = np.frombuffer(data, dtype=np.uint8, count=width * height * self.channels)
+        frame = frame.reshape(height, width, self.channels)[self._rows, self._cols]
+        self._resize(frame)
+        return self.out
+
+    def _prepare(self, width, height):
+        left, top, right, bottom = self.crop or (0, 0, width, height)
+        if not (0 <= left < right <= width and 0 <= top < bottom <= height):
+            raise ValueError("Crop {} does not fit in a {}x{} frame".format(self.crop, width, height))
+        self._rows = slice(top, bottom)
+        self._cols = slice(left, right)
+        in_width, in_height = right - left, bottom - top
+
+        if self.method == RESIZE_METHOD_STRIDE:
+            self._row_index = _nearest_indices(in_height, self.out_height)
+            self._col_index = _nearest_indices(in_width, self.out_width)
+            self._row_buffer = np.empty((self.out_height, in_width, self.channels), dtype=np.uint8)
+            self._resize = self._resize_stride
+        elif in_height % self.out_height == 0 and in_width % self.out_width == 0:
+            self._block = (in_height // self.out_height, in_width // self.out_width)
+            self._sum = np.empty(self.out.shape, dtype=np.uint32)
+            self._resize = self._resize_blocks
+        else:
+            # Separable area average, the rows are averaged first and then the columns. Every output pixel
+            # only covers a few source pixels, so each pass is a short sum of weighted strided gathers.
+            self._row_taps = _area_taps(in_height, self.out_height)
+            self._col_taps = _area_taps(in_width, self.out_width)
+            self._row_gather = np.empty((self.out_height, in_width, self.channels), dtype=np.uint8)
+            self._row_pass = np.empty((self.out_height, in_width, self.channels), dtype=np.float32)
+            self._col_gather = np.empty(self.out.shape, dtype=np.float32)
+            self._col_pass = np.empty(self.out.shape, dtype=np.float32)
+            self._weighted = np.empty((self.out_height, in_width, self.channels), dtype=np.float32)
+            self._resize = self._resize_weighted
+        self._source_size = (width, height)
+
+    def _resize_stride(self, frame):
+        np.take(frame, self._row_index, axis=0, out=self._row_buffer, mode='clip')
+        np.take(self._row_buffer, self._col_index, axis=1, out=self.out, mode='clip')
+
+    def _resize_blocks(self, frame):
+        # Accumulate one strided view per position in the block, each of them the size of the output
+        block_height, block_width = self._block
+        pixels = block_height * block_width
+        self._sum.fill(pixels // 2)  # Round to the nearest integer
+        for row in range(block_height):
+            for col in range(block_width):
+                np.add(self._sum, frame[row::block_height, col::block_width], out=self._sum)
+        self._sum //= pixels
+        np.copyto(self.out, self._sum, casting='unsafe')
+
+    def _resize_weighted(self, frame):
+        self._row_pass.fill(0)
+        for indices, weights in zip(*self._row_taps):
+            np.take(frame, indices, axis=0, out=self._row_gather, mode='clip')
+            np.multiply(self._row_gather, weights[:, None, None], out=self._weighted)
+            self._row_pass += self._weighted
+
+        self._col_pass.fill(0.5)  # Round to the nearest integer
+        weighted = self._weighted[:, :self.out_width]
+        for indices, weights in zip(*self._col_taps):
+            np.take(self._row_pass, indices, axis=1, out=self._col_gather, mode='clip')
+            np.multiply(self._col_gather, weights[None, :, None], out=weighted)
+            self._col_pass += weighted
+        np.copyto(self.out, self._col_pass, casting='unsafe')
+
+
+class ObservationPipeline(object):
+    """
+    Declarative camera preprocessing applied in order: ROI crop, resize, grayscale and frame differencing.
+    Environments build it from the keyword arguments given to their gym registration, and take their
+    observation_space from it so the agent's network matches the preprocessed observation.
+    """
+    def __init__(self, width, height, crop=None, grayscale=False, frame_difference=False,
+                 resize_method=RESIZE_METHOD_PIL):
+        """
+        :param width: Width of the observation in pixels
+        :param height: Height of the observation in pixels
+        :param crop: Optional (left, top, right, bottom) region of the camera frame to keep, in pixels
+        :param grayscale: Convert the image to a single luma channel
+        :param frame_difference: Append the change since the previous frame as extra channels, encoded as
+                                 128 + difference / 2 so that 128 means unchanged
+        :param resize_method: RESIZE_METHOD_PIL, RESIZE_METHOD_AREA or RESIZE_METHOD_STRIDE
+        """
+        self.width = width
+        self.height = height
+        self.crop = tuple(crop) if crop else None
+        self.grayscale = grayscale
+        self.frame_difference = frame_difference
+        self.resize_method = resize_method
+        self.downsampler = None
+        if resize_method != RESIZE_METHOD_PIL:
+            self.downsampler = FrameDownsampler(width, height, crop=self.crop, method=resize_method)
+        self.previous_frame = None
+
+    @property
+    def observation_space(self):
+        channels = 1 if self.grayscale else 3
+        if self.frame_difference:
+            channels *= 2
+        # Always height x width x channels: rl_coach's GymEnvironment only treats 3-D spaces as images, one or three
+        # channels as an ImageObservationSpace and any other number of channels as planar maps
+        return spaces.Box(low=0, high=255, shape=(self.height, self.width, channels), dtype=np.uint8)
+
+    def reset(self):
+        """
+        Forget the previous frame, call at the start of every episode
+        """
+        self.previous_frame = None
+
+    def __call__(self, data, width, height):
+        """
+        :param data: Raw RGB8 frame bytes
+        :param width: Width of the frame in pixels
+        :param height: Height of the frame in pixels
+        :return: A new height x width x channels uint8 array shaped like observation_space
+        """
+        if self.downsampler:
+            image = self.downsampler(data, width, height)
+            if self.grayscale:
+                image = _luma(image)
+            else:
+                image = image.copy()
+        else:
+            image = Image.frombytes('RGB', (width, height), data, 'raw', 'RGB', 0, 1)
+            if self.crop:
+                image = image.crop(self.crop)
+            image = image.resize((self.width, self.height), Image.ANTIALIAS)
+            if self.grayscale:
+                image = image.convert('L')
+            image = np.array(image)
+        if self.grayscale:
+            image = image[:, :, np.newaxis]
+
+        if not self.frame_difference:
+            return image
+
+        previous_frame = image if self.previous_frame is None else self.previous_frame
+        self.previous_frame = image
+        difference = ((image.astype(np.int16) - previous_frame) // 2 + 128).astype(np.uint8)
+        return np.concatenate((image, difference), axis=-1)
+
+
+def _luma(image):
+    """
+    :return: ITU-R 601-2 luma of an RGB image, the weights PIL uses for mode "L"
+    """
+    rgb = image.astype(np.uint32)
+    luma = rgb[..., 0] * 299 + rgb[..., 1] * 587 + rgb[..., 2] * 114
+    return ((luma + 500) // 1000).astype(np.uint8)
+
+
+def _nearest_indices(in_size, out_size):
+    """
+    :return: Index of the source pixel at the center of each output pixel
+    """
+    centers = (np.arange(out_size) + 0.5) * in_size / out_size
+    return np.minimum(centers.astype(np.intp), in_size - 1)
+
+
+def _area_taps(in_size, out_size):
+    """
+    :return: (indices, weights), two (taps, out_size) arrays where tap t of output pixel i covers source pixel
+             indices[t, i] with the fraction weights[t, i] of its area. The weights of a pixel sum to one.
+    """
+    scale = in_size / out_size
+    starts = np.arange(out_size) * scale
+    ends = starts + scale
+    first = np.floor(starts).astype(np.intp)
+    taps = int(np.max(np.ceil(ends).astype(np.intp) - first))
+    indices = np.minimum(first[None, :] + np.arange(taps)[:, None], in_size - 1)
+    overlap = (np.minimum(ends[None, :], first[None, :] + np.arange(taps)[:, None] + 1) -
+               np.maximum(starts[None, :], first[None, :] + np.arange(taps)[:, None]))
+    weights = np.clip(overlap, 0, None) / scale
+    return indices, weights.astype(np.float32)
@@ -0,0 +1,217 @@
+"""
+Helpers shared by the environments for consuming sensor data coming in on the ROS topics
+"""
+import math
+import threading
+import time
+from collections import namedtuple
+import numpy as np
+
+# Topics the environments wait on before calculating the reward for an action
+SCAN_TOPIC = '/scan'
+IMAGE_TOPIC = '/camera/image_raw'
+ODOM_TOPIC = '/odom'
+STEP_SYNC_TOPICS = (SCAN_TOPIC, IMAGE_TOPIC, ODOM_TOPIC)
+
+# Step synchronization modes
+STEP_SYNC_MODE_SLEEP = "sleep"      # Sleep for a fixed interval after each action
+STEP_SYNC_MODE_SENSOR = "sensor"    # Wait until every sensor published data stamped after the action
+
+
+class SensorSync(object):
+    """
+    Keeps the header stamp of the latest message received on each topic, so that a caller can block
+    until every topic has published data newer than a given stamp (e.g. the time an action was sent).
+    ROS callbacks call update() and the environment calls wait_for_fresh_data(); stamps are plain
+    floats in seconds so this can be driven by any publisher.
+    """
+    def __init__(self, topics=STEP_SYNC_TOPICS):
+        self.topics = tuple(topics)
+        self._condition = threading.Condition()
+        self._stamps = dict.fromkeys(self.topics)
+
+    def update(self, topic, stamp):
+        """
+        :param topic: Topic the message was received on
+        :param stamp: Header stamp of the message in seconds
+        """
+        with self._condition:
+            self._stamps[topic] = stamp
+            self._condition.notify_all()
+
+    def reset(self):
+        with self._condition:
+            self._stamps = dict.fromkeys(self.topics)
+
+    def get_stamp(self, topic):
+        with self._condition:
+            return self._stamps.get(topic)
+
+    def wait_for_fresh_data(self, after_stamp, timeout, topics=None):
+        """
+        :param after_stamp: Every topic must have a message stamped later than this (in seconds)
+        :param timeout: Maximum wall time to wait in seconds
+        :param topics: Topics to wait for, defaults to all of them
+        :return: True if all the topics have fresh data, False if the deadline passed first
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            while not self._is_fresh(after_stamp, topics or self.topics):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+    def _is_fresh(self, after_stamp, topics):
+        for topic in topics:
+            stamp = self._stamps[topic]
+            if stamp is None or stamp <= after_stamp:
+                return False
+        return True
+
+
+# A camera frame without the rest of the ROS message; seq increases by one for every frame received
+Frame = namedtuple('Frame', ['data', 'width', 'height', 'stamp', 'seq'])
+
+
+class FrameMailbox(object):
+    """
+    Overwrite-latest mailbox for camera frames. Only the newest frame is kept, so consumers always observe
+    the most recent image and never block the ROS callback. Consumers remember the sequence number of the
+    last frame they used and wait for a newer one.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._frame = None
+
+    @property
+    def seq(self):
+        """
+        :return: Sequence number of the newest frame, 0 if no frame was received yet
+        """
+        with self._condition:
+            return self._frame.seq if self._frame else 0
+
+    def put(self, data, width, height, stamp):
+        """
+        :param data: Raw RGB8 pixel data
+        :param width: Width of the image in pixels
+        :param height: Height of the image in pixels
+        :param stamp: Header stamp of the image in seconds
+        """
+        with self._condition:
+            seq = self._frame.seq + 1 if self._frame else 1
+            self._frame = Frame(data, width, height, stamp, seq)
+            self._condition.notify_all()
+
+    def get_latest(self):
+        with self._condition:
+            return self._frame
+
+    def wait_for_frame(self, newer_than_seq=0, timeout=None):
+        """
+        :param newer_than_seq: Only return a frame with a sequence number greater than this one
+        :param timeout: Maximum wall time to wait in seconds, None to wait forever
+        :return: The newest frame, or None if no newer frame arrived before the timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._frame is None or self._frame.seq <= newer_than_seq:
+                if deadline is None:
+                    self._condition.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+            return self._frame
+
+
+class ScanProcessor(object):
+    """
+    Processes every LaserScan once, in the ROS callback, into preallocated arrays: invalid readings are
+    cleaned up and the overall and per-sector minimum distances are computed. The sector boundaries are
+    cached per scan size. Readers wait on a condition for the first scan instead of polling.
+    """
+    def __init__(self, max_distance, sectors=1):
+        """
+        :param max_distance: Readings that are NaN, infinite or further than this are set to this distance
+        :param sectors: Number of equal angular sectors to compute the minimum distance of, ordered from the
+                        scan's min angle to its max angle
+        """
+        self.max_distance = max_distance
+        self.sectors = sectors
+        self._condition = threading.Condition()
+        self._buffers = {}
+        self._sector_minima = np.empty(sectors, dtype=np.float32)
+        self._min_distance = None
+
+    def update(self, ranges):
+        """
+        :param ranges: Distances of the LaserScan message
+        """
+        if len(ranges) < self.sectors:
+            return
+        distances, invalid, sector_starts = self._get_buffers(len(ranges))
+        distances[:] = ranges
+        np.isnan(distances, out=invalid)
+        np.copyto(distances, self.max_distance, where=invalid)
+        np.clip(distances, 0, self.max_distance, out=distances)
+
+        with self._condition:
+            np.minimum.reduceat(distances, sector_starts, out=self._sector_minima)
+            self._min_distance = float(self._sector_minima.min())
+            self._condition.notify_all()
+
+    def reset(self):
+        """
+        Forget the last scan, so that readers wait for a new one
+        """
+        with self._condition:
+            self._min_distance = None
+
+    def wait_for_scan(self, timeout=None):
+        """
+        :param timeout: Maximum wall time to wait in seconds, None to wait forever
+        :return: (minimum distance, copy of the per-sector minimum distances) of the latest scan,
+                 or None if no scan arrived before the timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._min_distance is None:
+                if deadline is None:
+                    self._condition.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+            return self._min_distance, self._sector_minima.copy()
+
+    def _get_buffers(self, size):
+        """
+        :return: Distance and mask buffers for scans of the given size, and the index each sector starts at
+        """
+        if size not in self._buffers:
+            sector_starts = np.linspace(0, size, self.sectors + 1)[:-1].astype(np.intp)
+            self._buffers[size] = (np.empty(size, dtype=np.float32), np.empty(size, dtype=bool), sector_starts)
+        return self._buffers[size]
+
+
+def yaw_from_quaternion(orientation):
+    """
+    :param orientation: geometry_msgs Quaternion
+    :return: Rotation around the z axis in radians
+    """
+    return math.atan2(2 * (orientation.w * orientation.z + orientation.x * orientation.y),
+                      1 - 2 * (orientation.y * orientation.y + orientation.z * orientation.z))
+
+
+def bearing_to(x, y, yaw, target_x, target_y):
+    """
+    :return: Angle in radians, in [-pi, pi], between the heading given by yaw and the direction from (x, y)
+             to the target. Positive when the target is to the left.
+    """
+    bearing = math.atan2(target_y - y, target_x - x) - yaw
+    return math.atan2(math.sin(bearing), math.cos(bearing))
@@ -1,12 +1,10 @@
 from __future__ import print_function
 
 import time
-import boto3
+import threading
 import gym
 import numpy as np
 from gym import spaces
-import PIL
-from PIL import Image
 import os
 import random
 import math
@@ -14,15 +12,20 @@ import sys
 import rospy
 from nav_msgs.msg import Odometry
 from geometry_msgs.msg import Twist, Pose, Quaternion
-from gazebo_msgs.srv import SetModelState, SetModelConfiguration
+from gazebo_msgs.srv import SetModelState, SetModelConfiguration, SetModelStateRequest, SetModelConfigurationRequest
 from gazebo_msgs.msg import ModelState, ContactsState
 from sensor_msgs.msg import Image as sensor_image
 from sensor_msgs.msg import LaserScan
 from geometry_msgs.msg import Point
 from std_msgs.msg import Float64
 from std_msgs.msg import String
-from PIL import Image
-import queue
+from markov.environments.sensors import (SensorSync, FrameMailbox, ScanProcessor, STEP_SYNC_MODE_SLEEP,
+                                         STEP_SYNC_MODE_SENSOR, STEP_SYNC_TOPICS, SCAN_TOPIC, IMAGE_TOPIC,
+                                         ODOM_TOPIC, yaw_from_quaternion, bearing_to)
+from markov.environments.world_control import WorldControl, PersistentService
+from markov.cloudwatch import CloudWatchMetricsPublisher
+from markov.step_logger import StepLogger
+from markov.environments.preprocessing import ObservationPipeline, RESIZE_METHOD_PIL
 
 
 VERSION = "0.0.4"
@@ -32,12 +35,9 @@ TRAINING_IMAGE_HEIGHT = 120
 TRAINING_IMAGE_SIZE = (TRAINING_IMAGE_WIDTH, TRAINING_IMAGE_HEIGHT)
 
 LIDAR_SCAN_MAX_DISTANCE = 4.5  # Max distance Lidar scanner can measure
+LIDAR_SECTORS = 8  # Number of equal angular sectors the LIDAR minimum distance is also computed for
 CRASH_DISTANCE = 0.49  # Min distance to obstacle (The LIDAR is in the center of the 1M Rover)
 
-# Size of the image queue buffer, we want this to be one so that we consume 1 image
-# at a time, but may want to change this as we add more algorithms
-IMG_QUEUE_BUF_SIZE = 1
-
 
 # REWARD Multipliers
 COLLISION_REWARD = 0
@@ -62,6 +62,31 @@ INITIAL_ORIENT_Y = 0.0178586654381
 INITIAL_ORIENT_Z = -0.699497425461
 INITIAL_ORIENT_W = 0.71419778911
 
+
+# Rover model and the joints reset at the start of each episode (this is all of them)
+ROVER_MODEL_NAME = 'rover'
+ROVER_URDF_PARAM_NAME = 'rover_description'
+ROVER_JOINT_NAMES = ("rocker_left_corner_lb",
+                     "rocker_right_corner_rb",
+                     "body_rocker_left",
+                     "body_rocker_right",
+                     "rocker_right_bogie_right",
+                     "rocker_left_bogie_left",
+                     "bogie_left_corner_lf",
+                     "bogie_right_corner_rf",
+                     "corner_lf_wheel_lf",
+                     "imu_wheel_lf_joint",
+                     "bogie_left_wheel_lm",
+                     "imu_wheel_lm_joint",
+                     "corner_lb_wheel_lb",
+                     "imu_wheel_lb_joint",
+                     "corner_rf_wheel_rf",
+                     "imu_wheel_rf_joint",
+                     "bogie_right_wheel_rm",
+                     "imu_wheel_rm_joint",
+                     "corner_rb_wheel_rb",
+                     "imu_wheel_rb_joint")
+
 # Initial distance to checkpoint
 INITIAL_DISTANCE_TO_CHECKPOINT = abs(math.sqrt(((CHECKPOINT_X - INITIAL_POS_X) ** 2) +
                                                ((CHECKPOINT_Y - INITIAL_POS_Y) ** 2)))
@@ -76,11 +101,67 @@ STAGE_Y_MAX = 10.0
 # SLEEP INTERVALS
 SLEEP_AFTER_RESET_TIME_IN_SECOND = 0.3
 SLEEP_BETWEEN_ACTION_AND_REWARD_CALCULATION_TIME_IN_SECOND = 0.3 # LIDAR Scan is 5 FPS (0.2sec).
-SLEEP_WAITING_FOR_IMAGE_TIME_IN_SECOND = 0.01
+
+# FAST RESET - instead of sleeping SLEEP_AFTER_RESET_TIME_IN_SECOND after a reset, wait until every sensor
+# published data stamped after the reset and the rover moves and turns slower than RESET_SETTLE_SPEED, for at most
+# RESET_SETTLE_DEADLINE_IN_SECOND of simulation time
+FAST_RESET = os.environ.get("FAST_RESET", "false").lower() == "true"
+RESET_SETTLE_SPEED = float(os.environ.get("RESET_SETTLE_SPEED", 0.05))  # m/s and rad/s
+RESET_SETTLE_DEADLINE_IN_SECOND = float(os.environ.get("RESET_SETTLE_DEADLINE_IN_SECOND", 2.0))
+
+# PRE RESET - start resetting the world in a background thread as soon as an episode is done, so that
+# the reset overlaps with the agent's training and reset() only collects the initial observation
+PRE_RESET = os.environ.get("PRE_RESET", "false").lower() == "true"
+
+# STEP SYNCHRONIZATION - "sleep" waits SLEEP_BETWEEN_ACTION_AND_REWARD_CALCULATION_TIME_IN_SECOND after each action,
+# "sensor" waits until the LIDAR, camera and odometry have all published data stamped after the action
+STEP_SYNC_MODE = os.environ.get("STEP_SYNC_MODE", STEP_SYNC_MODE_SLEEP)
+STEP_SYNC_DEADLINE_IN_SECOND = float(os.environ.get("STEP_SYNC_DEADLINE_IN_SECOND", 1.0))
+
+# PAUSED PHYSICS - keep the physics paused between actions and run it for PHYSICS_TICKS_PER_STEP ticks after every
+# action. When no tick count is given it is derived from SLEEP_BETWEEN_ACTION_AND_REWARD_CALCULATION_TIME_IN_SECOND.
+# The physics is paused from here after a sleep in simulation time, so a step can run for more ticks than requested:
+# the ticks actually run are reported as info['physics_ticks'] by step(), see WorldControl.
+PAUSE_PHYSICS_BETWEEN_STEPS = os.environ.get("PAUSE_PHYSICS_BETWEEN_STEPS", "false").lower() == "true"
+PHYSICS_TICKS_PER_STEP = int(os.environ.get("PHYSICS_TICKS_PER_STEP", 0))
+# When a step is shorter than the period of a sensor, the world is stepped PHYSICS_TICKS_PER_SENSOR_RETRY more ticks
+# at a time (a quarter of a step by default) until every sensor published, for at most STEP_SYNC_DEADLINE_IN_SECOND of
+# simulation time. Before each retry the messages of the ticks that already ran get SENSOR_DATA_IN_FLIGHT_IN_SECOND
+# of wall time to arrive. The ticks of the retries are reported as info['physics_retry_ticks'].
+PHYSICS_TICKS_PER_SENSOR_RETRY = int(os.environ.get("PHYSICS_TICKS_PER_SENSOR_RETRY", 0))
+SENSOR_DATA_IN_FLIGHT_IN_SECOND = 0.05
+
+# IMAGE RESIZING - "pil" resizes with PIL ANTIALIAS, "area" (area average) and "stride" (subsampling) read the
+# camera buffer in place with NumPy and write into a preallocated buffer. Used unless the registration's
+# observation_config picks a resize_method.
+IMAGE_RESIZE_METHOD = os.environ.get("IMAGE_RESIZE_METHOD", RESIZE_METHOD_PIL)
+
+# CLOUDWATCH METRICS - published in the background, metrics that cannot be sent are appended to
+# CLOUDWATCH_SPILL_FILE when it is set and dropped otherwise
+CLOUDWATCH_NAMESPACE = 'AWS_NASA_JPL_OSR_Challenge'
+CLOUDWATCH_SPILL_FILE = os.environ.get("CLOUDWATCH_SPILL_FILE")
+CLOUDWATCH_ENDPOINT_URL = os.environ.get("CLOUDWATCH_ENDPOINT_URL")  # e.g. a local stub endpoint
+
+# STEP LOGGING - a JSON record is written every STEP_LOG_SAMPLE_EVERY steps (0 for none), at most
+# STEP_LOG_MAX_RECORDS_PER_SECOND a second (0 for no limit). The last STEP_LOG_RING_SIZE records that were
+# sampled out are written at the end of each episode and on errors.
+STEP_LOG_SAMPLE_EVERY = int(os.environ.get("STEP_LOG_SAMPLE_EVERY", 1))
+STEP_LOG_MAX_RECORDS_PER_SECOND = float(os.environ.get("STEP_LOG_MAX_RECORDS_PER_SECOND", 0))
+STEP_LOG_RING_SIZE = int(os.environ.get("STEP_LOG_RING_SIZE", 50))
+STEP_LOG_FIELDS = ('step', 'steering', 'reward', 'distance_to_checkpoint', 'distance_travelled',
+                   'collision_threshold', 'closer_to_checkpoint', 'power_supply_range')
 
 
 class RoverTrainingGroundsEnv(gym.Env):
-    def __init__(self):
+    # Environments that do not observe the camera set this to False to skip receiving images entirely
+    observe_camera = True
+
+    def __init__(self, observation_config=None, lidar_sectors=LIDAR_SECTORS):
+        """
+        :param observation_config: Keyword arguments for the camera ObservationPipeline (crop, grayscale,
+                                   width, height, frame_difference, resize_method), set per gym registration
+        :param lidar_sectors: Number of sectors the LIDAR minimum distance is computed for
+        """
         self.x = INITIAL_POS_X
         self.y = INITIAL_POS_Y
         self.orientation = None
@@ -94,6 +175,7 @@ class RoverTrainingGroundsEnv(gym.Env):
         self.current_distance_to_checkpoint = INITIAL_DISTANCE_TO_CHECKPOINT
         self.collision_threshold = sys.maxsize
         self.collision = False
+        self.reached_checkpoint = False
         self.state = None
         self.steering = 0
         self.throttle = 0
@@ -106,13 +188,41 @@ class RoverTrainingGroundsEnv(gym.Env):
         self.action_space = spaces.Box(low=np.array([-1, 0]), high=np.array([+1, +3]), dtype=np.float32)
 
 
-        # Create the observation space
-        self.observation_space = spaces.Box(low=0, high=255,
-                                            shape=(TRAINING_IMAGE_SIZE[1], TRAINING_IMAGE_SIZE[0], 3),
-                                            dtype=np.uint8)
+        # Create the camera preprocessing pipeline and the matching observation space
+        pipeline_params = {'width': TRAINING_IMAGE_WIDTH,
+                           'height': TRAINING_IMAGE_HEIGHT,
+                           'resize_method': IMAGE_RESIZE_METHOD}
+        pipeline_params.update(observation_config or {})
+        self.observation_pipeline = ObservationPipeline(**pipeline_params)
+        self.observation_space = self.observation_pipeline.observation_space
 
         self.state = None
-        self.image_queue = queue.Queue(IMG_QUEUE_BUF_SIZE)
+        self.image_mailbox = FrameMailbox()                                     # Latest camera frame
+        self.last_image_seq = 0                                                 # Sequence of the last frame used
+
+        # LIDAR scans are processed as they arrive
+        self.scan_processor = ScanProcessor(LIDAR_SCAN_MAX_DISTANCE, lidar_sectors)
+        self.sector_distances = None                                            # Min distance per LIDAR sector
+
+        # Episode metrics are sent to CloudWatch off the training thread
+        self.metrics_publisher = CloudWatchMetricsPublisher(CLOUDWATCH_NAMESPACE, self.aws_region,
+                                                            spill_file=CLOUDWATCH_SPILL_FILE,
+                                                            endpoint_url=CLOUDWATCH_ENDPOINT_URL)
+
+        # Per-step records are written in the background
+        self.step_logger = StepLogger(STEP_LOG_FIELDS, sample_every=STEP_LOG_SAMPLE_EVERY,
+                                      max_records_per_second=STEP_LOG_MAX_RECORDS_PER_SECOND,
+                                      ring_size=STEP_LOG_RING_SIZE)
+
+        # Episode reset started in the background when PRE_RESET is enabled
+        self.pre_reset_thread = None
+        self.pre_reset_error = None
+        self.pre_reset_image_seq = 0                                            # Last frame before the pre-reset
+
+        # Step synchronization
+        self.step_sync_mode = STEP_SYNC_MODE
+        self.sensor_sync = SensorSync([topic for topic in STEP_SYNC_TOPICS
+                                       if self.observe_camera or topic != IMAGE_TOPIC])
 
         # ROS initialization
         self.ack_publisher = rospy.Publisher('/cmd_vel', Twist, queue_size=100)
@@ -122,21 +232,45 @@ class RoverTrainingGroundsEnv(gym.Env):
         self.distance_travelled_pub = rospy.Publisher('/distance_travelled', String, queue_size=3)
         # ################################################################################
 
-        self.gazebo_model_state_service = rospy.ServiceProxy('/gazebo/set_model_state', SetModelState)
-        self.gazebo_model_configuration_service = rospy.ServiceProxy('/gazebo/set_model_configuration', SetModelConfiguration)
+        self.gazebo_model_state_service = PersistentService('/gazebo/set_model_state', SetModelState)
+        self.gazebo_model_configuration_service = PersistentService('/gazebo/set_model_configuration', SetModelConfiguration)
+
+        # The reset requests are the same every episode, build them once
+        model_state = ModelState()
+        model_state.model_name = ROVER_MODEL_NAME
+        model_state.pose.position = Point(INITIAL_POS_X, INITIAL_POS_Y, INITIAL_POS_Z)
+        model_state.pose.orientation = Quaternion(INITIAL_ORIENT_X, INITIAL_ORIENT_Y, INITIAL_ORIENT_Z, INITIAL_ORIENT_W)
+        self.reset_model_state_request = SetModelStateRequest(model_state=model_state)
+        self.reset_model_configuration_request = SetModelConfigurationRequest(
+            model_name=ROVER_MODEL_NAME, urdf_param_name=ROVER_URDF_PARAM_NAME,
+            joint_names=list(ROVER_JOINT_NAMES), joint_positions=[0] * len(ROVER_JOINT_NAMES))
         rospy.init_node('rl_coach', anonymous=True)
 
+        # Paused physics stepping
+        self.world_control = None
+        if PAUSE_PHYSICS_BETWEEN_STEPS:
+            self.world_control = WorldControl(PHYSICS_TICKS_PER_STEP)
+            if self.world_control.ticks_per_step < 1:
+                self.world_control.ticks_per_step = self.world_control.ticks_for(
+                    SLEEP_BETWEEN_ACTION_AND_REWARD_CALCULATION_TIME_IN_SECOND)
+            self.physics_ticks_per_sensor_retry = PHYSICS_TICKS_PER_SENSOR_RETRY or \
+                max(1, self.world_control.ticks_per_step // 4)
+
         # Subscribe to ROS topics and register callbacks
         rospy.Subscriber('/odom', Odometry, self.callback_pose)
         rospy.Subscriber('/scan', LaserScan, self.callback_scan)
         rospy.Subscriber('/robot_bumper', ContactsState, self.callback_collision)
-        rospy.Subscriber('/camera/image_raw', sensor_image, self.callback_image)
+        if self.observe_camera:
+            rospy.Subscriber('/camera/image_raw', sensor_image, self.callback_image)
 
 
     '''
     DO NOT EDIT - Function called by rl_coach to instruct the agent to take an action
     '''
     def step(self, action):
+        if self.pre_reset_thread:
+            raise RuntimeError("step() called while the finished episode is being reset, call reset() first")
+
         # initialize rewards, next_state, done
         self.reward = None
         self.done = False
@@ -145,36 +279,106 @@ class RoverTrainingGroundsEnv(gym.Env):
         steering = float(action[0])
         throttle = float(action[1])
         self.steps += 1
+        action_stamp = rospy.get_time()
         self.send_action(steering, throttle)
-        time.sleep(SLEEP_BETWEEN_ACTION_AND_REWARD_CALCULATION_TIME_IN_SECOND)
+        self.wait_for_action_to_apply(action_stamp)
 
-        self.call_reward_function(action)
+        try:
+            self.call_reward_function(action)
+        except Exception:
+            self.step_logger.dump("error")
+            raise
 
         info = {}  # additional data, not to be used for training
+        if self.world_control:
+            info['physics_ticks'] = self.world_control.last_ticks
+            info['requested_physics_ticks'] = self.world_control.last_requested_ticks
+            info['physics_retry_ticks'] = self.world_control.last_retry_ticks
+        if self.done:
+            # Outcome of the episode, the pre-reset leaves it in place until reset() is called
+            info['distance_to_checkpoint'] = self.current_distance_to_checkpoint
+            info['reached_checkpoint'] = self.reached_checkpoint
 
 
         #return dict(xy=np.array([self.next_state[0]]), observation=np.array([self.next_state[1]]), theta=np.array([self.next_state[2]]) ), self.reward, self.done, {}
 
-        return self.next_state, self.reward, self.done, info
+        next_state, reward, done = self.next_state, self.reward, self.done
+        if done and PRE_RESET:
+            # Reset the world while the agent works on the finished episode
+            self.start_pre_reset()
+
+        return next_state, reward, done, info
 
     '''
     DO NOT EDIT - Function called at the conclusion of each episode to reset episodic values
     '''
     def reset(self):
-        print('Total Episodic Reward=%.2f' % self.reward_in_episode,
-              'Total Episodic Steps=%.2f' % self.steps)
+        if self.pre_reset_thread:
+            # The reset was started in the background when the episode ended
+            self.finish_pre_reset()
+        else:
+            self.reset_episode()
+
+        return self.next_state
+
+
+    '''
+    Function to end the episode and put the rover back at the starting point, sets the initial observation
+    '''
+    def reset_episode(self):
+        self.reset_episode_values(self.reset_world())
+
+
+    '''
+    Function to report the finished episode and put the rover back at the starting point in the simulator. Leaves
+    the episodic values alone and returns the sequence of the last camera frame captured before the reset.
+    '''
+    def reset_world(self):
+        self.step_logger.log_event("episode_end", reward=self.reward_in_episode, steps=self.steps)
+        self.step_logger.dump("episode_end")
         self.send_reward_to_cloudwatch(self.reward_in_episode)
 
+        # Only use a LIDAR scan received after the reset
+        self.scan_processor.reset()
+        self.send_action(0, 0) # set the throttle to 0
+        return self.rover_reset_in_world()
+
+
+    '''
+    Function to reset the episodic values once the world is reset, sets the initial observation
+    '''
+    def reset_episode_values(self, image_seq):
         # Reset global episodic values
         self.reward = None
         self.done = False
         self.next_state = None
-        self.ranges= None
-        self.send_action(0, 0) # set the throttle to 0
-        self.rover_reset()
+        self.rover_reset(image_seq)
         self.call_reward_function([0, 0])
 
-        return self.next_state
+
+    '''
+    Function to start resetting the world in a background thread. The thread leaves the values step() returns
+    alone, reset() waits for it and then resets the episodic values.
+    '''
+    def start_pre_reset(self):
+        self.pre_reset_error = None
+        self.pre_reset_thread = threading.Thread(target=self.run_pre_reset, name="pre-reset")
+        self.pre_reset_thread.daemon = True
+        self.pre_reset_thread.start()
+
+    def run_pre_reset(self):
+        try:
+            self.pre_reset_image_seq = self.reset_world()
+        except Exception as err:
+            self.pre_reset_error = err
+
+    def finish_pre_reset(self):
+        self.pre_reset_thread.join()
+        self.pre_reset_thread = None
+        if self.pre_reset_error:
+            error, self.pre_reset_error = self.pre_reset_error, None
+            raise error
+        self.reset_episode_values(self.pre_reset_image_seq)
 
     '''
     DO NOT EDIT - Function called to send the agent's chosen action to the simulator (Gazebo)
@@ -185,77 +389,113 @@ class RoverTrainingGroundsEnv(gym.Env):
         speed.angular.z = steering
         self.ack_publisher.publish(speed)
 
+
+    '''
+    Function to give Gazebo time to apply an action before the reward is calculated
+    '''
+    def wait_for_action_to_apply(self, action_stamp):
+        if self.world_control:
+            # Sensor messages for the ticks that just ran may still be in flight
+            self.world_control.step()
+            self.wait_for_sensor_data(action_stamp)
+        elif self.step_sync_mode == STEP_SYNC_MODE_SENSOR:
+            self.wait_for_sensor_data(action_stamp)
+        else:
+            rospy.sleep(SLEEP_BETWEEN_ACTION_AND_REWARD_CALCULATION_TIME_IN_SECOND)
+
+
+    '''
+    Function to wait until the LIDAR, camera and odometry have published data newer than the given stamp
+    '''
+    def wait_for_sensor_data(self, stamp):
+        if self.world_control:
+            # With the physics paused no newer data comes in, the world is stepped further instead of waiting
+            fresh = self.world_control.step_until(
+                lambda: self.sensor_sync.wait_for_fresh_data(stamp, SENSOR_DATA_IN_FLIGHT_IN_SECOND),
+                self.world_control.ticks_for(STEP_SYNC_DEADLINE_IN_SECOND),
+                self.physics_ticks_per_sensor_retry)
+        else:
+            fresh = self.sensor_sync.wait_for_fresh_data(stamp, STEP_SYNC_DEADLINE_IN_SECOND)
+        if not fresh:
+            print("Warning! Timed out waiting for sensor data newer than the last action")
+
+    '''
+    Function to wait until every sensor published data stamped after the reset and the odometry reports
+    that the rover stopped moving
+    '''
+    def wait_for_rover_to_settle(self, reset_stamp):
+        # The deadline is in simulation time, so that a simulation slower than real time gets as many physics
+        # ticks to settle. Each wait is bounded by the simulation time left, as wall time.
+        deadline = reset_stamp + RESET_SETTLE_DEADLINE_IN_SECOND
+        stamp = reset_stamp
+        topics = None
+        now = rospy.get_time()
+        while now < deadline:
+            if not self.sensor_sync.wait_for_fresh_data(stamp, deadline - now, topics):
+                previous, now = now, rospy.get_time()
+                if now <= previous:
+                    print("Warning! The simulation time stopped while waiting for the rover to settle")
+                    return
+                continue
+            linear = self.linear_trajectory
+            angular = self.angular_trajectory
+            if (math.sqrt(linear.x ** 2 + linear.y ** 2 + linear.z ** 2) < RESET_SETTLE_SPEED and
+                    math.sqrt(angular.x ** 2 + angular.y ** 2 + angular.z ** 2) < RESET_SETTLE_SPEED):
+                return
+            # Check again on the next odometry message
+            stamp = self.sensor_sync.get_stamp(ODOM_TOPIC)
+            topics = (ODOM_TOPIC,)
+            now = rospy.get_time()
+        print("Warning! Timed out waiting for the rover to settle after the reset")
+
+
+    '''
+    Function to put the rover at the starting point in the world and let it settle, returns the sequence of the
+    last camera frame captured before the reset
+    '''
+    def rover_reset_in_world(self):
+        # Put the Rover at the initial position and reset all of its joints
+        reset_stamp = rospy.get_time()
+        self.gazebo_model_state_service(self.reset_model_state_request)
+        self.gazebo_model_configuration_service(self.reset_model_configuration_request)
+        image_seq = self.image_mailbox.seq
+
+        if self.world_control:
+            # Step the world to let the rover settle
+            self.world_control.step_for(SLEEP_AFTER_RESET_TIME_IN_SECOND)
+            self.wait_for_sensor_data(reset_stamp)
+        elif FAST_RESET:
+            self.wait_for_rover_to_settle(reset_stamp)
+        else:
+            rospy.sleep(SLEEP_AFTER_RESET_TIME_IN_SECOND)
+        return image_seq
+
+
     '''
     DO NOT EDIT - Function to reset the rover to the starting point in the world
     '''
-    def rover_reset(self):
+    def rover_reset(self, image_seq):
         
-        # Reset Rover-related Episodic variables
-        rospy.wait_for_service('gazebo/set_model_state')
-
         self.x = INITIAL_POS_X
         self.y = INITIAL_POS_Y
 
-        # Put the Rover at the initial position
-        model_state = ModelState()
-        model_state.pose.position.x = INITIAL_POS_X
-        model_state.pose.position.y = INITIAL_POS_Y
-        model_state.pose.position.z = INITIAL_POS_Z
-        model_state.pose.orientation.x = INITIAL_ORIENT_X
-        model_state.pose.orientation.y = INITIAL_ORIENT_Y
-        model_state.pose.orientation.z = INITIAL_ORIENT_Z
-        model_state.pose.orientation.w = INITIAL_ORIENT_W
-        model_state.twist.linear.x = 0
-        model_state.twist.linear.y = 0
-        model_state.twist.linear.z = 0
-        model_state.twist.angular.x = 0
-        model_state.twist.angular.y = 0
-        model_state.twist.angular.z = 0
-        model_state.model_name = 'rover'
-
-        # List of joints to reset (this is all of them)
-        joint_names_list = ["rocker_left_corner_lb",
-                            "rocker_right_corner_rb",
-                            "body_rocker_left",
-                            "body_rocker_right",
-                            "rocker_right_bogie_right",
-                            "rocker_left_bogie_left",
-                            "bogie_left_corner_lf",
-                            "bogie_right_corner_rf",
-                            "corner_lf_wheel_lf",
-                            "imu_wheel_lf_joint",
-                            "bogie_left_wheel_lm",
-                            "imu_wheel_lm_joint",
-                            "corner_lb_wheel_lb",
-                            "imu_wheel_lb_joint",
-                            "corner_rf_wheel_rf",
-                            "imu_wheel_rf_joint",
-                            "bogie_right_wheel_rm",
-                            "imu_wheel_rm_joint",
-                            "corner_rb_wheel_rb",
-                            "imu_wheel_rb_joint"]
-        # Angle to reset joints to
-        joint_positions_list = [0 for _ in range(len(joint_names_list))]
-
-        self.gazebo_model_state_service(model_state)
-        self.gazebo_model_configuration_service(model_name='rover', urdf_param_name='rover_description', joint_names=joint_names_list, joint_positions=joint_positions_list)
-
         self.last_collision_threshold = sys.maxsize
         self.last_position_x = self.x
         self.last_position_y = self.y
 
-        time.sleep(SLEEP_AFTER_RESET_TIME_IN_SECOND)
+        # Only use a frame captured after the reset for the start image
+        self.last_image_seq = image_seq
+        self.observation_pipeline.reset()
 
         self.distance_travelled = 0
         self.current_distance_to_checkpoint = INITIAL_DISTANCE_TO_CHECKPOINT
         self.steps = 0
         self.reward_in_episode = 0
         self.collision = False
+        self.reached_checkpoint = False
         self.closer_to_checkpoint = False
         self.power_supply_range = MAX_STEPS
         self.reached_midpoint = False
-        # First clear the queue so that we set the state to the start image
-        _ = self.image_queue.get(block=True, timeout=None)
         self.set_next_state()
 
     '''
@@ -263,17 +503,8 @@ class RoverTrainingGroundsEnv(gym.Env):
     '''
     def get_distance_to_object(self):
 
-        while not self.ranges:
-            time.sleep(SLEEP_WAITING_FOR_IMAGE_TIME_IN_SECOND)
-
-        size = len(self.ranges)
-        x = np.linspace(0, size - 1, 360)
-        xp = np.arange(size)
-        val = np.clip(np.interp(x, xp, self.ranges), 0, LIDAR_SCAN_MAX_DISTANCE)
-        val[np.isnan(val)] = LIDAR_SCAN_MAX_DISTANCE
-
-        # Find min distance
-        self.collision_threshold = np.amin(val)
+        # Wait for the first scan of the episode, the scans are processed in callback_scan
+        self.collision_threshold, self.sector_distances = self.scan_processor.wait_for_scan()
 
 
     '''
@@ -281,16 +512,12 @@ class RoverTrainingGroundsEnv(gym.Env):
     '''
     def set_next_state(self):
         try:
-            # Make sure the first image is the starting image
-            image_data = self.image_queue.get(block=True, timeout=None)
-        
-            # Read the image and resize to get the state
-            image = Image.frombytes('RGB', (image_data.width, image_data.height), image_data.data, 'raw', 'RGB', 0, 1)
-            image = image.resize((TRAINING_IMAGE_WIDTH,TRAINING_IMAGE_HEIGHT), PIL.Image.ANTIALIAS)
-            
-            # TODO - can we crop this image to get additional savings?
-           
-            self.next_state = np.array(image)
+            # Wait for a frame newer than the one used for the previous state
+            image_data = self.image_mailbox.wait_for_frame(self.last_image_seq)
+            self.last_image_seq = image_data.seq
+
+            # Crop, resize and convert the image to get the state
+            self.next_state = self.observation_pipeline(image_data.data, image_data.width, image_data.height)
         except Exception as err:
             print("Error!::set_next_state:: {}".format(err))
 
@@ -314,14 +541,14 @@ class RoverTrainingGroundsEnv(gym.Env):
         self.reward_in_episode += reward
 
     
-        print('Step:%.2f' % self.steps,
-              'Steering:%f' % action[0],
-              'R:%.2f' % reward,                                # Reward
-              'DTCP:%f' % self.current_distance_to_checkpoint,  # Distance to Check Point
-              'DT:%f' % self.distance_travelled,                # Distance Travelled
-              'CT:%.2f' % self.collision_threshold,             # Collision Threshold
-              'CTCP:%f' % self.closer_to_checkpoint,            # Is closer to checkpoint
-              'PSR: %f' % self.power_supply_range)              # Steps remaining in Episode
+        self.step_logger.log_step(self.steps,
+                                  action[0],
+                                  reward,
+                                  self.current_distance_to_checkpoint,
+                                  self.distance_travelled,
+                                  self.collision_threshold,
+                                  self.closer_to_checkpoint,
+                                  self.power_supply_range)
 
         self.reward = reward
         self.done = done
@@ -354,34 +581,35 @@ class RoverTrainingGroundsEnv(gym.Env):
             
             # Has LIDAR registered a hit
             if self.collision_threshold <= CRASH_DISTANCE:
-                print("Rover has sustained sideswipe damage")
+                self.step_logger.log_event("Rover has sustained sideswipe damage")
                 return 0, True # No reward
             
             # Have the gravity sensors registered too much G-force
             if self.collision:
-                print("Rover has collided with an object")
+                self.step_logger.log_event("Rover has collided with an object")
                 return 0, True # No reward
             
             # Has the rover reached the max steps
             if self.power_supply_range < 1:
-                print("Rover's power supply has been drained (MAX Steps reached")
+                self.step_logger.log_event("Rover's power supply has been drained (MAX Steps reached")
                 return 0, True # No reward
             
             # Has the Rover reached the Checkpoint
             if self.last_position_x >= CHECKPOINT_X and self.last_position_y >= CHECKPOINT_Y:
-                print("Congratulations! The rover has reached the checkpoint!")
+                self.step_logger.log_event("Congratulations! The rover has reached the checkpoint!")
+                self.reached_checkpoint = True  # <-- reported as the outcome of the episode, keep it when editing
                 multiplier = FINISHED_REWARD
                 reward = (base_reward * multiplier) / self.steps # <-- incentivize to reach checkpoint in fewest steps
                 return reward, True
             
             # If it has not reached the check point is it still on the map?
             if self.x < (STAGE_X_MIN - .45) or self.x > (STAGE_X_MAX + .45):
-                print("Rover has left the mission map!")
+                self.step_logger.log_event("Rover has left the mission map!")
                 return 0, True
                 
                 
             if self.y < (STAGE_Y_MIN - .45) or self.y > (STAGE_Y_MAX + .45):
-                print("Rover has left the mission map!")
+                self.step_logger.log_event("Rover has left the mission map!")
                 return 0, True
             
             
@@ -391,7 +619,7 @@ class RoverTrainingGroundsEnv(gym.Env):
                 # Determine if Rover already received one time reward for reaching the midpoint
                 if not self.reached_midpoint:  
                     self.reached_midpoint = True
-                    print("Congratulations! The rover has reached the midpoint!")
+                    self.step_logger.log_event("Congratulations! The rover has reached the midpoint!")
                     multiplier = MIDPOINT_REWARD 
                     reward = (base_reward * multiplier)/ self.steps # <-- incentivize to reach mid-point in fewest steps
                     return reward, False
@@ -442,15 +670,15 @@ class RoverTrainingGroundsEnv(gym.Env):
     DO NOT EDIT - Function to receive LIDAR data from a ROSTopic
     '''
     def callback_scan(self, data):
-        self.ranges = data.ranges
+        self.scan_processor.update(data.ranges)
+        self.sensor_sync.update(SCAN_TOPIC, data.header.stamp.to_sec())
 
 
     def callback_image(self, data):
         try:
-            #rint("Height: {}   Width: {}".format(data.height, data.width))
-            self.image_queue.put_nowait(data)
-        except queue.Full:
-            pass
+            stamp = data.header.stamp.to_sec()
+            self.image_mailbox.put(data.data, data.width, data.height, stamp)
+            self.sensor_sync.update(IMAGE_TOPIC, stamp)
         except Exception as ex:
            print("Error! {}".format(ex))
 
@@ -461,6 +689,7 @@ class RoverTrainingGroundsEnv(gym.Env):
         self.orientation = data.pose.pose.orientation
         self.linear_trajectory = data.twist.twist.linear
         self.angular_trajectory = data.twist.twist.angular
+        self.sensor_sync.update(ODOM_TOPIC, data.header.stamp.to_sec())
 
         new_position = data.pose.pose.position
 
@@ -507,31 +736,23 @@ class RoverTrainingGroundsEnv(gym.Env):
     DO NOT EDIT - Function to wrote episodic rewards to CloudWatch
     '''
     def send_reward_to_cloudwatch(self, reward):
-        try:
-            session = boto3.session.Session()
-            cloudwatch_client = session.client('cloudwatch', region_name=self.aws_region)
-            cloudwatch_client.put_metric_data(
-                MetricData=[
-                    {
-                        'MetricName': 'Episode_Reward',
-                        'Unit': 'None',
-                        'Value': reward
-                    },
-                    {
-                        'MetricName': 'Episode_Steps',
-                        'Unit': 'None',
-                        'Value': self.steps,
-                    },
-                    {
-                        'MetricName': 'DistanceToCheckpoint',
-                        'Unit': 'None',
-                        'Value': self.current_distance_to_checkpoint
-                    }
-                ],
-                Namespace='AWS_NASA_JPL_OSR_Challenge'
-            )
-        except Exception as err:
-            print("Error in the send_reward_to_cloudwatch function: {}".format(err))
+        self.metrics_publisher.put_metrics([
+            {
+                'MetricName': 'Episode_Reward',
+                'Unit': 'None',
+                'Value': reward
+            },
+            {
+                'MetricName': 'Episode_Steps',
+                'Unit': 'None',
+                'Value': self.steps,
+            },
+            {
+                'MetricName': 'DistanceToCheckpoint',
+                'Unit': 'None',
+                'Value': self.current_distance_to_checkpoint
+            }
+        ])
 
 '''
 DO NOT EDIT - Inheritance class to convert discrete actions to continuous actions
@@ -539,8 +760,8 @@ DO NOT EDIT - Inheritance class to convert discrete actions to continuous action
 
 
 class RoverTrainingGroundsDiscreteEnv(RoverTrainingGroundsEnv):
-    def __init__(self):
-        RoverTrainingGroundsEnv.__init__(self)
+    def __init__(self, **kwargs):
+        RoverTrainingGroundsEnv.__init__(self, **kwargs)
         print("New Training Grounds Gym environment created...")
         # actions -> straight, left, right
         self.action_space = spaces.Discrete(3)
@@ -561,4 +782,42 @@ class RoverTrainingGroundsDiscreteEnv(RoverTrainingGroundsEnv):
 
         continuous_action = [steering, throttle]
 
-        return super().step(continuous_action)
\ No newline at end of file
+        return super().step(continuous_action)
+
+
+'''
+Discrete action environment observing a compact vector instead of the camera: the minimum LIDAR distance
+of each sector, the distance and bearing to the checkpoint and the speeds reported by the odometry
+'''
+class RoverTrainingGroundsLidarDiscreteEnv(RoverTrainingGroundsDiscreteEnv):
+    observe_camera = False
+
+    def __init__(self, **kwargs):
+        self.yaw = 0                                                            # Heading of the Rover
+        self.forward_speed = 0                                                  # Linear velocity from odometry
+        self.turn_rate = 0                                                      # Angular velocity from odometry
+        RoverTrainingGroundsDiscreteEnv.__init__(self, **kwargs)
+        print("Observing LIDAR sectors instead of the camera...")
+
+        sectors = self.scan_processor.sectors
+        low = np.array([0] * sectors + [0, -math.pi, -np.inf, -np.inf], dtype=np.float32)
+        high = np.array([LIDAR_SCAN_MAX_DISTANCE] * sectors + [np.inf, math.pi, np.inf, np.inf], dtype=np.float32)
+        self.observation_space = spaces.Box(low=low, high=high, dtype=np.float32)
+        self.next_state_buffer = np.empty(sectors + 4, dtype=np.float32)
+
+    def set_next_state(self):
+        # Wait for the first scan of the episode, the scans are processed in callback_scan
+        _, sector_distances = self.scan_processor.wait_for_scan()
+        sectors = len(sector_distances)
+        self.next_state_buffer[:sectors] = sector_distances
+        self.next_state_buffer[sectors:] = (self.current_distance_to_checkpoint,
+                                            bearing_to(self.x, self.y, self.yaw, CHECKPOINT_X, CHECKPOINT_Y),
+                                            self.forward_speed,
+                                            self.turn_rate)
+        self.next_state = self.next_state_buffer.copy()
+
+    def callback_pose(self, data):
+        self.yaw = yaw_from_quaternion(data.pose.pose.orientation)
+        self.forward_speed = data.twist.twist.linear.x
+        self.turn_rate = data.twist.twist.angular.z
+        super().callback_pose(data)
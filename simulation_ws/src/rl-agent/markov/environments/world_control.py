@@ -0,0 +1,163 @@
+"""
+Control of the Gazebo world: paused physics stepping, where the physics only runs for a set number of ticks
+after every action, and persistent connections to the services the environments call every episode
+"""
+import rospy
+from std_srvs.srv import Empty
+from gazebo_msgs.srv import GetPhysicsProperties, GetWorldProperties
+
+PAUSE_PHYSICS_SERVICE = '/gazebo/pause_physics'
+UNPAUSE_PHYSICS_SERVICE = '/gazebo/unpause_physics'
+GET_PHYSICS_PROPERTIES_SERVICE = '/gazebo/get_physics_properties'
+GET_WORLD_PROPERTIES_SERVICE = '/gazebo/get_world_properties'
+
+class PersistentService(object):
+    """
+    Persistent ROS service proxy that keeps its connection open between calls. When the connection breaks,
+    e.g. because Gazebo restarted, the call waits for the service to come back, reconnects and is retried once.
+    """
+    def __init__(self, name, service_class):
+        """
+        :param name: Name of the service
+        :param service_class: Service definition, e.g. std_srvs.srv.Empty
+        """
+        self.name = name
+        self.service_class = service_class
+        self._proxy = None
+
+    def __call__(self, *args, **kwargs):
+        try:
+            return self._get_proxy()(*args, **kwargs)
+        except (rospy.ServiceException, rospy.exceptions.TransportException) as err:
+            print("Reconnecting to {} after error: {}".format(self.name, err))
+            self.close()
+            return self._get_proxy()(*args, **kwargs)
+
+    def close(self):
+        if self._proxy is not None:
+            self._proxy.close()
+            self._proxy = None
+
+    def _get_proxy(self):
+        if self._proxy is None:
+            rospy.wait_for_service(self.name)
+            self._proxy = rospy.ServiceProxy(self.name, self.service_class, persistent=True)
+        return self._proxy
+
+
+class WorldControl(object):
+    """
+    Keeps the physics paused between actions and runs it for about a fixed number of ticks per step.
+    gazebo_ros does not expose a "step N iterations" service, so a step unpauses the physics, sleeps for
+    ticks * time_step of simulation time and pauses it again. The physics keeps running while the sleep wakes up
+    on /clock and the pause request reaches Gazebo, so a step can advance the world by more ticks than requested,
+    and by a different number of ticks every time. The ticks actually advanced are measured from the simulation
+    time Gazebo reports before and after every step. The service proxies, the physics time step, the simulation
+    time and the sleep function can be injected to run this against mocked world-control services.
+    """
+    def __init__(self, ticks_per_step, pause_physics=None, unpause_physics=None, time_step=None,
+                 get_sim_time=None, sleep=rospy.sleep):
+        """
+        :param ticks_per_step: Number of physics ticks to run for every call to step()
+        :param pause_physics: Callable pausing the physics, defaults to the gazebo_ros service
+        :param unpause_physics: Callable unpausing the physics, defaults to the gazebo_ros service
+        :param time_step: Length of a physics tick in seconds, queried from Gazebo if not given
+        :param get_sim_time: Callable returning the simulation time of the world in seconds, defaults to the
+                             sim_time of the gazebo_ros world properties
+        :param sleep: Function sleeping for a duration of simulation time
+        """
+        self.pause_physics = pause_physics or PersistentService(PAUSE_PHYSICS_SERVICE, Empty)
+        self.unpause_physics = unpause_physics or PersistentService(UNPAUSE_PHYSICS_SERVICE, Empty)
+        if time_step is None:
+            rospy.wait_for_service(GET_PHYSICS_PROPERTIES_SERVICE)
+            get_physics_properties = rospy.ServiceProxy(GET_PHYSICS_PROPERTIES_SERVICE, GetPhysicsProperties)
+            time_step = get_physics_properties().time_step
+        if get_sim_time is None:
+            get_world_properties = PersistentService(GET_WORLD_PROPERTIES_SERVICE, GetWorldProperties)
+            get_sim_time = lambda: get_world_properties().sim_time
+        self.time_step = time_step
+        self.ticks_per_step = ticks_per_step
+        self.get_sim_time = get_sim_time
+        self.sleep = sleep
+        # Ticks requested and actually advanced by the last step and by all the steps, and the ticks the world was
+        # stepped further by after the last step, see step_until()
+        self.num_steps = 0
+        self.num_retry_steps = 0
+        self.last_requested_ticks = 0
+        self.last_ticks = 0
+        self.last_retry_ticks = 0
+        self.total_requested_ticks = 0
+        self.total_ticks = 0
+
+        # The world only moves when it is stepped
+        self.pause_physics()
+
+    def ticks_for(self, duration_in_second):
+        """
+        :return: Number of physics ticks (at least one) covering the given duration of simulation time
+        """
+        return max(1, int(round(duration_in_second / self.time_step)))
+
+    def step(self, ticks=None):
+        """
+        :param ticks: Number of physics ticks to run the world for, defaults to ticks_per_step
+        :return: Number of physics ticks the world actually advanced by
+        """
+        if ticks is None:
+            ticks = self.ticks_per_step
+        self.num_steps += 1
+        self.last_requested_ticks = ticks
+        self.last_ticks = self._run(ticks)
+        self.last_retry_ticks = 0
+        return self.last_ticks
+
+    def step_for(self, duration_in_second):
+        """
+        :return: Number of physics ticks the world actually advanced by
+        """
+        return self.step(self.ticks_for(duration_in_second))
+
+    def step_until(self, is_done, max_ticks, ticks=1):
+        """
+        Step the world further, a few ticks at a time, until is_done() returns True, e.g. until every sensor
+        published data newer than the action. No new data comes in while the physics is paused, so waiting for it
+        in wall time would only wait out the deadline when a step is shorter than the period of a sensor.
+        :param is_done: Callable returning True once the world does not need to run any further
+        :param max_ticks: Maximum number of ticks to request
+        :param ticks: Number of ticks to run between two calls to is_done
+        :return: True if is_done() returned True, False if it still returned False after max_ticks
+        """
+        requested_ticks = 0
+        while not is_done():
+            if requested_ticks >= max_ticks:
+                return False
+            requested_ticks += ticks
+            self.num_retry_steps += 1
+            self.last_retry_ticks += self._run(ticks)
+        return True
+
+    def _run(self, ticks):
+        """
+        Unpause the physics for ticks physics ticks of simulation time
+        :return: Number of physics ticks the world actually advanced by
+        """
+        start_time = self.get_sim_time()
+        self.unpause_physics()
+        try:
+            self.sleep(ticks * self.time_step)
+        finally:
+            self.pause_physics()
+        ticks_run = int(round((self.get_sim_time() - start_time) / self.time_step))
+        self.total_requested_ticks += ticks
+        self.total_ticks += ticks_run
+        return ticks_run
+
+    @property
+    def mean_overshoot(self):
+        """
+        :return: Average number of ticks per step the world advanced by beyond the ticks requested, including the
+                 ticks of step_until()
+        """
+        if not self.num_steps:
+            return 0.0
+        return float(self.total_ticks - self.total_requested_ticks) / self.num_steps
@@ -0,0 +1,244 @@
+"""
+Evaluation of the frozen policy spread over several environment instances running in separate processes, stopped
+as soon as the success rate or the mean reward is known precisely enough
+"""
+import json
+import math
+import multiprocessing
+import os
+import queue
+import time
+
+# EARLY STOP - evaluation stops once the half width of the confidence interval on the success rate, or on the mean
+# reward, is at most the target, after at least EVALUATION_MIN_TRIALS trials
+EVALUATION_CONFIDENCE = float(os.environ.get("EVALUATION_CONFIDENCE", 0.95))
+EVALUATION_SUCCESS_RATE_HALF_WIDTH = float(os.environ.get("EVALUATION_SUCCESS_RATE_HALF_WIDTH", 0.05))
+EVALUATION_REWARD_HALF_WIDTH = float(os.environ.get("EVALUATION_REWARD_HALF_WIDTH", 0))    # 0 to not stop on it
+EVALUATION_MIN_TRIALS = int(os.environ.get("EVALUATION_MIN_TRIALS", 10))
+# Comma separated ROS master URIs, one per simulation. The environment of the i-th worker talks to the i-th one.
+# Every worker needs a simulation of its own, workers sharing one would move the same rover.
+EVALUATION_ROS_MASTER_URIS = os.environ.get("EVALUATION_ROS_MASTER_URIS", "")
+
+# Two sided standard normal quantiles of the supported confidence levels
+Z_SCORES = {0.8: 1.2816, 0.9: 1.6449, 0.95: 1.96, 0.99: 2.5758}
+WORKER_STOP_TIMEOUT_IN_SECOND = 10
+# Evaluation stops once at least this many episodes failed, and more failed than completed
+MAX_FAILED_TRIALS = 10
+
+
+class EarlyStop(object):
+    """
+    Aggregates the outcome of the episodes and decides when the estimates are tight enough. The interval on the
+    success rate is the Wilson score interval, the interval on the mean reward the normal approximation.
+    """
+    def __init__(self, confidence=EVALUATION_CONFIDENCE, success_rate_half_width=EVALUATION_SUCCESS_RATE_HALF_WIDTH,
+                 reward_half_width=EVALUATION_REWARD_HALF_WIDTH, min_trials=EVALUATION_MIN_TRIALS):
+        """
+        :param confidence: Confidence level of the intervals, one of Z_SCORES
+        :param success_rate_half_width: Stop once the success rate is known within this, 0 to not stop on it
+        :param reward_half_width: Stop once the mean reward is known within this, 0 to not stop on it
+        :param min_trials: Never stop before this many trials
+        """
+        if confidence not in Z_SCORES:
+            raise ValueError("Unsupported confidence {}, expected one of {}".format(confidence, sorted(Z_SCORES)))
+        self.confidence = confidence
+        self.z = Z_SCORES[confidence]
+        self.success_rate_half_width = success_rate_half_width
+        self.reward_half_width = reward_half_width
+        self.min_trials = min_trials
+        self.episodes = []
+
+    def add(self, episode):
+        """
+        :param episode: Dict with the reward, steps, success and distance_to_checkpoint of an episode
+        """
+        self.episodes.append(episode)
+
+    def get_success_rate_interval(self):
+        """
+        :return: Tuple of the success rate and the half width of its confidence interval
+        """
+        n = len(self.episodes)
+        if not n:
+            return 0.5, 0.5
+        rate = sum(1 for episode in self.episodes if episode["success"]) / float(n)
+        z2 = self.z ** 2
+        center = (rate + z2 / (2 * n)) / (1 + z2 / n)
+        half_width = self.z * math.sqrt(rate * (1 - rate) / n + z2 / (4 * n ** 2)) / (1 + z2 / n)
+        return center, half_width
+
+    def get_reward_interval(self):
+        """
+        :return: Tuple of the mean reward and the half width of its confidence interval
+        """
+        n = len(self.episodes)
+        if n < 2:
+            return (self.episodes[0]["reward"] if n else 0.0), float("inf")
+        mean = sum(episode["reward"] for episode in self.episodes) / n
+        variance = sum((episode["reward"] - mean) ** 2 for episode in self.episodes) / (n - 1)
+        return mean, self.z * math.sqrt(variance / n)
+
+    def get_stop_reason(self):
+        """
+        :return: Why the evaluation can stop, None if it should go on
+        """
+        if len(self.episodes) < self.min_trials:
+            return None
+        if self.success_rate_half_width and self.get_success_rate_interval()[1] <= self.success_rate_half_width:
+            return "success_rate_converged"
+        if self.reward_half_width and self.get_reward_interval()[1] <= self.reward_half_width:
+            return "reward_converged"
+        return None
+
+    def get_summary(self):
+        success_rate, success_rate_half_width = self.get_success_rate_interval()
+        mean_reward, reward_half_width = self.get_reward_interval()
+        n = max(len(self.episodes), 1)
+        return {"trials": len(self.episodes),
+                "confidence": self.confidence,
+                "success_rate": sum(1 for episode in self.episodes if episode["success"]) / float(n),
+                "success_rate_interval": [success_rate - success_rate_half_width,
+                                          success_rate + success_rate_half_width],
+                "mean_reward": mean_reward,
+                "mean_reward_interval": [mean_reward - reward_half_width, mean_reward + reward_half_width]
+                if math.isfinite(reward_half_width) else None,
+                "mean_steps": sum(episode["steps"] for episode in self.episodes) / float(n),
+                "mean_distance_to_checkpoint": sum(episode["distance_to_checkpoint"] or 0
+                                                   for episode in self.episodes) / float(n),
+                "episodes": self.episodes}
+
+
+def run_evaluation(level, num_workers, max_trials, summary_filename, model_path=None, output_head=None,
+                   inference_socket=None, early_stop=None):
+    """
+    Run episodes on num_workers environments in separate processes until early_stop says the estimates are tight
+    enough or max_trials episodes ran, then write the summary as JSON
+    :param level: Gym id of the environment
+    :param num_workers: Number of environment processes
+    :param max_trials: Maximum number of episodes
+    :param summary_filename: File the summary is written to
+    :param model_path: Frozen graph each worker loads, unless inference_socket is set
+    :param output_head: Name of the output node of the frozen graph giving the action probabilities
+    :param inference_socket: Unix socket of the inference server the workers ask the actions to
+    :param early_stop: EarlyStop deciding when to stop, defaults to the EVALUATION_* settings
+    :return: The summary
+    """
+    early_stop = early_stop or EarlyStop()
+    ros_master_uris = []
+    for uri in EVALUATION_ROS_MASTER_URIS.split(","):
+        if uri.strip() and uri.strip() not in ros_master_uris:
+            ros_master_uris.append(uri.strip())
+    if num_workers > 1 and len(ros_master_uris) < num_workers:
+        raise ValueError("{} evaluation workers need as many distinct simulations, EVALUATION_ROS_MASTER_URIS lists "
+                         "{}".format(num_workers, len(ros_master_uris)))
+    context = multiprocessing.get_context("spawn")
+    trials = context.Queue()
+    results = context.Queue()
+    workers = []
+    for worker_id in range(num_workers):
+        ros_master_uri = ros_master_uris[worker_id] if ros_master_uris else None
+        worker = context.Process(target=_run_worker, name="evaluation-worker-%s" % worker_id,
+                                 args=(worker_id, level, model_path, output_head, inference_socket, ros_master_uri,
+                                       trials, results))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    start_time = time.time()
+    # Every worker always has one trial to run, so that no environment waits for the parent
+    num_started = min(num_workers, max_trials)
+    for _ in range(num_started):
+        trials.put(True)
+    stop_reason = None
+    num_failed = 0
+    try:
+        while stop_reason is None:
+            try:
+                result = results.get(timeout=WORKER_STOP_TIMEOUT_IN_SECOND)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    stop_reason = "workers_exited"
+                continue
+            if "error" in result:
+                print("Evaluation worker %s failed: %s" % (result["worker"], result["error"]))
+                num_failed += 1
+                if num_failed >= max(MAX_FAILED_TRIALS, len(early_stop.episodes)):
+                    stop_reason = "too_many_failures"
+                elif "trial" in result:
+                    # Run the failed trial again
+                    trials.put(True)
+                continue
+            early_stop.add(result)
+            print("Trial %s on worker %s: reward %.2f in %s steps, success %s" %
+                  (len(early_stop.episodes), result["worker"], result["reward"], result["steps"], result["success"]))
+            stop_reason = early_stop.get_stop_reason()
+            if stop_reason is None:
+                if num_started < max_trials:
+                    trials.put(True)
+                    num_started += 1
+                elif len(early_stop.episodes) >= max_trials:
+                    stop_reason = "trial_budget"
+    finally:
+        # The episodes still running are dropped, they would not change the decision
+        for _ in workers:
+            trials.put(False)
+        for worker in workers:
+            worker.join(WORKER_STOP_TIMEOUT_IN_SECOND)
+            if worker.is_alive():
+                worker.terminate()
+
+    summary = early_stop.get_summary()
+    summary.update({"stop_reason": stop_reason, "workers": num_workers,
+                    "elapsed_time_in_second": time.time() - start_time})
+    with open(summary_filename, 'w') as f:
+        json.dump(summary, f, indent=2)
+    print("Evaluation stopped (%s) after %s trials in %.0f seconds: success rate %.3f %s, mean reward %.2f %s, "
+          "summary in %s" %
+          (stop_reason, summary["trials"], summary["elapsed_time_in_second"], summary["success_rate"],
+           _format_interval(summary["success_rate_interval"]), summary["mean_reward"],
+           _format_interval(summary["mean_reward_interval"]), summary_filename))
+    return summary
+
+
+def _format_interval(interval):
+    return "[%.3f, %.3f]" % tuple(interval) if interval else "[unknown]"
+
+
+def _run_worker(worker_id, level, model_path, output_head, inference_socket, ros_master_uri, trials, results):
+    """
+    Run one episode per trial received until told to stop
+    """
+    try:
+        if ros_master_uri:
+            os.environ["ROS_MASTER_URI"] = ros_master_uri
+        # Imported in the worker, every worker loads its own environment and policy. model_evaluation, which the
+        # spawned worker imports again as its main module, keeps these imports out of module level.
+        import gym
+        import markov.environments
+        from markov.frozen_policy import FrozenPolicy
+        from markov.inference_server import InferenceClient
+        policy = InferenceClient(inference_socket) if inference_socket else \
+            FrozenPolicy(model_path, output_name=output_head)
+        env = gym.make(level)
+    except Exception as e:
+        results.put({"worker": worker_id, "error": repr(e)})
+        return
+
+    while trials.get():
+        try:
+            observation = env.reset()
+            done = False
+            total_reward = 0
+            steps = 0
+            info = {}
+            while not done:
+                observation, reward, done, info = env.step(policy.act(observation))
+                total_reward += reward
+                steps += 1
+            results.put({"worker": worker_id,
+                         "reward": total_reward,
+                         "steps": steps,
+                         "success": bool(info.get("reached_checkpoint", False)),
+                         "distance_to_checkpoint": info.get("distance_to_checkpoint")})
+        except Exception as e:
+            results.put({"worker": worker_id, "trial": True, "error": repr(e)})
@@ -0,0 +1,107 @@
+"""
+Greedy evaluation of the frozen policy graph (model.pb) without building the rl_coach graph
+"""
+import resource
+import time
+import numpy as np
+import tensorflow as tf
+from markov.graph_export import PPO_POLICY_OUTPUT_HEAD
+
+
+class FrozenPolicy(object):
+    """
+    Runs a frozen policy graph in a session of its own, on CPU. The observation is copied into a preallocated
+    batch of one and fed through a callable made once, so a step only runs the graph.
+    """
+    def __init__(self, model_path, output_name=PPO_POLICY_OUTPUT_HEAD, input_name=None, num_threads=1):
+        """
+        :param model_path: Path of the frozen graph
+        :param output_name: Name of the output node giving the action probabilities
+        :param input_name: Name of the observation placeholder, defaults to the only placeholder of the graph
+        :param num_threads: Number of threads TensorFlow runs the graph with
+        """
+        graph_def = tf.GraphDef()
+        with open(model_path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        if input_name is None:
+            input_names = [node.name for node in graph_def.node if node.op == "Placeholder"]
+            if len(input_names) != 1:
+                raise ValueError("Cannot tell the observation placeholder among {}".format(input_names))
+            input_name = input_names[0]
+
+        self.input_name = input_name
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        input_tensor = self.graph.get_tensor_by_name(input_name + ":0")
+        output_tensor = self.graph.get_tensor_by_name(output_name + ":0")
+        self.session = tf.Session(graph=self.graph,
+                                  config=tf.ConfigProto(device_count={"GPU": 0},
+                                                        intra_op_parallelism_threads=num_threads,
+                                                        inter_op_parallelism_threads=num_threads))
+        self._input = np.zeros([1] + input_tensor.shape.as_list()[1:], dtype=input_tensor.dtype.as_numpy_dtype)
+        self._run = self.session.make_callable(output_tensor, feed_list=[input_tensor])
+
+    @property
+    def observation_shape(self):
+        return self._input.shape[1:]
+
+    @property
+    def observation_dtype(self):
+        return self._input.dtype
+
+    def run_batch(self, observations):
+        """
+        :param observations: Observations stacked along the first axis
+        :return: Output of the policy for every observation
+        """
+        return self._run(observations)
+
+    def action_probabilities(self, observation):
+        """
+        :return: Output of the policy for a single observation
+        """
+        self._input[0] = observation
+        return self._run(self._input)[0]
+
+    def act(self, observation):
+        """
+        :return: The greedy action for the observation
+        """
+        return int(np.argmax(self.action_probabilities(observation)))
+
+    def close(self):
+        self.session.close()
+
+
+def run_episodes(env, policy, number_of_trials):
+    """
+    Run greedy episodes of the policy in the environment
+    :return: List of dicts with the reward, the number of steps and the inference latencies in seconds of every
+             episode
+    """
+    episodes = []
+    for trial in range(number_of_trials):
+        observation = env.reset()
+        done = False
+        total_reward = 0
+        latencies = []
+        while not done:
+            start_time = time.time()
+            action = policy.act(observation)
+            latencies.append(time.time() - start_time)
+            observation, reward, done, info = env.step(action)
+            total_reward += reward
+        latencies_in_ms = np.array(latencies) * 1000
+        print("Episode %s: reward %.2f in %s steps, inference %.3f ms per step (p99 %.3f ms)" %
+              (trial + 1, total_reward, len(latencies), np.percentile(latencies_in_ms, 50),
+               np.percentile(latencies_in_ms, 99)))
+        episodes.append({"reward": total_reward, "steps": len(latencies), "latencies": latencies})
+    return episodes
+
+
+def get_max_rss_in_mb():
+    """
+    :return: Peak resident set size of the process in MB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
@@ -0,0 +1,324 @@
+"""
+Export of the policy as a frozen graph (model.pb) off the training thread, from a snapshot of the variables
+"""
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import tensorflow as tf
+
+FROZEN_GRAPH_FILENAME = "model.pb"
+
+# EXPORT - the frozen graph is exported every FROZEN_GRAPH_EXPORT_EVERY saves of a checkpoint. The output heads are
+# taken from the online networks of the agents, FROZEN_GRAPH_OUTPUT_HEADS (comma separated node names) overrides them.
+FROZEN_GRAPH_EXPORT_EVERY = int(os.environ.get("FROZEN_GRAPH_EXPORT_EVERY", 1))
+FROZEN_GRAPH_OUTPUT_HEADS = os.environ.get("FROZEN_GRAPH_OUTPUT_HEADS")
+# Comma separated reduced size variants written next to model.pb after each export (folded, fp16, int8), see
+# graph_variants. None by default since building and validating them takes a few seconds of CPU.
+FROZEN_GRAPH_VARIANTS = os.environ.get("FROZEN_GRAPH_VARIANTS", "")
+# Batch of captured observations the variants are validated on, defaults to validation_observations.npz next to
+# model.pb, see graph_variants.capture_validation_observations
+FROZEN_GRAPH_VALIDATION_OBSERVATIONS = os.environ.get("FROZEN_GRAPH_VALIDATION_OBSERVATIONS")
+# Output head of the PPO presets, used if the output heads cannot be found on the networks
+PPO_POLICY_OUTPUT_HEAD = 'main_level/agent/main/online/network_1/ppo_head_0/policy'
+
+VARIABLE_OPS = ("Variable", "VariableV2", "VarHandleOp")
+# Same epsilon as the normalization of rl_coach's running observation stats
+NORMALIZATION_EPSILON = 1e-15
+
+
+def get_frozen_graph_name(checkpoint_name, filename):
+    """
+    :param checkpoint_name: Name of the checkpoint the graph was exported from, e.g. 12_Step-3456.ckpt
+    :param filename: Name of a file written by the export, e.g. model.pb
+    :return: Name the file is published under in the data store, e.g. 12_Step-3456.ckpt.model.pb, which the
+             retention of old checkpoints covers
+    """
+    return "{}.{}".format(checkpoint_name, filename)
+
+
+def get_output_heads(graph_manager):
+    """
+    :return: Names of the output nodes of the online networks of all the agents of the graph manager
+    """
+    if FROZEN_GRAPH_OUTPUT_HEADS:
+        return [name.strip() for name in FROZEN_GRAPH_OUTPUT_HEADS.split(",") if name.strip()]
+    output_heads = []
+    try:
+        for level_manager in graph_manager.level_managers:
+            for agent in level_manager.agents.values():
+                for network in agent.networks.values():
+                    for output in network.online_network.outputs:
+                        if output.op.name not in output_heads:
+                            output_heads.append(output.op.name)
+    except AttributeError as e:
+        print("Cannot find the output heads of the networks, using the PPO policy head", e)
+    return output_heads or [PPO_POLICY_OUTPUT_HEAD]
+
+
+def get_input_normalization(graph_manager):
+    """
+    The running mean and standard deviation of an ObservationNormalizationFilter live in the input filter of the
+    agent, not in the TF graph. They are read here so that the normalization can be folded into the frozen graph.
+    :return: Dict mapping the name of every normalized observation to the mean, std, clip_min and clip_max of its
+             normalization, copied so that later updates of the filter do not change them
+    """
+    normalization = {}
+    try:
+        for level_manager in graph_manager.level_managers:
+            for agent in level_manager.agents.values():
+                for input_filter in (agent.input_filter, agent.pre_network_filter):
+                    for observation_name, filters in input_filter.observation_filters.items():
+                        stats = [getattr(observation_filter, "running_observation_stats", None)
+                                 for observation_filter in filters.values()]
+                        if not any(stats):
+                            continue
+                        if len(filters) > 1 or observation_name in normalization:
+                            print("Cannot fold the filters of observation %s into the frozen graph, it expects "
+                                  "filtered observations" % observation_name)
+                            continue
+                        clip_min, clip_max = stats[0].clip_values
+                        normalization[observation_name] = {"mean": np.array(stats[0].mean, dtype=np.float32),
+                                                           "std": np.array(stats[0].std, dtype=np.float32),
+                                                           "clip_min": clip_min,
+                                                           "clip_max": clip_max}
+    except AttributeError as e:
+        print("Cannot find the input filters of the agents, the frozen graph expects filtered observations", e)
+    return normalization
+
+
+def fold_input_normalization(graph_def, normalization):
+    """
+    :param graph_def: Frozen policy graph
+    :param normalization: Normalization of the observations, see get_input_normalization
+    :return: Copy of the graph where the placeholder of every normalized observation is followed by
+             clip((observation - mean) / (std + epsilon), clip_min, clip_max). The placeholders keep their names, so
+             the graph is fed the raw observations of the environment.
+    """
+    if not normalization:
+        return graph_def
+    placeholders = [node.name for node in graph_def.node if node.op == "Placeholder"]
+    folded = tf.GraphDef()
+    folded.versions.CopyFrom(graph_def.versions)
+    folded.library.CopyFrom(graph_def.library)
+    normalized_inputs = {}
+    for name in placeholders:
+        # The input embedders name their placeholder after the observation
+        observation_name = name.split("/")[-1]
+        if observation_name not in normalization and len(placeholders) == 1 and len(normalization) == 1:
+            observation_name = next(iter(normalization))
+        if observation_name in normalization:
+            normalized_inputs[name] = _add_normalization_nodes(folded, name, normalization[observation_name])
+    for node in graph_def.node:
+        copy = folded.node.add()
+        copy.CopyFrom(node)
+        for index, input_name in enumerate(copy.input):
+            # Control inputs (^name) only order the nodes and keep pointing at the placeholder
+            source = input_name[:-2] if input_name.endswith(":0") else input_name
+            if source in normalized_inputs:
+                copy.input[index] = normalized_inputs[source]
+    return folded
+
+
+def _add_normalization_nodes(graph_def, input_name, normalization):
+    """
+    :return: Name of the node giving the normalized input
+    """
+    prefix = input_name + "_normalization/"
+
+    def add_node(name, op, inputs=(), value=None):
+        node = graph_def.node.add()
+        node.name = prefix + name
+        node.op = op
+        node.input.extend(inputs)
+        if value is None:
+            node.attr["T"].type = tf.float32.as_datatype_enum
+        else:
+            node.attr["dtype"].type = tf.float32.as_datatype_enum
+            node.attr["value"].tensor.CopyFrom(tf.make_tensor_proto(np.asarray(value, dtype=np.float32)))
+        return node.name
+
+    mean = add_node("mean", "Const", value=normalization["mean"])
+    std = add_node("std", "Const", value=normalization["std"] + NORMALIZATION_EPSILON)
+    clip_min = add_node("clip_min", "Const", value=normalization["clip_min"])
+    clip_max = add_node("clip_max", "Const", value=normalization["clip_max"])
+    centered = add_node("sub", "Sub", (input_name, mean))
+    scaled = add_node("truediv", "RealDiv", (centered, std))
+    clipped = add_node("maximum", "Maximum", (scaled, clip_min))
+    return add_node("minimum", "Minimum", (clipped, clip_max))
+
+
+class FrozenGraphExporter(object):
+    """
+    Exports the frozen graph every export_every calls to export(). The training thread only fetches the values of
+    the variables the output heads depend on, the conversion of the graph to constants and the write run on a
+    background thread. An export that is due while the previous one is still running is skipped.
+    The background thread writes to a staging directory next to local_path. The files are only moved into
+    local_path by wait() once they are complete, so they never change while the data store lists, hashes and
+    uploads the checkpoint directory. The data store starts the export before uploading the checkpoint files and
+    waits for it before writing the pointer, so a save publishes the graph of the checkpoint it saves.
+    The statistics of the observation normalization filters are snapshotted with the variables and folded into the
+    graph, see fold_input_normalization.
+    """
+    def __init__(self, graph_manager, local_path, export_every=FROZEN_GRAPH_EXPORT_EVERY, output_heads=None,
+                 variants=None):
+        """
+        :param graph_manager: Graph manager holding the session of the agents
+        :param local_path: Directory model.pb is written to
+        :param export_every: Export every n-th call to export(), 0 to never export
+        :param output_heads: Names of the output nodes, defaults to the outputs of the agents' online networks
+        :param variants: Reduced size variants to write next to model.pb, defaults to FROZEN_GRAPH_VARIANTS
+        """
+        self.graph_manager = graph_manager
+        self.local_path = local_path
+        self.export_every = export_every
+        self.output_heads = output_heads or get_output_heads(graph_manager)
+        if variants is None:
+            variants = [variant.strip() for variant in FROZEN_GRAPH_VARIANTS.split(",") if variant.strip()]
+        self.variants = variants
+        self.num_exports = 0
+        self.num_skipped = 0
+        self.last_snapshot_time_in_second = 0
+        self.last_export_time_in_second = 0
+        self._count = 0
+        self._graph_def = None
+        self._variable_names = None
+        self.last_export = None
+        self._future = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._staging_dir = None
+        self._rejected_variants = []
+
+    @property
+    def filenames(self):
+        """
+        :return: Names of all the files an export may write to local_path
+        """
+        filenames = [FROZEN_GRAPH_FILENAME]
+        if self.variants:
+            # Imported here so that the graph transforms are only loaded when variants are exported
+            from markov.graph_variants import VARIANTS_REPORT_FILENAME, get_variant_filename
+            filenames += [get_variant_filename(variant) for variant in self.variants] + [VARIANTS_REPORT_FILENAME]
+        return filenames
+
+    def export(self, checkpoint_number=None):
+        """
+        Snapshot the variables and start exporting them if an export is due
+        :param checkpoint_number: Number of the checkpoint the variables were saved to, recorded with the export
+        :return: True if an export was started
+        """
+        self._count += 1
+        if not self.export_every or self._count % self.export_every != 0:
+            return False
+        if self._future and not self._future.done():
+            self.num_skipped += 1
+            print("Skipping the frozen graph export, the previous export is still running")
+            return False
+        if self._staging_dir is None:
+            if not os.path.exists(self.local_path):
+                os.makedirs(self.local_path)
+            # Outside local_path, so that the data store never lists the files being written
+            self._staging_dir = tempfile.mkdtemp(prefix=".frozen-graph-staging-",
+                                                 dir=os.path.dirname(os.path.abspath(self.local_path)))
+
+        start_time = time.time()
+        if self._graph_def is None:
+            # The inference graph does not change during training, only its variables do
+            self._graph_def = tf.graph_util.extract_sub_graph(self.graph_manager.sess.graph.as_graph_def(),
+                                                              self.output_heads)
+            # Same names convert_variables_to_constants fetches, resource variables are read through their ReadVariableOp
+            self._variable_names = [node.name + ("/Read/ReadVariableOp:0" if node.op == "VarHandleOp" else ":0")
+                                    for node in self._graph_def.node if node.op in VARIABLE_OPS]
+        values = self.graph_manager.sess.run(self._variable_names)
+        normalization = get_input_normalization(self.graph_manager)
+        self.last_snapshot_time_in_second = time.time() - start_time
+        self._future = self._executor.submit(self._write, dict(zip(self._variable_names, values)), normalization,
+                                             checkpoint_number)
+        return True
+
+    def wait(self):
+        """
+        Block until the export started by the last call to export(), if any, is written, then move its files into
+        local_path
+        :return: The last export moved into local_path, a dict with the number of the checkpoint it was exported from
+                 and the names of its files, None if no export succeeded yet
+        """
+        if self._future is None:
+            return self.last_export
+        future, self._future = self._future, None
+        export = future.result()
+        if export is None:
+            # The export failed, the files of the previous export stay in place
+            for filename in os.listdir(self._staging_dir):
+                os.remove(os.path.join(self._staging_dir, filename))
+            return self.last_export
+        export["files"] = sorted(os.listdir(self._staging_dir))
+        for filename in export["files"]:
+            os.replace(os.path.join(self._staging_dir, filename), os.path.join(self.local_path, filename))
+        # Variants that failed their validation are not served from a previous export either
+        for filename in self._rejected_variants:
+            if os.path.isfile(os.path.join(self.local_path, filename)):
+                os.remove(os.path.join(self.local_path, filename))
+        self._rejected_variants = []
+        self.last_export = export
+        return export
+
+    def _write(self, snapshot, normalization, checkpoint_number):
+        """
+        Convert the snapshot to constants and write the graph to the staging directory
+        :return: Dict with the number of the checkpoint exported, None if the export failed
+        """
+        try:
+            start_time = time.time()
+            frozen = tf.graph_util.convert_variables_to_constants(_SnapshotSession(snapshot), self._graph_def,
+                                                                  self.output_heads)
+            frozen = fold_input_normalization(frozen, normalization)
+            write_graph(frozen, self._staging_dir, FROZEN_GRAPH_FILENAME)
+            self.last_export_time_in_second = time.time() - start_time
+            self.num_exports += 1
+            print("Saved TF frozen graph in %.2f seconds (%.3f seconds on the training thread)" %
+                  (self.last_export_time_in_second, self.last_snapshot_time_in_second))
+        except Exception as e:
+            print("Got exception while exporting the frozen graph", e)
+            return None
+        if self.variants:
+            try:
+                # Imported here so that the graph transforms are only loaded when variants are exported
+                from markov.graph_variants import VALIDATION_OBSERVATIONS_FILENAME, export_variants
+                report = export_variants(frozen, self._staging_dir, self.output_heads, variants=self.variants,
+                                         observations_filename=FROZEN_GRAPH_VALIDATION_OBSERVATIONS or
+                                         os.path.join(self.local_path, VALIDATION_OBSERVATIONS_FILENAME))
+                self._rejected_variants = [filename for filename, entry in report["graphs"].items()
+                                           if not entry["written"]]
+            except Exception as e:
+                print("Got exception while exporting the frozen graph variants", e)
+        return {"checkpoint_number": checkpoint_number}
+
+
+def write_graph(graph_def, local_path, filename):
+    """
+    Write a binary graph, replacing the file atomically. The file is written next to local_path first, so that
+    the data store never publishes a partial file.
+    """
+    if not os.path.exists(local_path):
+        os.makedirs(local_path)
+    temp_dir = tempfile.mkdtemp(prefix=".frozen-graph-", dir=os.path.dirname(os.path.abspath(local_path)))
+    try:
+        tf.train.write_graph(graph_def, temp_dir, filename, as_text=False)
+        os.replace(os.path.join(temp_dir, filename), os.path.join(local_path, filename))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+class _SnapshotSession(object):
+    """
+    Stands in for the session in convert_variables_to_constants, returning the values of the variables at the
+    time of the snapshot instead of reading them from the live session
+    """
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def run(self, fetches):
+        return [self.snapshot[fetch] for fetch in fetches]
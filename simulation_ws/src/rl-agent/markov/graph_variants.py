@@ -0,0 +1,330 @@
+"""
+Reduced size variants of the frozen policy graph for CPU inference, validated against the float32 policy
+"""
+import argparse
+import json
+import os
+import time
+import numpy as np
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+from markov.graph_export import FROZEN_GRAPH_FILENAME, write_graph
+
+VARIANT_FOLDED = "folded"    # Unused nodes stripped and constant subgraphs folded
+VARIANT_FP16 = "fp16"        # Folded, with the weights stored as float16 and cast back to float32 when loaded
+VARIANT_INT8 = "int8"        # Folded, with the weights quantized to 8 bits and dequantized when loaded
+VARIANTS = (VARIANT_FOLDED, VARIANT_FP16, VARIANT_INT8)
+
+FOLD_TRANSFORMS = ["strip_unused_nodes",
+                   "remove_nodes(op=Identity, op=CheckNumerics)",
+                   "fold_constants(ignore_errors=true)",
+                   "fold_batch_norms",
+                   "fold_old_batch_norms",
+                   "sort_by_execution_order"]
+# Smaller weights, e.g. biases, are kept in float32
+MINIMUM_WEIGHT_SIZE = 1024
+INT8_TRANSFORMS = ["quantize_weights(minimum_size=%d)" % MINIMUM_WEIGHT_SIZE]
+
+VARIANTS_REPORT_FILENAME = "model_variants.json"
+# VALIDATION - the variants are validated on a batch of real observations captured from the environment with
+# capture_validation_observations (python -m markov.graph_variants --capture-level <gym id>). Until one is stored, a
+# batch drawn uniformly in [0, SYNTHETIC_OBSERVATION_HIGH), the range of the camera pixels, is used instead, never
+# stored, and the report says the validation is synthetic. Agreement on such noise says little about the fidelity of
+# the policy.
+VALIDATION_OBSERVATIONS_FILENAME = "validation_observations.npz"
+VALIDATION_BATCH_SIZE = 64
+SYNTHETIC_OBSERVATION_HIGH = 255
+# Observations are sampled uniformly among the first CAPTURE_STEPS steps of the greedy episodes
+CAPTURE_STEPS = 10 * VALIDATION_BATCH_SIZE
+# Variants picking the same action as the float32 policy on less than this fraction of the batch are not written
+FROZEN_GRAPH_VARIANT_MIN_AGREEMENT = float(os.environ.get("FROZEN_GRAPH_VARIANT_MIN_AGREEMENT", 0.99))
+NUM_LATENCY_RUNS = 100
+
+
+def get_variant_filename(variant):
+    """
+    :return: Name of the file the variant is written to, e.g. model_int8.pb
+    """
+    name, extension = os.path.splitext(FROZEN_GRAPH_FILENAME)
+    return "{}_{}{}".format(name, variant, extension)
+
+
+def get_input_names(graph_def):
+    """
+    :return: Names of the placeholders of the graph
+    """
+    return [node.name for node in graph_def.node if node.op == "Placeholder"]
+
+
+def fold_graph(graph_def, input_names, output_names):
+    return TransformGraph(graph_def, input_names, output_names, FOLD_TRANSFORMS)
+
+
+def quantize_weights_to_int8(graph_def, input_names, output_names):
+    return TransformGraph(graph_def, input_names, output_names, INT8_TRANSFORMS)
+
+
+def convert_weights_to_fp16(graph_def, minimum_size=MINIMUM_WEIGHT_SIZE):
+    """
+    :return: Copy of the graph where every float32 constant of at least minimum_size values is stored as float16,
+             followed by a Cast to float32 that takes the name of the constant
+    """
+    converted = tf.GraphDef()
+    converted.versions.CopyFrom(graph_def.versions)
+    converted.library.CopyFrom(graph_def.library)
+    for node in graph_def.node:
+        if node.op == "Const" and node.attr["dtype"].type == tf.float32.as_datatype_enum:
+            value = tf.make_ndarray(node.attr["value"].tensor)
+            if value.size >= minimum_size:
+                weights = converted.node.add()
+                weights.op = "Const"
+                weights.name = node.name + "_fp16"
+                weights.device = node.device
+                weights.attr["dtype"].type = tf.float16.as_datatype_enum
+                weights.attr["value"].tensor.CopyFrom(tf.make_tensor_proto(value.astype(np.float16)))
+                cast = converted.node.add()
+                cast.op = "Cast"
+                cast.name = node.name
+                cast.device = node.device
+                cast.input.append(weights.name)
+                cast.attr["SrcT"].type = tf.float16.as_datatype_enum
+                cast.attr["DstT"].type = tf.float32.as_datatype_enum
+                continue
+        converted.node.add().CopyFrom(node)
+    return converted
+
+
+def build_variants(graph_def, output_names, variants=VARIANTS):
+    """
+    :param graph_def: Frozen float32 policy graph
+    :param output_names: Names of the output nodes
+    :param variants: Variants to build
+    :return: Dict mapping the name of every variant to its graph
+    """
+    input_names = get_input_names(graph_def)
+    folded = fold_graph(graph_def, input_names, output_names)
+    graphs = {}
+    for variant in variants:
+        if variant == VARIANT_FOLDED:
+            graphs[variant] = folded
+        elif variant == VARIANT_FP16:
+            graphs[variant] = convert_weights_to_fp16(folded)
+        elif variant == VARIANT_INT8:
+            graphs[variant] = quantize_weights_to_int8(folded, input_names, output_names)
+        else:
+            raise ValueError("Unsupported graph variant: {}".format(variant))
+    return graphs
+
+
+def capture_validation_observations(env, policy, input_name, filename, batch_size=VALIDATION_BATCH_SIZE,
+                                    num_steps=CAPTURE_STEPS):
+    """
+    Run greedy episodes of the float32 policy and store a batch of the observations they went through, so that the
+    variants are validated on the states the policy actually visits
+    :param env: Environment to run the episodes in
+    :param policy: FrozenPolicy of the float32 graph
+    :param input_name: Name of the placeholder the observations are fed to
+    :param filename: .npz file the batch is written to
+    :param batch_size: Number of observations stored
+    :param num_steps: Number of steps the observations are sampled among
+    :return: Dict mapping input_name to the batch of observations
+    """
+    random_state = np.random.RandomState(0)
+    sample = []
+    step = 0
+    while step < num_steps:
+        observation = env.reset()
+        done = False
+        while not done and step < num_steps:
+            # Reservoir sampling, every step has the same chance to be in the batch
+            if len(sample) < batch_size:
+                sample.append(np.array(observation))
+            else:
+                index = random_state.randint(step + 1)
+                if index < batch_size:
+                    sample[index] = np.array(observation)
+            observation, reward, done, info = env.step(policy.act(observation))
+            step += 1
+    observations = {input_name: np.stack(sample).astype(policy.observation_dtype)}
+    np.savez(filename, **observations)
+    print("Stored %s validation observations sampled among %s steps in %s" % (len(sample), step, filename))
+    return observations
+
+
+def load_validation_observations(filename, graph_def, batch_size=VALIDATION_BATCH_SIZE):
+    """
+    Load the stored batch of observations, synthesizing one if there is none
+    :return: Tuple of the dict mapping the name of every placeholder of the graph to a batch of observations, and
+             whether the batch is synthetic
+    """
+    if os.path.isfile(filename):
+        with np.load(filename) as stored:
+            return {name: stored[name] for name in stored.files}, False
+    print("No validation observations in %s, validating the graph variants on synthetic observations" % filename)
+    random_state = np.random.RandomState(0)
+    observations = {}
+    for node in graph_def.node:
+        if node.op == "Placeholder":
+            shape = [dim.size if dim.size > 0 else batch_size for dim in node.attr["shape"].shape.dim]
+            dtype = tf.as_dtype(node.attr["dtype"].type).as_numpy_dtype
+            observations[node.name] = random_state.uniform(0, SYNTHETIC_OBSERVATION_HIGH, shape).astype(dtype)
+    return observations, True
+
+
+def run_policy(graph_def, observations, output_names, num_latency_runs=NUM_LATENCY_RUNS):
+    """
+    Run the policy on a batch of observations, then time it on single observations as in a rollout, on CPU
+    :return: Tuple of the list of output batches, the load time and the list of single observation latencies
+    """
+    start_time = time.time()
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name="")
+    with tf.Session(graph=graph, config=tf.ConfigProto(device_count={"GPU": 0})) as sess:
+        outputs = [graph.get_tensor_by_name(name + ":0") for name in output_names]
+        feed = {graph.get_tensor_by_name(name + ":0"): value for name, value in observations.items()}
+        values = sess.run(outputs, feed)
+        load_time = time.time() - start_time
+
+        single_feed = {tensor: value[:1] for tensor, value in feed.items()}
+        latencies = []
+        for _ in range(num_latency_runs):
+            start_time = time.time()
+            sess.run(outputs, single_feed)
+            latencies.append(time.time() - start_time)
+    return values, load_time, latencies
+
+
+def compare_outputs(reference, outputs):
+    """
+    :param reference: Output batches of the float32 policy
+    :param outputs: Output batches of a variant
+    :return: Tuple of the fraction of observations where the variant picks the same action for every output with more
+             than one value, and the largest absolute difference between any output value
+    """
+    agree = None
+    max_delta = 0.0
+    for expected, actual in zip(reference, outputs):
+        expected = np.asarray(expected, dtype=np.float64)
+        actual = np.asarray(actual, dtype=np.float64)
+        max_delta = max(max_delta, float(np.max(np.abs(expected - actual))) if expected.size else 0.0)
+        if expected.ndim >= 2 and expected.shape[-1] > 1:
+            same_action = np.argmax(expected, axis=-1) == np.argmax(actual, axis=-1)
+            agree = same_action if agree is None else agree & same_action
+    return (float(np.mean(agree)) if agree is not None else 1.0), max_delta
+
+
+def export_variants(graph_def, local_path, output_names, variants=VARIANTS, observations_filename=None,
+                    min_agreement=FROZEN_GRAPH_VARIANT_MIN_AGREEMENT):
+    """
+    Write the variants of the frozen policy next to model.pb, with a report of the size, the CPU latency and the
+    agreement with the float32 policy of every variant. A variant whose agreement is below min_agreement is
+    reported but not written, and a previous version of it is removed.
+    :param graph_def: Frozen float32 policy graph
+    :param local_path: Directory model.pb is in
+    :param output_names: Names of the output nodes
+    :param variants: Variants to build
+    :param observations_filename: Batch of observations to validate the variants on, defaults to
+                                  VALIDATION_OBSERVATIONS_FILENAME in local_path
+    :param min_agreement: Minimum action agreement with the float32 policy for a variant to be written
+    :return: The report
+    """
+    start_time = time.time()
+    observations_filename = observations_filename or os.path.join(local_path, VALIDATION_OBSERVATIONS_FILENAME)
+    observations, synthetic = load_validation_observations(observations_filename, graph_def)
+    reference, load_time, latencies = run_policy(graph_def, observations, output_names)
+    graphs = {FROZEN_GRAPH_FILENAME: _get_report_entry(graph_def, load_time, latencies, 1.0, 0.0)}
+    graphs[FROZEN_GRAPH_FILENAME]["written"] = True
+    for variant, variant_graph_def in build_variants(graph_def, output_names, variants).items():
+        outputs, load_time, latencies = run_policy(variant_graph_def, observations, output_names)
+        agreement, max_delta = compare_outputs(reference, outputs)
+        filename = get_variant_filename(variant)
+        entry = _get_report_entry(variant_graph_def, load_time, latencies, agreement, max_delta)
+        entry["written"] = agreement >= min_agreement
+        if entry["written"]:
+            write_graph(variant_graph_def, local_path, filename)
+        elif os.path.isfile(os.path.join(local_path, filename)):
+            os.remove(os.path.join(local_path, filename))
+        graphs[filename] = entry
+
+    report = {"validation": {"observations": None if synthetic else observations_filename,
+                             "synthetic": synthetic,
+                             "batch_size": min(len(value) for value in observations.values()),
+                             "min_action_agreement": min_agreement},
+              "graphs": graphs}
+    with open(os.path.join(local_path, VARIANTS_REPORT_FILENAME), 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print("Exported %s of %s policy graph variants in %.2f seconds, validated on %s %s observations" %
+          (sum(1 for entry in graphs.values() if entry["written"]) - 1, len(graphs) - 1, time.time() - start_time,
+           report["validation"]["batch_size"], "synthetic" if synthetic else "captured"))
+    for filename, entry in sorted(graphs.items()):
+        print("  %s: %s bytes, %.3f ms per step, action agreement %.4f, max output delta %.6f%s" %
+              (filename, entry["size_bytes"], entry["latency_ms_p50"], entry["action_agreement"],
+               entry["max_output_delta"], "" if entry["written"] else ", below %s, not written" % min_agreement))
+    return report
+
+
+def _get_report_entry(graph_def, load_time, latencies, agreement, max_delta):
+    latencies_in_ms = np.array(latencies) * 1000
+    return {"size_bytes": graph_def.ByteSize(),
+            "load_time_in_second": load_time,
+            "latency_ms_p50": float(np.percentile(latencies_in_ms, 50)),
+            "latency_ms_p99": float(np.percentile(latencies_in_ms, 99)),
+            "action_agreement": agreement,
+            "max_output_delta": max_delta}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--local-model-directory',
+                        help='(string) Path to the folder containing model.pb, the variants are written to it.',
+                        type=str,
+                        default='./checkpoint')
+    parser.add_argument('--output-heads',
+                        help='(string) Comma separated names of the output nodes of the policy.',
+                        type=str,
+                        required=True)
+    parser.add_argument('--variants',
+                        help='(string) Comma separated variants to build, among {}.'.format(", ".join(VARIANTS)),
+                        type=str,
+                        default=",".join(VARIANTS))
+    parser.add_argument('--observations',
+                        help='(string) .npz file with a batch of observations per placeholder to validate on.',
+                        type=str,
+                        default=None)
+    parser.add_argument('--capture-level',
+                        help='(string) Gym id of the environment to capture the validation observations from with '
+                             'greedy episodes of model.pb, before exporting the variants.',
+                        type=str,
+                        default=None)
+    parser.add_argument('--min-agreement',
+                        help='(float) Minimum action agreement with model.pb for a variant to be written.',
+                        type=float,
+                        default=FROZEN_GRAPH_VARIANT_MIN_AGREEMENT)
+    args = parser.parse_args()
+
+    model_path = os.path.join(args.local_model_directory, FROZEN_GRAPH_FILENAME)
+    output_names = args.output_heads.split(",")
+    observations_filename = args.observations or \
+        os.path.join(args.local_model_directory, VALIDATION_OBSERVATIONS_FILENAME)
+    if args.capture_level:
+        # Imported here since they need the simulation
+        import gym
+        import markov.environments
+        from markov.frozen_policy import FrozenPolicy
+        policy = FrozenPolicy(model_path, output_name=output_names[0])
+        try:
+            capture_validation_observations(gym.make(args.capture_level), policy, policy.input_name,
+                                            observations_filename)
+        finally:
+            policy.close()
+
+    graph_def = tf.GraphDef()
+    with open(model_path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    export_variants(graph_def, args.local_model_directory, output_names, variants=args.variants.split(","),
+                    observations_filename=observations_filename, min_agreement=args.min_agreement)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,395 @@
+"""
+Local policy inference server shared by the evaluation workers of a host. It loads the frozen policy once, runs the
+observations of all the workers in micro batches and swaps the policy when the trainer publishes a new one.
+Its clients are the frozen graph evaluation workers (model_evaluation --inference-socket). The rl_coach rollout
+workers still run the policy in their own session, since their agents act through the rl_coach graph.
+"""
+import argparse
+import json
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+import numpy as np
+from markov import utils
+from markov.checkpoint_manifest import hash_file
+from markov.cloudwatch import CloudWatchMetricsPublisher
+from markov.data_store_factory import create_data_store
+from markov.frozen_policy import FrozenPolicy
+from markov.graph_export import FROZEN_GRAPH_FILENAME, PPO_POLICY_OUTPUT_HEAD
+
+# Requests are a header with the length of the observation and the NumPy type code of its values, followed by the
+# raw observation. Responses are a header with the length of the probabilities, the action and the version of the
+# policy that picked it, followed by the float32 action probabilities. A negative action reports an error instead.
+REQUEST_HEADER = struct.Struct("<Ic")
+RESPONSE_HEADER = struct.Struct("<IiI")
+POLICY_ERROR_ACTION = -1            # The batch the observation was in failed to run
+INVALID_OBSERVATION_ACTION = -2     # The size or the type of the observation does not match the policy
+
+# BATCHING - a batch is run as soon as it holds MAX_BATCH_SIZE observations, one observation of every connected
+# worker, or its first observation waited MAX_BATCH_DELAY_IN_SECOND
+INFERENCE_SOCKET_PATH = os.environ.get("INFERENCE_SOCKET_PATH", "/tmp/markov-inference.sock")
+MAX_BATCH_SIZE = int(os.environ.get("INFERENCE_MAX_BATCH_SIZE", 32))
+MAX_BATCH_DELAY_IN_SECOND = float(os.environ.get("INFERENCE_MAX_BATCH_DELAY_IN_SECOND", 0.002))
+INFERENCE_THREADS = int(os.environ.get("INFERENCE_THREADS", 2))
+
+# METRICS - queue depth and batch size are logged every METRICS_LOG_INTERVAL_IN_SECOND, and published to CloudWatch
+# when INFERENCE_METRICS_NAMESPACE is set
+METRICS_LOG_INTERVAL_IN_SECOND = 60
+# The frozen graph is exported every few saves, the server logs that it is still waiting for one at this interval
+POLICY_WAIT_LOG_INTERVAL_IN_SECOND = 60
+INFERENCE_METRICS_NAMESPACE = os.environ.get("INFERENCE_METRICS_NAMESPACE")
+
+
+class InferenceServer(object):
+    """
+    Serves actions over a Unix socket. Every connection has a reader thread that queues the observations it
+    receives, a single batcher thread runs them through the policy in micro batches and answers each connection.
+    A watcher thread waits for new checkpoints with load_from_store and swaps in the frozen graph published with
+    them, a batch always runs on a single version of the policy.
+    """
+    def __init__(self, socket_path, data_store, checkpoint_dir, output_name=PPO_POLICY_OUTPUT_HEAD,
+                 max_batch_size=MAX_BATCH_SIZE, max_batch_delay_in_second=MAX_BATCH_DELAY_IN_SECOND,
+                 num_threads=INFERENCE_THREADS, metrics_publisher=None):
+        """
+        :param socket_path: Path of the Unix socket to listen on
+        :param data_store: Data store the trainer publishes the checkpoints and the frozen graph to
+        :param checkpoint_dir: Local directory the checkpoints and the frozen graph are downloaded to
+        :param output_name: Name of the output node of the frozen graph giving the action probabilities
+        :param max_batch_size: Maximum number of observations run in a batch
+        :param max_batch_delay_in_second: Maximum time an observation waits for the batch to fill up
+        :param num_threads: Number of threads TensorFlow runs the graph with
+        :param metrics_publisher: Optional CloudWatchMetricsPublisher the metrics are published to
+        """
+        self.socket_path = socket_path
+        self.data_store = data_store
+        self.checkpoint_dir = checkpoint_dir
+        self.output_name = output_name
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay_in_second = max_batch_delay_in_second
+        self.num_threads = num_threads
+        self.metrics_publisher = metrics_publisher
+        self.policy = None
+        self.policy_version = 0
+        self.num_requests = 0
+        self.num_batches = 0
+        self.max_queue_depth = 0
+        self._policy_digest = None
+        self._policy_lock = threading.Lock()
+        self._policy_loaded = threading.Event()
+        self._requests = queue.Queue()
+        self._metrics_lock = threading.Lock()
+        self._batch_sizes = []
+        self._queue_depths = []
+        self._stop = threading.Event()
+        self._server_socket = None
+        self._num_connections = 0
+
+    def serve_forever(self):
+        """
+        Load the latest policy, then serve requests until stop() is called
+        """
+        utils.wait_for_checkpoint(self.checkpoint_dir, self.data_store)
+        threading.Thread(target=self._watch_checkpoints, name="inference-watcher", daemon=True).start()
+        start_time = time.time()
+        while not self._policy_loaded.wait(POLICY_WAIT_LOG_INTERVAL_IN_SECOND):
+            print("Waited %.0f seconds for a checkpoint published with a frozen graph (%s), the trainer exports it "
+                  "every FROZEN_GRAPH_EXPORT_EVERY saves" % (time.time() - start_time, FROZEN_GRAPH_FILENAME))
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self._server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server_socket.bind(self.socket_path)
+        self._server_socket.listen(64)
+        threading.Thread(target=self._run_batches, name="inference-batcher", daemon=True).start()
+        threading.Thread(target=self._log_metrics, name="inference-metrics", daemon=True).start()
+        print("Serving policy version %s on %s" % (self.policy_version, self.socket_path))
+        while not self._stop.is_set():
+            try:
+                connection, _ = self._server_socket.accept()
+            except OSError:
+                break
+            threading.Thread(target=self._read_requests, args=(connection,), name="inference-reader",
+                             daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        if self._server_socket:
+            self._server_socket.close()
+
+    def get_metrics(self):
+        """
+        :return: Dict with the request and batch counters and the queue depth and batch size since the last call
+        """
+        with self._metrics_lock:
+            batch_sizes, self._batch_sizes = self._batch_sizes, []
+            queue_depths, self._queue_depths = self._queue_depths, []
+        return {"policy_version": self.policy_version,
+                "requests": self.num_requests,
+                "batches": self.num_batches,
+                "queue_depth": self._requests.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                "mean_queue_depth": float(np.mean(queue_depths)) if queue_depths else 0.0,
+                "mean_batch_size": float(np.mean(batch_sizes)) if batch_sizes else 0.0,
+                "max_batch_size": max(batch_sizes) if batch_sizes else 0}
+
+    def _read_requests(self, connection):
+        send_lock = threading.Lock()
+        with self._metrics_lock:
+            self._num_connections += 1
+        try:
+            while not self._stop.is_set():
+                header = _recv_exactly(connection, REQUEST_HEADER.size)
+                if header is None:
+                    return
+                length, type_code = REQUEST_HEADER.unpack(header)
+                payload = _recv_exactly(connection, length)
+                if payload is None:
+                    return
+                observation = np.frombuffer(payload, dtype=np.dtype(type_code.decode()))
+                self._requests.put((observation, connection, send_lock))
+        except OSError as e:
+            print("Inference connection closed", e)
+        finally:
+            with self._metrics_lock:
+                self._num_connections -= 1
+            connection.close()
+
+    def _run_batches(self):
+        while not self._stop.is_set():
+            requests = [self._requests.get()]
+            queue_depth = self._requests.qsize() + 1
+            # Wait for more observations until the batch is full or the first observation waited long enough. Clients
+            # wait for the answer before sending the next observation, so once every connection has an observation
+            # in the batch no other can come.
+            deadline = time.time() + self.max_batch_delay_in_second
+            while len(requests) < min(self.max_batch_size, self._num_connections):
+                remaining = deadline - time.time()
+                try:
+                    requests.append(self._requests.get(block=remaining > 0, timeout=max(remaining, 0)))
+                except queue.Empty:
+                    break
+
+            with self._policy_lock:
+                policy, policy_version = self.policy, self.policy_version
+            # An observation that does not fit the policy is only answered with an error to its own connection
+            valid_requests = []
+            for request in requests:
+                if self._is_valid(request[0], policy):
+                    valid_requests.append(request)
+                else:
+                    self._send(request, RESPONSE_HEADER.pack(0, INVALID_OBSERVATION_ACTION, policy_version))
+            requests = valid_requests
+            if not requests:
+                continue
+            try:
+                observations = np.empty((len(requests),) + policy.observation_shape, dtype=policy.observation_dtype)
+                for index, (observation, _, _) in enumerate(requests):
+                    observations[index] = observation.reshape(policy.observation_shape)
+                probabilities = np.asarray(policy.run_batch(observations), dtype=np.float32)
+            except Exception as e:
+                print("Got exception while running a batch of %s observations" % len(requests), e)
+                probabilities = None
+
+            for index, request in enumerate(requests):
+                if probabilities is None:
+                    response = RESPONSE_HEADER.pack(0, POLICY_ERROR_ACTION, policy_version)
+                else:
+                    payload = probabilities[index].tobytes()
+                    response = RESPONSE_HEADER.pack(len(payload), int(np.argmax(probabilities[index])),
+                                                    policy_version) + payload
+                self._send(request, response)
+
+            with self._metrics_lock:
+                self.num_requests += len(requests)
+                self.num_batches += 1
+                self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+                self._batch_sizes.append(len(requests))
+                self._queue_depths.append(queue_depth)
+
+    @staticmethod
+    def _is_valid(observation, policy):
+        """
+        :return: True if the observation has as many values as the input of the policy, of a type that converts to
+                 the type of the input without changing its kind
+        """
+        if observation.size != int(np.prod(policy.observation_shape)) or \
+                not np.can_cast(observation.dtype, policy.observation_dtype, casting="same_kind"):
+            print("Rejected an observation of %s %s values, the policy expects %s %s" %
+                  (observation.size, observation.dtype, policy.observation_shape, np.dtype(policy.observation_dtype)))
+            return False
+        return True
+
+    @staticmethod
+    def _send(request, response):
+        _, connection, send_lock = request
+        try:
+            with send_lock:
+                connection.sendall(response)
+        except OSError:
+            pass
+
+    def _watch_checkpoints(self):
+        while not self._stop.is_set():
+            try:
+                self._load_policy()
+                # Block until the trainer publishes the next checkpoint
+                self.data_store.load_from_store(
+                    expected_checkpoint_number=self.data_store.get_current_checkpoint_number() + 1)
+            except Exception as e:
+                print("Got exception while waiting for a new policy", e)
+                time.sleep(1)
+
+    def _load_policy(self):
+        """
+        Load the frozen graph published with the latest checkpoint if it changed, and swap it in
+        """
+        if self.data_store.download_frozen_graph() is None:
+            return
+        model_path = os.path.join(self.checkpoint_dir, FROZEN_GRAPH_FILENAME)
+        digest = hash_file(model_path)
+        if digest == self._policy_digest:
+            # The frozen graph is exported in the background, it may not have been updated with the checkpoint
+            return
+        start_time = time.time()
+        policy = FrozenPolicy(model_path, output_name=self.output_name, num_threads=self.num_threads)
+        with self._policy_lock:
+            old_policy, self.policy = self.policy, policy
+            self.policy_version += 1
+        self._policy_digest = digest
+        self._policy_loaded.set()
+        print("Loaded policy version %s in %.2f seconds" % (self.policy_version, time.time() - start_time))
+        if old_policy:
+            # Leave the batch that may still be running on the old policy time to finish
+            threading.Timer(10, old_policy.close).start()
+
+    def _log_metrics(self):
+        while not self._stop.wait(METRICS_LOG_INTERVAL_IN_SECOND):
+            metrics = self.get_metrics()
+            print(json.dumps({"event": "inference_metrics", **metrics}))
+            if self.metrics_publisher:
+                self.metrics_publisher.put_metrics([
+                    {'MetricName': 'QueueDepth', 'Unit': 'Count', 'Value': metrics["mean_queue_depth"]},
+                    {'MetricName': 'MaxQueueDepth', 'Unit': 'Count', 'Value': metrics["max_queue_depth"]},
+                    {'MetricName': 'BatchSize', 'Unit': 'Count', 'Value': metrics["mean_batch_size"]}])
+
+
+class InferenceClient(object):
+    """
+    Asks the inference server for actions, a drop-in replacement for FrozenPolicy in frozen_policy.run_episodes
+    """
+    def __init__(self, socket_path=INFERENCE_SOCKET_PATH):
+        self.socket_path = socket_path
+        self.policy_version = None
+        self._socket = None
+
+    def action_probabilities(self, observation):
+        """
+        :return: Tuple of the action picked by the server and the output of the policy for the observation
+        """
+        observation = np.ascontiguousarray(observation)
+        request = REQUEST_HEADER.pack(observation.nbytes, observation.dtype.char.encode()) + observation.tobytes()
+        try:
+            return self._request(request)
+        except OSError as e:
+            # The server may have restarted, reconnect once
+            print("Reconnecting to the inference server", e)
+            self.close()
+            return self._request(request)
+
+    def act(self, observation):
+        """
+        :return: The greedy action for the observation
+        """
+        return self.action_probabilities(observation)[0]
+
+    def close(self):
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+
+    def _request(self, request):
+        if self._socket is None:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(self.socket_path)
+        self._socket.sendall(request)
+        header = _recv_exactly(self._socket, RESPONSE_HEADER.size)
+        if header is None:
+            raise ConnectionError("The inference server closed the connection")
+        length, action, self.policy_version = RESPONSE_HEADER.unpack(header)
+        if action == INVALID_OBSERVATION_ACTION:
+            raise ValueError("The inference server rejected the observation, its size or type does not match the "
+                             "input of the policy")
+        if action < 0:
+            raise RuntimeError("The inference server failed to run the policy")
+        payload = _recv_exactly(self._socket, length)
+        if payload is None:
+            raise ConnectionError("The inference server closed the connection")
+        return action, np.frombuffer(payload, dtype=np.float32)
+
+
+def _recv_exactly(connection, length):
+    """
+    :return: The next length bytes received, None if the connection was closed first
+    """
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    received = 0
+    while received < length:
+        num_bytes = connection.recv_into(view[received:])
+        if not num_bytes:
+            return None
+        received += num_bytes
+    return bytes(buffer)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket',
+                        help='(string) Path of the Unix socket to serve on.',
+                        type=str,
+                        default=INFERENCE_SOCKET_PATH)
+    parser.add_argument('--data-store-url',
+                        help='(string) s3://<bucket>/<prefix> or file:///<directory> of the data store the model is '
+                             'stored in. Overrides the S3 bucket and prefix.',
+                        type=str,
+                        default=os.environ.get("DATA_STORE_URL"))
+    parser.add_argument('--model-s3-bucket',
+                        help='(string) S3 bucket where trained models are stored. It contains model checkpoints.',
+                        type=str,
+                        default=os.environ.get("MODEL_S3_BUCKET"))
+    parser.add_argument('--model-s3-prefix',
+                        help='(string) S3 prefix where trained models are stored. It contains model checkpoints.',
+                        type=str,
+                        default=os.environ.get("MODEL_S3_PREFIX"))
+    parser.add_argument('--aws-region',
+                        help='(string) AWS region',
+                        type=str,
+                        default=os.environ.get("ROS_AWS_REGION", "us-west-2"))
+    parser.add_argument('-c', '--local-model-directory',
+                        help='(string) Path to the folder the checkpoints and the frozen graph are downloaded to.',
+                        type=str,
+                        default='./inference_checkpoint')
+    parser.add_argument('--output-head',
+                        help='(string) Name of the output node of the frozen graph giving the action probabilities.',
+                        type=str,
+                        default=os.environ.get("FROZEN_GRAPH_POLICY_HEAD", PPO_POLICY_OUTPUT_HEAD))
+    args = parser.parse_args()
+
+    _, data_store = create_data_store(args.data_store_url,
+                                      checkpoint_dir=args.local_model_directory,
+                                      aws_region=args.aws_region,
+                                      bucket_name=args.model_s3_bucket,
+                                      s3_folder=args.model_s3_prefix)
+    metrics_publisher = None
+    if INFERENCE_METRICS_NAMESPACE:
+        metrics_publisher = CloudWatchMetricsPublisher(INFERENCE_METRICS_NAMESPACE, args.aws_region)
+    server = InferenceServer(args.socket, data_store, args.local_model_directory, output_name=args.output_head,
+                             metrics_publisher=metrics_publisher)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,396 @@
+"""
+Data store keeping the checkpoints in a directory on a disk shared by the trainer and the rollout workers, e.g.
+a local disk on a single node or a shared volume, instead of S3
+"""
+import errno
+import json
+import os
+import shutil
+import tempfile
+import time
+from google.protobuf import text_format
+from tensorflow.python.training.checkpoint_state_pb2 import CheckpointState
+from rl_coach.data_stores.data_store import DataStore, DataStoreParameters
+from markov.checkpoint_manifest import FileHashCache, build_manifest
+from markov.graph_export import FROZEN_GRAPH_FILENAME, FrozenGraphExporter, get_frozen_graph_name
+from markov.polling import Poller
+from markov.retention import RetentionPolicy, get_checkpoint_number
+from markov.s3_boto_data_store import CHECKPOINT_METADATA_FILENAME, CHECKPOINT_POINTER_FILENAME, IP_KEY, \
+    CHECKPOINT_KEEP_LAST, CHECKPOINT_KEEP_EVERY, IP_POLL_LOG_INTERVAL_IN_SECOND
+
+try:
+    # inotify wakes the readers up as soon as a file is published, without it they watch the modification time
+    # of the published files
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+# Maximum time between two checks for a new checkpoint, in case a change notification was missed
+LOCAL_POLL_MAX_INTERVAL_IN_SECOND = 1
+
+
+class LocalDataStoreParameters(DataStoreParameters):
+    def __init__(self, store_dir: str = None, checkpoint_dir: str = None, keep_last: int = CHECKPOINT_KEEP_LAST,
+                 keep_every: int = CHECKPOINT_KEEP_EVERY):
+        super().__init__("local", "", "")
+        self.store_dir = store_dir
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+
+
+class LocalDataStore(DataStore):
+    """
+    Same layout as the S3 data store, under store_dir instead of the S3 prefix. Files are published by writing
+    them next to their destination and renaming them into place, and a checkpoint becomes visible to the readers
+    when its pointer file is renamed into place last. Checkpoint files are never modified once written, so they
+    are hard linked instead of copied when the store is on the same file system as the checkpoint directory.
+    Same as in S3, the pointer lists the digest of every file and a file is only published or loaded again when its
+    content differs, so a restarted run reusing the checkpoint names never keeps the weights of the previous run.
+    """
+    def __init__(self, params: LocalDataStoreParameters):
+        self.params = params
+        self.model_dir = os.path.join(self.params.store_dir, "model")
+        self.ip_data_file = os.path.join(self.params.store_dir, "ip", "ip.json")
+        self.ip_done_file = os.path.join(self.params.store_dir, "ip", "done")
+        self.preset_data_dir = os.path.join(self.params.store_dir, "presets")
+        self.environment_data_dir = os.path.join(self.params.store_dir, "environments")
+        self.pointer_file = os.path.join(self.model_dir, CHECKPOINT_POINTER_FILENAME)
+        self.retention_policy = RetentionPolicy(self.params.keep_last, self.params.keep_every)
+        self.graph_manager = None
+        self._downloaded_checkpoint = None
+        self._graph_exporter = None
+        self._frozen_graph = None
+        self._hash_cache = FileHashCache()
+        self.checkpoint_poller = Poller("checkpoint", max_interval_in_second=LOCAL_POLL_MAX_INTERVAL_IN_SECOND,
+                                        notify_file=self.pointer_file)
+        self.ip_poller = Poller("SageMaker Redis server IP", max_interval_in_second=LOCAL_POLL_MAX_INTERVAL_IN_SECOND,
+                                notify_file=self.ip_done_file, log_interval_in_second=IP_POLL_LOG_INTERVAL_IN_SECOND)
+
+    def deploy(self) -> bool:
+        return True
+
+    def get_info(self):
+        return "file://{}".format(os.path.abspath(self.params.store_dir))
+
+    def undeploy(self) -> bool:
+        return True
+
+    def save_to_store(self):
+        """
+        Publish the checkpoint: its files are published first and the pointer file last
+        """
+        checkpoint = self._get_current_checkpoint()
+        graph_filenames = ()
+        if self.graph_manager:
+            # The frozen graph is converted in the background while the checkpoint files are published, and
+            # published after them
+            if self._graph_exporter is None:
+                self._graph_exporter = FrozenGraphExporter(self.graph_manager, self.params.checkpoint_dir)
+            self._graph_exporter.export(self._get_checkpoint_number(checkpoint) if checkpoint else None)
+            graph_filenames = tuple(self._graph_exporter.filenames)
+
+        start_time = time.time()
+        os.makedirs(self.model_dir, exist_ok=True)
+        files = {}
+        num_files = 0
+        manifest = build_manifest(self.params.checkpoint_dir, self._hash_cache,
+                                  exclude=(CHECKPOINT_METADATA_FILENAME,) + graph_filenames)
+        for rel_name, entry in manifest.items():
+            if os.path.basename(rel_name).startswith("."):
+                continue
+            filename = os.path.join(self.params.checkpoint_dir, rel_name)
+            published_filename = os.path.join(self.model_dir, rel_name)
+            if get_checkpoint_number(rel_name) is None:
+                # Other files are rewritten in place by the trainer so they are copied
+                num_files += self._publish_changed_file(rel_name, entry)
+            elif checkpoint and rel_name.startswith(checkpoint.model_checkpoint_path):
+                files[rel_name] = entry
+                if not self._hash_cache.matches(published_filename, entry["sha256"]):
+                    self._publish_file(filename, published_filename)
+                    self._hash_cache.put(published_filename, entry["sha256"])
+                    num_files += 1
+
+        if self._graph_exporter:
+            export = self._graph_exporter.wait()
+            if checkpoint and export and export["files"] and \
+                    export["checkpoint_number"] == self._get_checkpoint_number(checkpoint):
+                # Same as the checkpoint files, the frozen graph is published under the name of its checkpoint
+                graph_files = {}
+                for rel_name in export["files"]:
+                    filename = os.path.join(self.params.checkpoint_dir, rel_name)
+                    name = get_frozen_graph_name(checkpoint.model_checkpoint_path, rel_name)
+                    graph_files[rel_name] = {"key": name,
+                                             "size": os.path.getsize(filename),
+                                             "sha256": self._hash_cache.get(filename)}
+                    self._publish_file(filename, os.path.join(self.model_dir, name))
+                    num_files += 1
+                self._frozen_graph = {"checkpoint_number": export["checkpoint_number"], "files": graph_files}
+
+        metadata_filename = os.path.join(self.params.checkpoint_dir, CHECKPOINT_METADATA_FILENAME)
+        self._publish_file(metadata_filename, os.path.join(self.model_dir, CHECKPOINT_METADATA_FILENAME), link=False)
+        if checkpoint:
+            with open(metadata_filename) as f:
+                metadata = f.read()
+            self._write_file(self.pointer_file, json.dumps({"checkpoint": checkpoint.model_checkpoint_path,
+                                                            "metadata": metadata,
+                                                            "files": files,
+                                                            "frozen_graph": self._frozen_graph}))
+            self._delete_old_checkpoints(self._get_checkpoint_number(checkpoint))
+        print("Published %s model files to %s in %.2f seconds" % (num_files + 1, self.model_dir,
+                                                                 time.time() - start_time))
+
+    def load_from_store(self, expected_checkpoint_number=-1):
+        try:
+            if not os.path.exists(self.params.checkpoint_dir):
+                os.makedirs(self.params.checkpoint_dir)
+
+            def get_expected_checkpoint():
+                # Wait until the trainer published a checkpoint that is at least the expected checkpoint
+                pointer = self._get_checkpoint_pointer()
+                if pointer and self._get_checkpoint_number(pointer["checkpoint"]) >= expected_checkpoint_number:
+                    return pointer
+                return None
+
+            if self._downloaded_checkpoint and \
+                    self._get_checkpoint_number(self._downloaded_checkpoint) < expected_checkpoint_number:
+                # The trainer is about to publish the next checkpoint
+                self.checkpoint_poller.expect_event()
+            pointer = self._wait_for(self.checkpoint_poller, get_expected_checkpoint)
+            if self._downloaded_checkpoint == pointer["checkpoint"]:
+                return True
+
+            # Same as the S3 data store, the checkpoint is gathered next to the checkpoint directory and moved into
+            # it file by file, the metadata file last
+            start_time = time.time()
+            download_dir = tempfile.mkdtemp(prefix=".checkpoint-download-",
+                                            dir=os.path.dirname(os.path.abspath(self.params.checkpoint_dir)))
+            try:
+                rel_names = []
+                for rel_name, entry in pointer["files"].items():
+                    filename = os.path.join(self.params.checkpoint_dir, rel_name)
+                    if self._hash_cache.matches(filename, entry.get("sha256")):
+                        continue
+                    self._publish_file(os.path.join(self.model_dir, rel_name), os.path.join(download_dir, rel_name))
+                    rel_names.append(rel_name)
+                self._write_file(os.path.join(download_dir, CHECKPOINT_METADATA_FILENAME), pointer["metadata"])
+                for rel_name in rel_names + [CHECKPOINT_METADATA_FILENAME]:
+                    filename = os.path.join(self.params.checkpoint_dir, rel_name)
+                    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+                    os.replace(os.path.join(download_dir, rel_name), filename)
+                    if rel_name in pointer["files"]:
+                        self._hash_cache.put(filename, pointer["files"][rel_name]["sha256"])
+            finally:
+                shutil.rmtree(download_dir, ignore_errors=True)
+            self._downloaded_checkpoint = pointer["checkpoint"]
+            print("Loaded checkpoint %s (%s new files) from %s in %.2f seconds" %
+                  (pointer["checkpoint"], len(rel_names), self.model_dir, time.time() - start_time))
+            return True
+
+        except Exception as e:
+            print("Got exception while loading model from %s" % self.model_dir, e)
+            raise e
+
+    def store_ip(self, ip_address):
+        self._write_file(self.ip_data_file, json.dumps({IP_KEY: ip_address}))
+        self._write_file(self.ip_done_file, "done")
+
+    def store_evaluation_summary(self, filename):
+        """
+        Copy the summary of an evaluation next to the checkpoints, under the name of the file. The retention policy
+        does not delete it.
+        """
+        self._publish_file(filename, os.path.join(self.model_dir, os.path.basename(filename)), link=False)
+
+    def get_ip(self, timeout_in_second=600):
+        if not self._wait_for(self.ip_poller, lambda: os.path.isfile(self.ip_done_file), timeout_in_second):
+            raise RuntimeError("Cannot retrieve IP of redis server running in SageMaker")
+        try:
+            with open(self.ip_data_file) as f:
+                return json.load(f)[IP_KEY]
+        except Exception as e:
+            raise RuntimeError("Cannot fetch IP of redis server running in SageMaker:", e)
+
+    def download_presets_if_present(self, local_path):
+        return self._copy_directory(self.preset_data_dir, local_path)
+
+    def download_environments_if_present(self, local_path):
+        return self._copy_directory(self.environment_data_dir, local_path)
+
+    def download_frozen_graph(self):
+        """
+        Copy the frozen graph listed in the pointer to the latest checkpoint into the checkpoint directory, unless
+        the one already there has the same content
+        :return: Number of the checkpoint the graph was exported from, None if no graph was published
+        """
+        pointer = self._get_checkpoint_pointer()
+        frozen_graph = pointer.get("frozen_graph") if pointer else None
+        if not frozen_graph or FROZEN_GRAPH_FILENAME not in frozen_graph["files"]:
+            return None
+        entry = frozen_graph["files"][FROZEN_GRAPH_FILENAME]
+        filename = os.path.join(self.params.checkpoint_dir, FROZEN_GRAPH_FILENAME)
+        if not self._hash_cache.matches(filename, entry["sha256"]):
+            try:
+                self._publish_file(os.path.join(self.model_dir, entry["key"]), filename, link=False)
+            except OSError as e:
+                print("Got exception while copying the frozen graph %s" % entry["key"], e)
+                return None
+            self._hash_cache.put(filename, entry["sha256"])
+        return frozen_graph["checkpoint_number"]
+
+    def get_current_checkpoint_number(self):
+        return self._get_checkpoint_number(self._get_current_checkpoint())
+
+    def _wait_for(self, poller, check, timeout_in_second=None):
+        """
+        Call check until it returns a truthy value, waking up when a file of the published file's directory
+        changes if inotify is available, and polling with the poller otherwise
+        :return: The first truthy value returned by check, or None if the timeout passed first
+        """
+        if INotify is None:
+            return poller.poll(check, timeout_in_second)
+        directory = os.path.dirname(poller.notify_file)
+        os.makedirs(directory, exist_ok=True)
+        start_time = time.time()
+        inotify = INotify()
+        try:
+            inotify.add_watch(directory, flags.CREATE | flags.MOVED_TO | flags.CLOSE_WRITE)
+            while True:
+                poller.num_checks += 1
+                result = check()
+                if result:
+                    return result
+                remaining = LOCAL_POLL_MAX_INTERVAL_IN_SECOND
+                if timeout_in_second is not None:
+                    remaining = min(remaining, start_time + timeout_in_second - time.time())
+                    if remaining <= 0:
+                        return None
+                inotify.read(timeout=int(remaining * 1000))
+        finally:
+            poller.wait_time_in_second += time.time() - start_time
+            inotify.close()
+
+    def _get_checkpoint_pointer(self):
+        """
+        :return: The pointer to the latest published checkpoint, None if no checkpoint was published yet
+        """
+        try:
+            with open(self.pointer_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _delete_old_checkpoints(self, current_checkpoint_number):
+        """
+        Delete the published checkpoints that the retention policy does not keep. The checkpoint just published is
+        always kept, even when a restarted run numbers it below the checkpoints left by the previous run, and so are
+        the files of the frozen graph the pointer lists.
+        """
+        graph_files = set(entry["key"] for entry in self._frozen_graph["files"].values()) \
+            if self._frozen_graph else set()
+        files_by_checkpoint = {}
+        for rel_name in self._list_files(self.model_dir):
+            checkpoint_number = get_checkpoint_number(rel_name)
+            if checkpoint_number is not None and rel_name not in graph_files:
+                files_by_checkpoint.setdefault(checkpoint_number, []).append(rel_name)
+        for checkpoint_number in self.retention_policy.select_for_deletion(files_by_checkpoint):
+            if checkpoint_number == current_checkpoint_number:
+                continue
+            for rel_name in files_by_checkpoint[checkpoint_number]:
+                try:
+                    os.remove(os.path.join(self.model_dir, rel_name))
+                except OSError as e:
+                    print("Failed deleting file", rel_name, e)
+
+    def _publish_changed_file(self, rel_name, entry):
+        """
+        Copy a file of the checkpoint directory into the store unless the published file has the same content
+        :return: 1 if the file was copied, 0 otherwise
+        """
+        published_filename = os.path.join(self.model_dir, rel_name)
+        if self._hash_cache.matches(published_filename, entry["sha256"]):
+            return 0
+        self._publish_file(os.path.join(self.params.checkpoint_dir, rel_name), published_filename, link=False)
+        self._hash_cache.put(published_filename, entry["sha256"])
+        return 1
+
+    def _copy_directory(self, source_dir, local_path):
+        rel_names = self._list_files(source_dir)
+        if not rel_names:
+            return False
+        try:
+            for rel_name in rel_names:
+                self._publish_file(os.path.join(source_dir, rel_name), os.path.join(local_path, rel_name),
+                                   link=False)
+        except Exception as e:
+            print("Got exception while copying", source_dir, e)
+            return False
+        return True
+
+    @staticmethod
+    def _list_files(directory):
+        """
+        :return: Paths of all the files under the directory, relative to it, skipping hidden temporary files
+        """
+        rel_names = []
+        for root, dirs, filenames in os.walk(directory):
+            for filename in filenames:
+                if not filename.startswith("."):
+                    rel_names.append(os.path.relpath(os.path.join(root, filename), directory))
+        return rel_names
+
+    @staticmethod
+    def _publish_file(filename, destination, link=True):
+        """
+        Atomically replace the destination with the file: the file is hard linked, or copied if it cannot be
+        linked, to a temporary name next to the destination that is then renamed into place
+        """
+        directory = os.path.dirname(os.path.abspath(destination))
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_filename = tempfile.mkstemp(prefix=".", dir=directory)
+        os.close(fd)
+        try:
+            if link:
+                try:
+                    os.remove(temp_filename)
+                    os.link(filename, temp_filename)
+                except OSError as e:
+                    # Not on the same file system, or the file system does not support hard links
+                    if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                        raise e
+                    link = False
+            if not link:
+                shutil.copyfile(filename, temp_filename)
+            os.replace(temp_filename, destination)
+        except Exception as e:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise e
+
+    @staticmethod
+    def _write_file(filename, contents):
+        """
+        Atomically replace the file with the contents
+        """
+        directory = os.path.dirname(os.path.abspath(filename))
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_filename = tempfile.mkstemp(prefix=".", dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+        os.replace(temp_filename, filename)
+
+    def _get_current_checkpoint(self):
+        checkpoint_metadata_filepath = os.path.join(self.params.checkpoint_dir, CHECKPOINT_METADATA_FILENAME)
+        if not os.path.exists(checkpoint_metadata_filepath):
+            return None
+        checkpoint = CheckpointState()
+        with open(checkpoint_metadata_filepath) as f:
+            text_format.Merge(f.read(), checkpoint)
+        return checkpoint
+
+    def _get_checkpoint_number(self, checkpoint):
+        """
+        :param checkpoint: CheckpointState or the name of the checkpoint
+        """
+        checkpoint_relative_path = checkpoint if isinstance(checkpoint, str) else checkpoint.model_checkpoint_path
+        return int(checkpoint_relative_path.split('_Step')[0])
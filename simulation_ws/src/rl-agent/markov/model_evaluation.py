@@ -3,14 +3,12 @@ import os
 import logging
 import sys
 import imp
+import time
 
-from rl_coach.core_types import EnvironmentEpisodes
-from rl_coach.base_parameters import TaskParameters
-from rl_coach.utils import short_dynamic_import
-
-from markov.s3_boto_data_store import S3BotoDataStoreParameters, S3BotoDataStore
-import markov.environments
-from markov import utils
+# Only the standard library and evaluation_driver, which only uses it, are imported at module level. The evaluation
+# workers are spawned processes that import this module again, the TensorFlow, rl_coach, gym and ROS imports are in
+# the functions that need them.
+from markov.evaluation_driver import run_evaluation
 
 CUSTOM_FILES_PATH="robomaker"
 PRESET_LOCAL_PATH = os.path.join(CUSTOM_FILES_PATH, "presets/")
@@ -24,16 +22,50 @@ if not os.path.exists(CUSTOM_FILES_PATH):
 logger = logging.getLogger(__name__)
 
 def evaluation_worker(graph_manager, number_of_trials, local_model_directory):
+    from rl_coach.base_parameters import TaskParameters
+    from rl_coach.core_types import EnvironmentEpisodes
+    from markov.frozen_policy import get_max_rss_in_mb
+
     # Initialize the graph
+    start_time = time.time()
     task_parameters = TaskParameters()
     task_parameters.__dict__['checkpoint_restore_dir'] = local_model_directory
     graph_manager.create_graph(task_parameters)
+    print("Built the rl_coach graph in %.2f seconds, max RSS %.0f MB" % (time.time() - start_time, get_max_rss_in_mb()))
 
     graph_manager.evaluate(EnvironmentEpisodes(number_of_trials))
 
 
+def frozen_graph_evaluation_worker(level, number_of_trials, model_path, output_head, inference_socket=None):
+    """
+    Evaluate the frozen graph exported by the trainer, driving the environment directly instead of through
+    rl_coach. With inference_socket the actions are asked to the inference server instead.
+    """
+    import gym
+    from markov.frozen_policy import FrozenPolicy, run_episodes, get_max_rss_in_mb
+    from markov.inference_server import InferenceClient
+
+    start_time = time.time()
+    if inference_socket:
+        policy = InferenceClient(inference_socket)
+    else:
+        policy = FrozenPolicy(model_path, output_name=output_head)
+    print("Loaded the policy in %.2f seconds, max RSS %.0f MB" % (time.time() - start_time, get_max_rss_in_mb()))
+    env = gym.make(level)
+    try:
+        run_episodes(env, policy, number_of_trials)
+    finally:
+        policy.close()
+
+
 
 def main():
+    from rl_coach.utils import short_dynamic_import
+    import markov.environments
+    from markov import utils
+    from markov.data_store_factory import create_data_store
+    from markov.graph_export import FROZEN_GRAPH_FILENAME, PPO_POLICY_OUTPUT_HEAD
+
     parser = argparse.ArgumentParser()
     parser.add_argument('--markov-preset-file',
                         help="(string) Name of a preset file to run in Markov's preset directory.",
@@ -51,6 +83,11 @@ def main():
                         help='(string) AWS region',
                         type=str,
                         default=os.environ.get("ROS_AWS_REGION", "us-west-2"))
+    parser.add_argument('--data-store-url',
+                        help='(string) s3://<bucket>/<prefix> or file:///<directory> of the data store the model is '
+                             'stored in. Overrides the S3 bucket and prefix.',
+                        type=str,
+                        default=os.environ.get("DATA_STORE_URL"))
     parser.add_argument('--number-of-trials',
                         help='(integer) Number of trials',
                         type=int,
@@ -59,13 +96,35 @@ def main():
                         help='(string) Path to a folder containing a checkpoint to restore the model from.',
                         type=str,
                         default='./checkpoint')
+    parser.add_argument('--frozen-graph',
+                        help='(bool) Evaluate the frozen graph (model.pb) instead of building the rl_coach graph.',
+                        action='store_true',
+                        default=os.environ.get("EVALUATE_FROZEN_GRAPH", "false").lower() == "true")
+    parser.add_argument('--output-head',
+                        help='(string) Name of the output node of the frozen graph giving the action probabilities.',
+                        type=str,
+                        default=os.environ.get("FROZEN_GRAPH_POLICY_HEAD", PPO_POLICY_OUTPUT_HEAD))
+    parser.add_argument('--inference-socket',
+                        help='(string) Unix socket of the local inference server to ask the actions to, with '
+                             '--frozen-graph.',
+                        type=str,
+                        default=os.environ.get("INFERENCE_SOCKET_PATH"))
+    parser.add_argument('--evaluation-workers',
+                        help='(integer) Number of environments evaluating the frozen graph in parallel, each in a '
+                             'process of its own. Stops early once the success rate is known precisely enough and '
+                             'stores the summary next to the checkpoints in the data store. More than 1 needs a '
+                             'simulation per worker listed in EVALUATION_ROS_MASTER_URIS. Implies --frozen-graph, the '
+                             'rl_coach graph is always evaluated one trial after the other. 0 to run the trials one '
+                             'after the other.',
+                        type=int,
+                        default=int(os.environ.get("EVALUATION_WORKERS", 0)))
 
     args = parser.parse_args()
-    data_store_params_instance = S3BotoDataStoreParameters(bucket_name=args.model_s3_bucket,
-                                                           s3_folder=args.model_s3_prefix,
-                                                           checkpoint_dir=args.local_model_directory,
-                                                           aws_region=args.aws_region)
-    data_store = S3BotoDataStore(data_store_params_instance)
+    data_store_params_instance, data_store = create_data_store(args.data_store_url,
+                                                               checkpoint_dir=args.local_model_directory,
+                                                               aws_region=args.aws_region,
+                                                               bucket_name=args.model_s3_bucket,
+                                                               s3_folder=args.model_s3_prefix)
     utils.wait_for_checkpoint(args.local_model_directory, data_store)
 
     preset_file_success = data_store.download_presets_if_present(PRESET_LOCAL_PATH)
@@ -85,6 +144,34 @@ def main():
     else:
         raise ValueError("Unable to determine preset file")
 
+    if args.frozen_graph or args.evaluation_workers:
+        # The results are labelled with the checkpoint the frozen graph was exported from, which is older than the
+        # latest checkpoint when the graph is not exported at every save
+        graph_checkpoint_number = data_store.download_frozen_graph()
+        if graph_checkpoint_number is None and not args.inference_socket:
+            raise ValueError("No frozen graph was published with the checkpoint")
+        if args.evaluation_workers:
+            summary_filename = os.path.join(args.local_model_directory, "evaluation_%s.json" % graph_checkpoint_number)
+            run_evaluation(
+                level=graph_manager.env_params.level,
+                num_workers=args.evaluation_workers,
+                max_trials=args.number_of_trials,
+                summary_filename=summary_filename,
+                model_path=os.path.join(args.local_model_directory, FROZEN_GRAPH_FILENAME),
+                output_head=args.output_head,
+                inference_socket=args.inference_socket
+            )
+            data_store.store_evaluation_summary(summary_filename)
+            return
+        frozen_graph_evaluation_worker(
+            level=graph_manager.env_params.level,
+            number_of_trials=args.number_of_trials,
+            model_path=os.path.join(args.local_model_directory, FROZEN_GRAPH_FILENAME),
+            output_head=args.output_head,
+            inference_socket=args.inference_socket
+        )
+        return
+
     graph_manager.data_store = data_store
     evaluation_worker(
         graph_manager=graph_manager,
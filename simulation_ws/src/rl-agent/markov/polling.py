@@ -0,0 +1,133 @@
+"""
+Polling with jittered exponential backoff, used to wait for data published by another process (checkpoints, the
+IP of the Redis server)
+"""
+import os
+import random
+import time
+
+POLL_INITIAL_INTERVAL_IN_SECOND = 0.5
+POLL_MAX_INTERVAL_IN_SECOND = 10
+POLL_BACKOFF_MULTIPLIER = 2
+POLL_JITTER = 0.25                       # Each interval is randomized by +/- this fraction
+FAST_POLL_INTERVAL_IN_SECOND = 0.2
+FAST_POLL_WINDOW_IN_SECOND = 5
+NOTIFY_FILE_CHECK_INTERVAL_IN_SECOND = 0.05
+
+
+class Poller(object):
+    """
+    Calls a check function until it returns a truthy value. The interval between two checks starts at
+    initial_interval_in_second and grows exponentially up to max_interval_in_second, randomized so that many
+    workers do not poll in lockstep. After expect_event() the checks run every fast_poll_interval_in_second for
+    fast_poll_window_in_second, since the data is likely to show up soon.
+    When the publisher runs on the same node it can touch notify_file with notify(): the poller watches its
+    modification time while sleeping, checks right away when it changes and restarts the backoff.
+    num_checks and wait_time_in_second add up over all the calls to poll().
+    """
+    def __init__(self, name, initial_interval_in_second=POLL_INITIAL_INTERVAL_IN_SECOND,
+                 max_interval_in_second=POLL_MAX_INTERVAL_IN_SECOND, backoff_multiplier=POLL_BACKOFF_MULTIPLIER,
+                 jitter=POLL_JITTER, fast_poll_interval_in_second=FAST_POLL_INTERVAL_IN_SECOND,
+                 fast_poll_window_in_second=FAST_POLL_WINDOW_IN_SECOND, notify_file=None, log_interval_in_second=None):
+        """
+        :param name: What is waited for, used in the log messages
+        :param initial_interval_in_second: Interval between the first two checks
+        :param max_interval_in_second: Upper bound of the interval between two checks
+        :param backoff_multiplier: Factor the interval grows by after every check
+        :param jitter: Fraction the intervals are randomized by
+        :param fast_poll_interval_in_second: Interval between two checks right after expect_event()
+        :param fast_poll_window_in_second: How long to poll at the fast interval after expect_event()
+        :param notify_file: Optional local file the publisher touches when it published new data
+        :param log_interval_in_second: Log that the poller is still waiting this often, None to never log
+        """
+        self.name = name
+        self.initial_interval_in_second = initial_interval_in_second
+        self.max_interval_in_second = max_interval_in_second
+        self.backoff_multiplier = backoff_multiplier
+        self.jitter = jitter
+        self.fast_poll_interval_in_second = fast_poll_interval_in_second
+        self.fast_poll_window_in_second = fast_poll_window_in_second
+        self.notify_file = notify_file
+        self.log_interval_in_second = log_interval_in_second
+        self.num_checks = 0
+        self.wait_time_in_second = 0.0
+        self._fast_poll_until = 0
+
+    def expect_event(self):
+        """
+        Poll at the fast interval for the next fast_poll_window_in_second
+        """
+        self._fast_poll_until = time.time() + self.fast_poll_window_in_second
+
+    def poll(self, check, timeout_in_second=None):
+        """
+        :param check: Function called without arguments, returning a falsy value while the data is not there yet
+        :param timeout_in_second: Maximum time to wait, None to wait forever
+        :return: The first truthy value returned by check, or None if the timeout passed first
+        """
+        start_time = time.time()
+        last_log_time = start_time
+        interval = self.initial_interval_in_second
+        notify_mtime = self._get_notify_mtime()
+        try:
+            while True:
+                self.num_checks += 1
+                result = check()
+                if result:
+                    return result
+
+                now = time.time()
+                if timeout_in_second is not None and now - start_time >= timeout_in_second:
+                    return None
+                if self.log_interval_in_second and now - last_log_time >= self.log_interval_in_second:
+                    print("Waiting for %s... Time elapsed: %.0f seconds" % (self.name, now - start_time))
+                    last_log_time = now
+
+                if now < self._fast_poll_until:
+                    delay = self.fast_poll_interval_in_second
+                else:
+                    delay = interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+                    interval = min(interval * self.backoff_multiplier, self.max_interval_in_second)
+                if timeout_in_second is not None:
+                    delay = min(delay, start_time + timeout_in_second - now)
+
+                new_notify_mtime = self._sleep(delay, notify_mtime)
+                if new_notify_mtime != notify_mtime:
+                    # The publisher signalled new data, check right away and start the backoff over
+                    notify_mtime = new_notify_mtime
+                    interval = self.initial_interval_in_second
+        finally:
+            self.wait_time_in_second += time.time() - start_time
+
+    def _sleep(self, delay, notify_mtime):
+        """
+        Sleep for the delay, returning early if the notify file was touched
+        :return: Modification time of the notify file
+        """
+        if not self.notify_file:
+            time.sleep(delay)
+            return notify_mtime
+        deadline = time.time() + delay
+        while True:
+            mtime = self._get_notify_mtime()
+            remaining = deadline - time.time()
+            if mtime != notify_mtime or remaining <= 0:
+                return mtime
+            time.sleep(min(remaining, NOTIFY_FILE_CHECK_INTERVAL_IN_SECOND))
+
+    def _get_notify_mtime(self):
+        try:
+            return os.stat(self.notify_file).st_mtime_ns if self.notify_file else None
+        except OSError:
+            return None
+
+
+def notify(notify_file):
+    """
+    Signal the pollers watching the file that new data was published
+    :param notify_file: Local file, created if it does not exist
+    """
+    if notify_file:
+        with open(notify_file, 'a'):
+            pass
+        os.utime(notify_file, None)
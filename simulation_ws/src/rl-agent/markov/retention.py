@@ -0,0 +1,44 @@
+"""
+Retention policy deciding which old checkpoints are deleted from the data store
+"""
+import os
+import re
+
+# Files of a checkpoint are named <checkpoint number>_Step-<step>.ckpt...
+CHECKPOINT_FILE_PATTERN = re.compile(r'^(\d+)_Step')
+
+
+class RetentionPolicy(object):
+    """
+    Keeps the keep_last most recent checkpoints and, to preserve a sparse history of the run, every
+    keep_every-th checkpoint. All the other checkpoints are deleted.
+    """
+    def __init__(self, keep_last, keep_every=0):
+        """
+        :param keep_last: Number of most recent checkpoints to keep, 0 to keep every checkpoint
+        :param keep_every: Also keep the checkpoints whose number is a multiple of this, 0 to keep no others
+        """
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+
+    def select_for_deletion(self, checkpoint_numbers):
+        """
+        :param checkpoint_numbers: Numbers of the checkpoints in the data store
+        :return: Sorted list of the checkpoint numbers to delete
+        """
+        if self.keep_last <= 0:
+            return []
+        numbers = sorted(set(checkpoint_numbers))
+        keep = set(numbers[-self.keep_last:])
+        if self.keep_every > 0:
+            keep.update(number for number in numbers if number % self.keep_every == 0)
+        return [number for number in numbers if number not in keep]
+
+
+def get_checkpoint_number(filename):
+    """
+    :param filename: Name or path of a file
+    :return: Number of the checkpoint the file belongs to, None if it is not a checkpoint file
+    """
+    match = CHECKPOINT_FILE_PATTERN.match(os.path.basename(filename))
+    return int(match.group(1)) if match else None
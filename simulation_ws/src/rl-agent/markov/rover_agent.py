@@ -5,7 +5,7 @@ This is single machine training worker. It starts a local training and stores th
 import argparse
 import copy
 
-from markov.s3_boto_data_store import S3BotoDataStore, S3BotoDataStoreParameters
+from markov.data_store_factory import create_data_store
 from rl_coach.base_parameters import TaskParameters, Frameworks
 from rl_coach.utils import short_dynamic_import
 import imp
@@ -67,6 +67,11 @@ def main():
                         help='(string) AWS region',
                         type=str,
                         default=os.environ.get("ROS_AWS_REGION", "us-west-1"))
+    parser.add_argument('--data-store-url',
+                        help='(string) s3://<bucket>/<prefix> or file:///<directory> of the data store the model is '
+                             'stored in. Overrides the S3 bucket and prefix.',
+                        type=str,
+                        default=os.environ.get("DATA_STORE_URL"))
     parser.add_argument('--checkpoint-save-secs',
                         help="(int) Time period in second between 2 checkpoints",
                         type=int,
@@ -93,13 +98,11 @@ def main():
     task_parameters.__dict__['checkpoint_save_dir'] = args.local_model_directory
     task_parameters.__dict__ = add_items_to_dict(task_parameters.__dict__, args.__dict__)
 
-    data_store_params_instance = S3BotoDataStoreParameters(bucket_name=args.model_s3_bucket,
-                                                           s3_folder=args.model_s3_prefix,
-                                                           checkpoint_dir=args.local_model_directory,
-                                                           aws_region=args.aws_region)
-
-
-    data_store = S3BotoDataStore(data_store_params_instance)
+    data_store_params_instance, data_store = create_data_store(args.data_store_url,
+                                                               checkpoint_dir=args.local_model_directory,
+                                                               aws_region=args.aws_region,
+                                                               bucket_name=args.model_s3_bucket,
+                                                               s3_folder=args.model_s3_prefix)
 
     if args.save_frozen_graph:
         data_store.graph_manager = graph_manager
@@ -1,27 +1,91 @@
+import gzip
 import io
 import os
+import tarfile
+import threading
 import time
 import json
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError, HTTPClientError, ConnectionError as BotoConnectionError
 from google.protobuf import text_format
 from tensorflow.python.training.checkpoint_state_pb2 import CheckpointState
 from rl_coach.data_stores.data_store import DataStore, DataStoreParameters
-from markov import utils
+from markov.graph_export import FROZEN_GRAPH_FILENAME, FrozenGraphExporter, get_frozen_graph_name
+from markov.polling import Poller, notify
+from markov.retention import RetentionPolicy, get_checkpoint_number
+from markov.checkpoint_manifest import FileHashCache, MANIFEST_SUFFIX, build_manifest, hash_file, index_by_digest
 
 CHECKPOINT_METADATA_FILENAME="checkpoint"
-SLEEP_TIME_WHILE_WAITING_FOR_DATA_FROM_TRAINER_IN_SECOND = 2
+# Small object written last to publish a checkpoint, readers poll it with conditional GETs
+CHECKPOINT_POINTER_FILENAME = "latest.json"
 IP_KEY = "IP"
 
+# POLLING - readers poll for new checkpoints with a jittered exponential backoff bounded by
+# CHECKPOINT_POLL_MAX_INTERVAL_IN_SECOND, polling faster right after they start waiting for a newer checkpoint.
+# On a single node CHECKPOINT_NOTIFY_FILE can be set to a local file the trainer touches after each publish.
+CHECKPOINT_POLL_MAX_INTERVAL_IN_SECOND = float(os.environ.get("CHECKPOINT_POLL_MAX_INTERVAL_IN_SECOND", 4))
+IP_POLL_MAX_INTERVAL_IN_SECOND = 10
+IP_POLL_LOG_INTERVAL_IN_SECOND = 5
+CHECKPOINT_NOTIFY_FILE = os.environ.get("CHECKPOINT_NOTIFY_FILE")
+
+# CHECKPOINT TRANSFERS - the checkpoint files are uploaded by a pool of S3_UPLOAD_THREADS threads and downloaded by a
+# pool of S3_DOWNLOAD_THREADS threads (1 transfers them one at a time), large files are additionally split into
+# S3_MULTIPART_CHUNKSIZE parts sent in parallel
+MB = 1024 * 1024
+S3_UPLOAD_THREADS = int(os.environ.get("S3_UPLOAD_THREADS", 8))
+S3_DOWNLOAD_THREADS = int(os.environ.get("S3_DOWNLOAD_THREADS", 8))
+S3_MULTIPART_THRESHOLD = int(os.environ.get("S3_MULTIPART_THRESHOLD", 16 * MB))
+S3_MULTIPART_CHUNKSIZE = int(os.environ.get("S3_MULTIPART_CHUNKSIZE", 16 * MB))
+S3_MULTIPART_MAX_CONCURRENCY = int(os.environ.get("S3_MULTIPART_MAX_CONCURRENCY", 4))
+S3_TRANSFER_RETRIES = 3
+
+# BUNDLES - with CHECKPOINT_BUNDLE=true the files of a checkpoint are streamed into a single gzip compressed tar
+# archive uploaded as one object next to the checkpoint, instead of one object per file
+CHECKPOINT_BUNDLE = os.environ.get("CHECKPOINT_BUNDLE", "false").lower() == "true"
+CHECKPOINT_BUNDLE_SUFFIX = ".tar.gz"
+CHECKPOINT_BUNDLE_COMPRESSION_LEVEL = int(os.environ.get("CHECKPOINT_BUNDLE_COMPRESSION_LEVEL", 1))
+
+# RETENTION - after every save the CHECKPOINT_KEEP_LAST most recent checkpoints are kept in S3 (0 keeps all of them),
+# plus every checkpoint whose number is a multiple of CHECKPOINT_KEEP_EVERY (0 keeps no others). The other
+# checkpoints are deleted in the background, in batches of up to S3_MAX_KEYS_PER_DELETE keys.
+CHECKPOINT_KEEP_LAST = int(os.environ.get("CHECKPOINT_KEEP_LAST", 4))
+CHECKPOINT_KEEP_EVERY = int(os.environ.get("CHECKPOINT_KEEP_EVERY", 0))
+S3_MAX_KEYS_PER_DELETE = 1000
+
+# S3 CLIENT - a single client is shared by all the threads of a data store, its connection pool is sized for the
+# concurrent transfers. It is only rebuilt after a connection error, after a call failed with expired credentials, or
+# S3_CREDENTIALS_EXPIRY_MARGIN_IN_SECOND before the temporary credentials it was built with expire.
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get("S3_MAX_POOL_CONNECTIONS",
+                                             max(10, max(S3_UPLOAD_THREADS, S3_DOWNLOAD_THREADS) *
+                                                 S3_MULTIPART_MAX_CONCURRENCY)))
+CREDENTIALS_EXPIRED_ERROR_CODES = ("ExpiredToken", "ExpiredTokenException", "RequestExpired", "InvalidToken")
+S3_CREDENTIALS_EXPIRY_MARGIN_IN_SECOND = 300
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")  # e.g. a local S3 stand-in such as moto_server or MinIO
+
 
 class S3BotoDataStoreParameters(DataStoreParameters):
     def __init__(self, aws_region: str = "us-east-1", bucket_name: str = None, s3_folder: str = None,
-                 checkpoint_dir: str = None):
+                 checkpoint_dir: str = None, upload_threads: int = S3_UPLOAD_THREADS,
+                 download_threads: int = S3_DOWNLOAD_THREADS, endpoint_url: str = S3_ENDPOINT_URL,
+                 notify_file: str = CHECKPOINT_NOTIFY_FILE, keep_last: int = CHECKPOINT_KEEP_LAST,
+                 keep_every: int = CHECKPOINT_KEEP_EVERY, bundle: bool = CHECKPOINT_BUNDLE):
         super().__init__("s3", "", "")
         self.aws_region = aws_region
         self.bucket = bucket_name
         self.s3_folder = s3_folder
         self.checkpoint_dir = checkpoint_dir
-        self.lock_file = ".lock"
+        self.upload_threads = upload_threads
+        self.download_threads = download_threads
+        self.endpoint_url = endpoint_url
+        self.notify_file = notify_file
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.bundle = bundle
 
 
 class S3BotoDataStore(DataStore):
@@ -32,6 +96,29 @@ class S3BotoDataStore(DataStore):
         self.ip_done_key = os.path.join(self.params.s3_folder, "ip/done")
         self.preset_data_prefix = os.path.join(self.params.s3_folder, "presets/")
         self.environment_data_prefix = os.path.join(self.params.s3_folder, "environments/")
+        self.num_clients_created = 0
+        self.num_client_cache_hits = 0
+        self._client = None
+        self._credentials_expiry = None
+        self._client_lock = threading.Lock()
+        self._hash_cache = FileHashCache()
+        self._remote_digests = None
+        self._remote_digests_lock = threading.Lock()
+        self.retention_policy = RetentionPolicy(self.params.keep_last, self.params.keep_every)
+        self._retention_executor = ThreadPoolExecutor(max_workers=1)
+        self._pointer = None
+        self._pointer_etag = None
+        self._downloaded_checkpoint = None
+        self._graph_exporter = None
+        self._frozen_graph = None
+        self.checkpoint_poller = Poller("checkpoint", max_interval_in_second=CHECKPOINT_POLL_MAX_INTERVAL_IN_SECOND,
+                                        notify_file=self.params.notify_file)
+        self.ip_poller = Poller("SageMaker Redis server IP", max_interval_in_second=IP_POLL_MAX_INTERVAL_IN_SECOND,
+                                notify_file=self.params.notify_file,
+                                log_interval_in_second=IP_POLL_LOG_INTERVAL_IN_SECOND)
+        self.transfer_config = TransferConfig(multipart_threshold=S3_MULTIPART_THRESHOLD,
+                                              multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+                                              max_concurrency=S3_MULTIPART_MAX_CONCURRENCY)
 
     def deploy(self) -> bool:
         return True
@@ -43,116 +130,139 @@ class S3BotoDataStore(DataStore):
         return True
 
     def save_to_store(self):
+        """
+        Publish the checkpoint: the files of a checkpoint have names unique to it and are never modified once
+        uploaded, and the checkpoint only becomes visible to the readers when the pointer object is written last
+        """
         try:
             s3_client = self._get_client()
+            checkpoint = self._get_current_checkpoint()
 
+            graph_filenames = ()
             if self.graph_manager:
-                utils.write_frozen_graph(self.graph_manager, self.params.checkpoint_dir)
-
-            # Delete any existing lock file
-            s3_client.delete_object(Bucket=self.params.bucket, Key=self._get_s3_key(self.params.lock_file))
-
-            # We take a lock by writing a lock file to the same location in S3
-            s3_client.upload_fileobj(Fileobj=io.BytesIO(b''),
-                                     Bucket=self.params.bucket,
-                                     Key=self._get_s3_key(self.params.lock_file))
-
-            # Start writing the model checkpoints to S3
-            checkpoint_file = None
-            for root, dirs, files in os.walk(self.params.checkpoint_dir):
-                for filename in files:
-                    # Skip the checkpoint file that has the latest checkpoint number
-                    if filename == CHECKPOINT_METADATA_FILENAME:
-                        checkpoint_file = (root, filename)
-                        continue
-
-                    # Upload all the other files from the checkpoint directory
-                    abs_name = os.path.abspath(os.path.join(root, filename))
-                    rel_name = os.path.relpath(abs_name, self.params.checkpoint_dir)
-                    s3_client.upload_file(Filename=abs_name,
-                                          Bucket=self.params.bucket,
-                                          Key=self._get_s3_key(rel_name))
-
-            # After all the checkpoint files have been uploaded, we upload the version file.
-            abs_name = os.path.abspath(os.path.join(checkpoint_file[0], checkpoint_file[1]))
-            rel_name = os.path.relpath(abs_name, self.params.checkpoint_dir)
-            s3_client.upload_file(Filename=abs_name,
-                                  Bucket=self.params.bucket,
-                                  Key=self._get_s3_key(rel_name))
-
-            # Release the lock by deleting the lock file from S3
-            s3_client.delete_object(Bucket=self.params.bucket, Key=self._get_s3_key(self.params.lock_file))
+                # The frozen graph is converted in the background while the checkpoint files are uploaded, and
+                # uploaded after them
+                if self._graph_exporter is None:
+                    self._graph_exporter = FrozenGraphExporter(self.graph_manager, self.params.checkpoint_dir)
+                self._graph_exporter.export(self._get_checkpoint_number(checkpoint) if checkpoint else None)
+                graph_filenames = tuple(self._graph_exporter.filenames)
+
+            # Start writing the model checkpoints to S3, only the files whose content is not in S3 yet are uploaded
+            start_time = time.time()
+            manifest = build_manifest(self.params.checkpoint_dir, self._hash_cache,
+                                      exclude=(CHECKPOINT_METADATA_FILENAME,) + graph_filenames)
+            # Older checkpoints still on disk that the retention policy does not keep are not uploaded
+            checkpoint_numbers = [get_checkpoint_number(rel_name) for rel_name in manifest]
+            expired = set(self.retention_policy.select_for_deletion(
+                [checkpoint_number for checkpoint_number in checkpoint_numbers if checkpoint_number is not None]))
+            manifest = {rel_name: entry for rel_name, entry in manifest.items()
+                        if get_checkpoint_number(rel_name) not in expired}
+            if self._remote_digests is None:
+                self._remote_digests = self._load_remote_digests()
+            bundled_files = {}
+            if self.params.bundle and checkpoint:
+                # The files of checkpoints are uploaded in bundles, only the other files are uploaded one by one
+                bundled_files = {rel_name: entry for rel_name, entry in manifest.items()
+                                 if rel_name.startswith(checkpoint.model_checkpoint_path)}
+                manifest = {rel_name: entry for rel_name, entry in manifest.items()
+                            if get_checkpoint_number(rel_name) is None}
+            num_files, num_bytes = self._upload_manifest(manifest)
+            bundle_key = None
+            if bundled_files:
+                bundle_key = self._get_s3_key(checkpoint.model_checkpoint_path + CHECKPOINT_BUNDLE_SUFFIX)
+                num_bytes += self._upload_bundle(sorted(bundled_files), bundle_key)
+
+            if self._graph_exporter:
+                export = self._graph_exporter.wait()
+                if checkpoint and export and export["files"] and \
+                        export["checkpoint_number"] == self._get_checkpoint_number(checkpoint):
+                    # The frozen graph is uploaded under the name of its checkpoint, so it is never modified either
+                    graph_manifest = {filename: self._get_manifest_entry(filename) for filename in export["files"]}
+                    names = {filename: get_frozen_graph_name(checkpoint.model_checkpoint_path, filename)
+                             for filename in export["files"]}
+                    num_graph_files, num_graph_bytes = self._upload_manifest(graph_manifest, names)
+                    num_files += num_graph_files
+                    num_bytes += num_graph_bytes
+                    self._frozen_graph = {"checkpoint_number": export["checkpoint_number"],
+                                          "files": {filename: dict(entry, key=names[filename])
+                                                    for filename, entry in graph_manifest.items()}}
+            if self._frozen_graph:
+                manifest.update({entry["key"]: {"size": entry["size"], "sha256": entry["sha256"]}
+                                 for entry in self._frozen_graph["files"].values()})
+
+            # The version file is still uploaded for the tools reading it directly
+            metadata_filename = os.path.abspath(os.path.join(self.params.checkpoint_dir, CHECKPOINT_METADATA_FILENAME))
+            num_bytes += self._upload_file(metadata_filename, self._get_s3_key(CHECKPOINT_METADATA_FILENAME))
 
-            checkpoint = self._get_current_checkpoint()
             if checkpoint:
-                checkpoint_number = self._get_checkpoint_number(checkpoint)
-                checkpoint_number_to_delete = checkpoint_number - 4
-
-                # List all the old checkpoint files that needs to be deleted
-                response = s3_client.list_objects_v2(Bucket=self.params.bucket,
-                                                     Prefix=self._get_s3_key(str(checkpoint_number_to_delete) + "_"))
-                if "Contents" in response:
-                    num_files = 0
-                    for obj in response["Contents"]:
-                        s3_client.delete_object(Bucket=self.params.bucket,
-                                                Key=obj["Key"])
-                        num_files += 1
-
-                    print("Deleted %s model files from S3" % num_files)
-                    return True
+                # The manifest is stored next to the checkpoint, so that a restarted trainer knows what is in S3
+                manifest_key = self._get_s3_key(checkpoint.model_checkpoint_path + MANIFEST_SUFFIX)
+                s3_client.put_object(Bucket=self.params.bucket,
+                                     Key=manifest_key,
+                                     Body=json.dumps({"checkpoint": checkpoint.model_checkpoint_path,
+                                                      "files": manifest}).encode())
+
+                # After all the checkpoint files have been uploaded, we commit the checkpoint by writing the pointer
+                with open(metadata_filename) as f:
+                    metadata = f.read()
+                pointer = {"checkpoint": checkpoint.model_checkpoint_path,
+                           "metadata": metadata,
+                           "manifest": manifest_key,
+                           "bundle": bundle_key,
+                           "files": bundled_files or {rel_name: entry for rel_name, entry in manifest.items()
+                                                      if rel_name.startswith(checkpoint.model_checkpoint_path)},
+                           "frozen_graph": self._frozen_graph}
+                s3_client.put_object(Bucket=self.params.bucket,
+                                     Key=self._get_s3_key(CHECKPOINT_POINTER_FILENAME),
+                                     Body=json.dumps(pointer).encode())
+                notify(self.params.notify_file)
+            print("Uploaded %s model files (%s bytes) to S3 in %.2f seconds, %s files were already in S3" %
+                  (num_files + len(bundled_files) + 1, num_bytes, time.time() - start_time, len(manifest) - num_files))
+
+            # Old checkpoints are deleted in the background so that the save does not wait for it
+            if checkpoint:
+                self._retention_executor.submit(self._delete_old_checkpoints, self._get_checkpoint_number(checkpoint))
         except Exception as e:
             raise e
 
     def load_from_store(self, expected_checkpoint_number=-1):
         try:
-            filename = os.path.abspath(os.path.join(self.params.checkpoint_dir, CHECKPOINT_METADATA_FILENAME))
             if not os.path.exists(self.params.checkpoint_dir):
                 os.makedirs(self.params.checkpoint_dir)
 
-            while True:
-                s3_client = self._get_client()
-                response = s3_client.list_objects_v2(Bucket=self.params.bucket,
-                                                     Prefix=self._get_s3_key(self.params.lock_file))
-
-                if "Contents" not in response:
-                    try:
-                        # If no lock is found, try getting the checkpoint
-                        s3_client.download_file(Bucket=self.params.bucket,
-                                                Key=self._get_s3_key(CHECKPOINT_METADATA_FILENAME),
-                                                Filename=filename)
-                    except Exception as e:
-                        print("Got exception while downloading checkpoint", e)
-                        time.sleep(SLEEP_TIME_WHILE_WAITING_FOR_DATA_FROM_TRAINER_IN_SECOND)
-                        continue
-                else:
-                    time.sleep(SLEEP_TIME_WHILE_WAITING_FOR_DATA_FROM_TRAINER_IN_SECOND)
-                    continue
-
-                checkpoint = self._get_current_checkpoint()
-                if checkpoint:
-                    checkpoint_number = self._get_checkpoint_number(checkpoint)
-
-                    # if we get a checkpoint that is older that the expected checkpoint, we wait for
-                    #  the new checkpoint to arrive.
-                    if checkpoint_number < expected_checkpoint_number:
-                        time.sleep(SLEEP_TIME_WHILE_WAITING_FOR_DATA_FROM_TRAINER_IN_SECOND)
-                        continue
-
-                    # Found a checkpoint to be downloaded
-                    response = s3_client.list_objects_v2(Bucket=self.params.bucket,
-                                                         Prefix=self._get_s3_key(checkpoint.model_checkpoint_path))
-                    if "Contents" in response:
-                        num_files = 0
-                        for obj in response["Contents"]:
-                            # Get the local filename of the checkpoint file
-                            filename = os.path.abspath(os.path.join(self.params.checkpoint_dir,
-                                                                    obj["Key"].replace(self.key_prefix, "")))
-                            s3_client.download_file(Bucket=self.params.bucket,
-                                                    Key=obj["Key"],
-                                                    Filename=filename)
-                            num_files += 1
-                        print("Downloaded %s model files from S3" % num_files)
-                        return True
+            def get_expected_checkpoint():
+                # Wait until the trainer published a checkpoint that is at least the expected checkpoint
+                pointer = self._get_checkpoint_pointer()
+                if pointer and self._get_checkpoint_number(pointer["checkpoint"]) >= expected_checkpoint_number:
+                    return pointer
+                return None
+
+            if self._downloaded_checkpoint and \
+                    self._get_checkpoint_number(self._downloaded_checkpoint) < expected_checkpoint_number:
+                # The trainer is about to publish the next checkpoint
+                self.checkpoint_poller.expect_event()
+            num_checks, wait_time = self.checkpoint_poller.num_checks, self.checkpoint_poller.wait_time_in_second
+            pointer = self.checkpoint_poller.poll(get_expected_checkpoint)
+            print("Found checkpoint %s after %.2f seconds and %s requests" %
+                  (pointer["checkpoint"], self.checkpoint_poller.wait_time_in_second - wait_time,
+                   self.checkpoint_poller.num_checks - num_checks))
+
+            if self._downloaded_checkpoint == pointer["checkpoint"]:
+                return True
+
+            # The checkpoint is downloaded next to the checkpoint directory and only moved into it once every
+            # file arrived, the metadata file last, so a partially downloaded checkpoint is never visible
+            download_dir = tempfile.mkdtemp(prefix=".checkpoint-download-",
+                                            dir=os.path.dirname(os.path.abspath(self.params.checkpoint_dir)))
+            try:
+                with open(os.path.join(download_dir, CHECKPOINT_METADATA_FILENAME), 'w') as f:
+                    f.write(pointer["metadata"])
+                digests = {rel_name: entry["sha256"] for rel_name, entry in pointer["files"].items()}
+                self._download_checkpoint(digests, download_dir, pointer.get("bundle"))
+                self._downloaded_checkpoint = pointer["checkpoint"]
+                return True
+            finally:
+                shutil.rmtree(download_dir, ignore_errors=True)
 
         except Exception as e:
             print("Got exception while loading model from S3", e)
@@ -166,6 +276,14 @@ class S3BotoDataStore(DataStore):
         ip_done_file_object = io.BytesIO(b'done')
         s3_client.upload_fileobj(ip_data_file_object, self.params.bucket, self.ip_data_key)
         s3_client.upload_fileobj(ip_done_file_object, self.params.bucket, self.ip_done_key)
+        notify(self.params.notify_file)
+
+    def store_evaluation_summary(self, filename):
+        """
+        Upload the summary of an evaluation next to the checkpoints, under the name of the file. The retention
+        policy does not delete it.
+        """
+        self._upload_file(filename, self._get_s3_key(os.path.basename(filename)))
 
     def get_ip(self):
         self._wait_for_ip_upload()
@@ -184,20 +302,48 @@ class S3BotoDataStore(DataStore):
     def download_environments_if_present(self, local_path):
         return self._download_directory(self.params.bucket, self.environment_data_prefix, local_path)
 
+    def download_frozen_graph(self):
+        """
+        Download the frozen graph listed in the pointer to the latest checkpoint into the checkpoint directory,
+        unless the one already there has the same content
+        :return: Number of the checkpoint the graph was exported from, None if no graph was published
+        """
+        pointer = self._get_checkpoint_pointer()
+        frozen_graph = pointer.get("frozen_graph") if pointer else None
+        if not frozen_graph or FROZEN_GRAPH_FILENAME not in frozen_graph["files"]:
+            return None
+        entry = frozen_graph["files"][FROZEN_GRAPH_FILENAME]
+        if self._hash_cache.matches(os.path.join(self.params.checkpoint_dir, FROZEN_GRAPH_FILENAME), entry["sha256"]):
+            return frozen_graph["checkpoint_number"]
+        download_dir = tempfile.mkdtemp(prefix=".checkpoint-download-",
+                                        dir=os.path.dirname(os.path.abspath(self.params.checkpoint_dir)))
+        try:
+            filename = os.path.join(download_dir, FROZEN_GRAPH_FILENAME)
+            self._download_file(self._get_s3_key(entry["key"]), filename)
+            if hash_file(filename) != entry["sha256"]:
+                raise ValueError("The content of %s does not match the pointer" % entry["key"])
+            self._move_into_checkpoint_dir(download_dir, FROZEN_GRAPH_FILENAME)
+            self._hash_cache.put(os.path.join(self.params.checkpoint_dir, FROZEN_GRAPH_FILENAME), entry["sha256"])
+            return frozen_graph["checkpoint_number"]
+        except Exception as e:
+            print("Got exception while downloading the frozen graph %s" % entry["key"], e)
+            return None
+        finally:
+            shutil.rmtree(download_dir, ignore_errors=True)
+
     def get_current_checkpoint_number(self):
         return self._get_checkpoint_number(self._get_current_checkpoint())
 
     def _download_directory(self, s3_bucket, s3_prefix, local_path):
         s3_client = self._get_client()
-        response = s3_client.list_objects_v2(Bucket=s3_bucket,
-                                             Prefix=s3_prefix)
+        objects = list(self._list_objects(s3_client, s3_prefix, bucket=s3_bucket))
 
-        if "Contents" not in response:
+        if not objects:
             return False
 
-        if "Contents" in response:
+        if objects:
             try:
-                for obj in response["Contents"]:
+                for obj in objects:
                     filename = os.path.abspath(os.path.join(local_path,
                                                             obj["Key"].replace(s3_prefix, "")))
                     if s3_client.download_file(Bucket=s3_bucket, Key=obj["Key"], Filename=filename) == False:
@@ -210,31 +356,405 @@ class S3BotoDataStore(DataStore):
 
         return True
 
+    def _download_checkpoint(self, digests, download_dir, bundle_key=None):
+        """
+        Download the files of a checkpoint that are not present locally into download_dir, then move them and the
+        metadata file into the checkpoint directory. Files whose content is already in the checkpoint directory
+        under another name are copied locally.
+        :param digests: Dict mapping the files of the checkpoint to the digest of their content
+        :param download_dir: Directory holding the metadata file of the checkpoint
+        :param bundle_key: S3 key of the archive holding all the files of the checkpoint, if it was bundled
+        """
+        start_time = time.time()
+        rel_names = [rel_name for rel_name, digest in digests.items()
+                     if not self._hash_cache.matches(os.path.join(self.params.checkpoint_dir, rel_name), digest)]
+        downloads = []
+        if bundle_key and rel_names:
+            num_bytes = self._download_bundle(bundle_key, download_dir)
+            downloads = rel_names
+        else:
+            local_files = index_by_digest(self.params.checkpoint_dir, self._hash_cache)
+            for rel_name in rel_names:
+                filename = os.path.join(download_dir, rel_name)
+                if digests[rel_name] in local_files:
+                    os.makedirs(os.path.dirname(filename), exist_ok=True)
+                    shutil.copyfile(local_files[digests[rel_name]], filename)
+                else:
+                    downloads.append((self._get_s3_key(rel_name), filename))
+            num_bytes = self._download_files(downloads)
+
+        for rel_name in rel_names + [CHECKPOINT_METADATA_FILENAME]:
+            self._move_into_checkpoint_dir(download_dir, rel_name)
+            if rel_name in digests:
+                self._hash_cache.put(os.path.join(self.params.checkpoint_dir, rel_name), digests[rel_name])
+        print("Downloaded %s model files (%s bytes) from S3 in %.2f seconds, %s files were already present" %
+              (len(downloads), num_bytes, time.time() - start_time, len(digests) - len(rel_names)))
+
+    def _upload_manifest(self, manifest, names=None):
+        """
+        Upload the files of the checkpoint directory listed in the manifest whose content is not in S3 under their
+        key yet. A file whose content is in S3 under another key is copied there instead of uploaded.
+        :param manifest: Dict mapping files relative to the checkpoint directory to their size and sha256
+        :param names: Dict mapping files of the manifest to the name they are uploaded under, defaults to their own
+        :return: Tuple of the number of files uploaded or copied and the number of bytes uploaded
+        """
+        names = names or {}
+        with self._remote_digests_lock:
+            remote_digests = dict(self._remote_digests)
+        keys_by_digest = {digest: key for key, digest in remote_digests.items()}
+        uploads = []
+        copies = []
+        for rel_name, entry in manifest.items():
+            abs_name = os.path.abspath(os.path.join(self.params.checkpoint_dir, rel_name))
+            key = self._get_s3_key(names.get(rel_name, rel_name))
+            if remote_digests.get(key) == entry["sha256"]:
+                continue
+            if entry["sha256"] in keys_by_digest:
+                # The same content is in S3 under another name, copy it there instead of uploading it
+                copies.append((keys_by_digest[entry["sha256"]], key, abs_name))
+            else:
+                uploads.append((abs_name, key))
+        num_bytes = self._upload_files(uploads)
+        num_bytes += self._copy_objects(copies)
+        with self._remote_digests_lock:
+            for rel_name, entry in manifest.items():
+                self._remote_digests[self._get_s3_key(names.get(rel_name, rel_name))] = entry["sha256"]
+        return len(uploads) + len(copies), num_bytes
+
+    def _get_manifest_entry(self, rel_name):
+        """
+        :return: Size and sha256 of a file of the checkpoint directory, as listed in a manifest
+        """
+        filename = os.path.join(self.params.checkpoint_dir, rel_name)
+        return {"size": os.path.getsize(filename), "sha256": self._hash_cache.get(filename)}
+
+    def _upload_bundle(self, rel_names, key):
+        """
+        Stream files of the checkpoint directory into a gzip compressed tar archive uploaded as a single object.
+        The archive is written to a pipe by another thread and uploaded in multipart chunks while it is being
+        written, so only a few chunks are held in memory.
+        :param rel_names: Files to bundle, relative to the checkpoint directory
+        :param key: S3 key of the archive
+        :return: Size of the archive in bytes
+        """
+        for attempt in range(S3_TRANSFER_RETRIES):
+            read_fd, write_fd = os.pipe()
+            archive = _StreamReader(os.fdopen(read_fd, 'rb'))
+            errors = []
+
+            def write_archive():
+                try:
+                    with os.fdopen(write_fd, 'wb') as pipe, \
+                            gzip.GzipFile(fileobj=pipe, mode='wb',
+                                          compresslevel=CHECKPOINT_BUNDLE_COMPRESSION_LEVEL) as compressed, \
+                            tarfile.open(fileobj=compressed, mode='w|') as tar:
+                        for rel_name in rel_names:
+                            tar.add(os.path.join(self.params.checkpoint_dir, rel_name), arcname=rel_name)
+                except Exception as e:
+                    errors.append(e)
+
+            writer = threading.Thread(target=write_archive, name="bundle-writer")
+            writer.start()
+            try:
+                self._get_client().upload_fileobj(Fileobj=archive,
+                                                  Bucket=self.params.bucket,
+                                                  Key=key,
+                                                  Config=self.transfer_config)
+                return archive.num_bytes
+            except Exception as e:
+                if attempt == S3_TRANSFER_RETRIES - 1:
+                    raise e
+                print("Got exception while uploading %s, retrying" % key, e)
+                self._reset_client_after_error(e)
+                time.sleep(2 ** attempt)
+            finally:
+                # Closing the read end also stops the writer if the upload failed half way
+                archive.close()
+                writer.join()
+                if errors and not isinstance(errors[0], BrokenPipeError):
+                    raise errors[0]
+
+    def _download_bundle(self, key, download_dir):
+        """
+        Stream a bundle from S3 and extract its files into download_dir without holding the archive in memory
+        :return: Size of the archive in bytes
+        """
+        for attempt in range(S3_TRANSFER_RETRIES):
+            try:
+                response = self._get_client().get_object(Bucket=self.params.bucket, Key=key)
+                with tarfile.open(fileobj=response["Body"], mode='r|gz') as tar:
+                    for member in tar:
+                        # Only extract regular files inside the download directory
+                        if not member.isfile() or os.path.isabs(member.name) or '..' in member.name.split('/'):
+                            continue
+                        tar.extract(member, download_dir)
+                return response["ContentLength"]
+            except Exception as e:
+                if attempt == S3_TRANSFER_RETRIES - 1:
+                    raise e
+                print("Got exception while downloading %s, retrying" % key, e)
+                self._reset_client_after_error(e)
+                time.sleep(2 ** attempt)
+
+    def _get_checkpoint_pointer(self):
+        """
+        Fetch the pointer to the latest checkpoint with a conditional GET, which does not transfer it again if it
+        did not change since the last call
+        :return: The pointer, None if no checkpoint was published yet
+        """
+        s3_client = self._get_client()
+        try:
+            kwargs = {"IfNoneMatch": self._pointer_etag} if self._pointer_etag else {}
+            response = s3_client.get_object(Bucket=self.params.bucket,
+                                            Key=self._get_s3_key(CHECKPOINT_POINTER_FILENAME),
+                                            **kwargs)
+            self._pointer = json.loads(response["Body"].read().decode())
+            self._pointer_etag = response["ETag"]
+        except ClientError as e:
+            error_code = e.response.get("Error", {}).get("Code")
+            if error_code in ("304", "NotModified"):
+                return self._pointer
+            if error_code not in ("NoSuchKey", "404"):
+                print("Got exception while getting the latest checkpoint from S3", e)
+                self._reset_client_after_error(e)
+            return None
+        return self._pointer
+
+    def _get_manifest(self, manifest_key):
+        """
+        :return: The manifest stored at the key, None if there is none
+        """
+        try:
+            response = self._get_client().get_object(Bucket=self.params.bucket, Key=manifest_key)
+            return json.loads(response["Body"].read().decode())
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            raise e
+
+    def _load_remote_digests(self):
+        """
+        :return: Dict mapping the S3 keys listed in the manifest of the latest published checkpoint to the digest
+                 of their content, empty if no checkpoint was published yet
+        """
+        pointer = self._get_checkpoint_pointer()
+        manifest = self._get_manifest(pointer["manifest"]) if pointer else None
+        if not manifest:
+            return {}
+        return {self._get_s3_key(rel_name): entry["sha256"] for rel_name, entry in manifest["files"].items()}
+
+    def _delete_old_checkpoints(self, current_checkpoint_number):
+        """
+        Delete every checkpoint in S3 that the retention policy does not keep, including the ones left behind by
+        earlier runs. The checkpoint just published is always kept, even when a restarted run numbers it below the
+        checkpoints left by the previous run, and so are the files of the frozen graph the pointer lists.
+        """
+        try:
+            start_time = time.time()
+            s3_client = self._get_client()
+            frozen_graph = self._frozen_graph
+            graph_keys = set(self._get_s3_key(entry["key"]) for entry in frozen_graph["files"].values()) \
+                if frozen_graph else set()
+            keys_by_checkpoint = {}
+            for obj in self._list_objects(s3_client, self.key_prefix):
+                checkpoint_number = get_checkpoint_number(obj["Key"])
+                if checkpoint_number is not None and obj["Key"] not in graph_keys:
+                    keys_by_checkpoint.setdefault(checkpoint_number, []).append(obj["Key"])
+            checkpoint_numbers = [checkpoint_number
+                                  for checkpoint_number in self.retention_policy.select_for_deletion(keys_by_checkpoint)
+                                  if checkpoint_number != current_checkpoint_number]
+            keys = [key for checkpoint_number in checkpoint_numbers for key in keys_by_checkpoint[checkpoint_number]]
+
+            num_files = 0
+            for start in range(0, len(keys), S3_MAX_KEYS_PER_DELETE):
+                batch = keys[start:start + S3_MAX_KEYS_PER_DELETE]
+                response = s3_client.delete_objects(Bucket=self.params.bucket,
+                                                     Delete={"Objects": [{"Key": key} for key in batch],
+                                                             "Quiet": True})
+                errors = response.get("Errors", [])
+                for error in errors:
+                    print("Failed deleting object, Key ", error.get("Key"), error.get("Message"))
+                num_files += len(batch) - len(errors)
+                with self._remote_digests_lock:
+                    for key in batch:
+                        self._remote_digests.pop(key, None)
+
+            if keys:
+                print("Deleted %s model files of %s checkpoints from S3 in %.2f seconds" %
+                      (num_files, len(checkpoint_numbers), time.time() - start_time))
+        except Exception as e:
+            print("Got exception while deleting old checkpoints from S3", e)
+            self._reset_client_after_error(e)
+
+    def _copy_objects(self, copies):
+        """
+        Copy objects within the bucket with a pool of upload_threads threads
+        :param copies: List of (source S3 key, destination S3 key, local filename with the same content) tuples
+        :return: Total number of bytes uploaded because the source object was gone
+        """
+        if not copies:
+            return 0
+        num_threads = max(1, min(self.params.upload_threads, len(copies)))
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            futures = [executor.submit(self._copy_object, source_key, key, filename)
+                       for source_key, key, filename in copies]
+            return sum(future.result() for future in futures)
+
+    def _copy_object(self, source_key, key, filename):
+        """
+        Copy an object within the bucket, falling back to uploading the local file if the copy fails
+        :return: Number of bytes uploaded
+        """
+        try:
+            self._get_client().copy(CopySource={"Bucket": self.params.bucket, "Key": source_key},
+                                    Bucket=self.params.bucket,
+                                    Key=key,
+                                    Config=self.transfer_config)
+            return 0
+        except Exception as e:
+            print("Got exception while copying %s to %s, uploading it instead" % (source_key, key), e)
+            self._reset_client_after_error(e)
+            return self._upload_file(filename, key)
+
+    def _upload_files(self, files):
+        """
+        Upload files with a pool of upload_threads threads
+        :param files: List of (local filename, S3 key) tuples
+        :return: Total number of bytes uploaded
+        """
+        if not files:
+            return 0
+        num_threads = max(1, min(self.params.upload_threads, len(files)))
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            futures = [executor.submit(self._upload_file, filename, key) for filename, key in files]
+            return sum(future.result() for future in futures)
+
+    def _upload_file(self, filename, key):
+        """
+        Upload a file, retrying failed attempts
+        :return: Number of bytes uploaded
+        """
+        for attempt in range(S3_TRANSFER_RETRIES):
+            try:
+                self._get_client().upload_file(Filename=filename,
+                                               Bucket=self.params.bucket,
+                                               Key=key,
+                                               Config=self.transfer_config)
+                return os.path.getsize(filename)
+            except Exception as e:
+                if attempt == S3_TRANSFER_RETRIES - 1:
+                    raise e
+                print("Got exception while uploading %s, retrying" % key, e)
+                self._reset_client_after_error(e)
+                time.sleep(2 ** attempt)
+
+    def _download_files(self, files):
+        """
+        Download files with a pool of download_threads threads
+        :param files: List of (S3 key, local filename) tuples
+        :return: Total number of bytes downloaded
+        """
+        if not files:
+            return 0
+        num_threads = max(1, min(self.params.download_threads, len(files)))
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            futures = [executor.submit(self._download_file, key, filename) for key, filename in files]
+            return sum(future.result() for future in futures)
+
+    def _download_file(self, key, filename):
+        """
+        Download a file, retrying failed attempts
+        :return: Number of bytes downloaded
+        """
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        for attempt in range(S3_TRANSFER_RETRIES):
+            try:
+                self._get_client().download_file(Bucket=self.params.bucket,
+                                                 Key=key,
+                                                 Filename=filename,
+                                                 Config=self.transfer_config)
+                return os.path.getsize(filename)
+            except Exception as e:
+                if attempt == S3_TRANSFER_RETRIES - 1:
+                    raise e
+                print("Got exception while downloading %s, retrying" % key, e)
+                self._reset_client_after_error(e)
+                time.sleep(2 ** attempt)
+
+    def _move_into_checkpoint_dir(self, download_dir, rel_name):
+        """
+        Atomically replace a file of the checkpoint directory with its downloaded version
+        """
+        filename = os.path.join(self.params.checkpoint_dir, rel_name)
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        os.replace(os.path.join(download_dir, rel_name), filename)
+
+    def _list_objects(self, s3_client, prefix, bucket=None):
+        """
+        :return: Iterator over all the objects under the prefix, following list_objects_v2 pagination
+        """
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket or self.params.bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                yield obj
+
     def _get_s3_key(self, key):
         return os.path.normpath(os.path.join(self.key_prefix, key))
 
     def _get_client(self):
-        session = boto3.session.Session()
-        return session.client('s3', region_name=self.params.aws_region)
+        """
+        :return: The S3 client shared by all the threads of this data store, built on first use and rebuilt shortly
+                 before its credentials expire
+        """
+        with self._client_lock:
+            expiring = self._credentials_expiry is not None and \
+                time.time() >= self._credentials_expiry - S3_CREDENTIALS_EXPIRY_MARGIN_IN_SECOND
+            if expiring:
+                self._client = None
+            if self._client is None:
+                session = boto3.session.Session()
+                self._client = session.client('s3', region_name=self.params.aws_region,
+                                              endpoint_url=self.params.endpoint_url,
+                                              config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS))
+                credentials_expiry = get_credentials_expiry(session)
+                if expiring and credentials_expiry is not None and credentials_expiry <= self._credentials_expiry:
+                    # The session has no fresher credentials, only a failed call rebuilds the client from now on
+                    credentials_expiry = None
+                self._credentials_expiry = credentials_expiry
+                self.num_clients_created += 1
+            else:
+                self.num_client_cache_hits += 1
+            return self._client
+
+    def _reset_client(self):
+        """
+        Drop the shared client, the next call to _get_client() builds a new one with fresh credentials and connections
+        """
+        with self._client_lock:
+            self._client = None
+
+    def _reset_client_after_error(self, error):
+        """
+        Drop the shared client if the error was caused by its connections or its expired credentials
+        """
+        if isinstance(error, (BotoConnectionError, HTTPClientError)):
+            self._reset_client()
+        elif isinstance(error, ClientError) and \
+                error.response.get("Error", {}).get("Code") in CREDENTIALS_EXPIRED_ERROR_CODES:
+            self._reset_client()
 
     def _wait_for_ip_upload(self, timeout_in_second=600):
-        start_time = time.time()
-        s3_client = self._get_client()
-        while True:
-            response = s3_client.list_objects(Bucket=self.params.bucket, Prefix=self.ip_done_key)
-            if "Contents" not in response:
-                time.sleep(SLEEP_TIME_WHILE_WAITING_FOR_DATA_FROM_TRAINER_IN_SECOND)
-
-                time_elapsed_in_second = time.time() - start_time
-                if time_elapsed_in_second % 5 == 0:
-                    print("Waiting for SageMaker Redis server IP... Time elapsed: %s seconds" % time_elapsed_in_second)
-                if time_elapsed_in_second % 300 == 0:
-                    # Recreate the client with new credential every 5 minutes
-                    s3_client = self._get_client()
-                if time_elapsed_in_second >= timeout_in_second:
-                    raise RuntimeError("Cannot retrieve IP of redis server running in SageMaker")
-            else:
-                break
+        def is_ip_uploaded():
+            try:
+                response = self._get_client().list_objects_v2(Bucket=self.params.bucket, Prefix=self.ip_done_key)
+                return "Contents" in response
+            except Exception as e:
+                print("Got exception while waiting for the SageMaker Redis server IP", e)
+                self._reset_client_after_error(e)
+                return False
+
+        if not self.ip_poller.poll(is_ip_uploaded, timeout_in_second):
+            raise RuntimeError("Cannot retrieve IP of redis server running in SageMaker")
 
     def _get_current_checkpoint(self):
         try:
@@ -252,5 +772,42 @@ class S3BotoDataStore(DataStore):
             raise e
 
     def _get_checkpoint_number(self, checkpoint):
-        checkpoint_relative_path = checkpoint.model_checkpoint_path
+        """
+        :param checkpoint: CheckpointState or the name of the checkpoint
+        """
+        checkpoint_relative_path = checkpoint if isinstance(checkpoint, str) else checkpoint.model_checkpoint_path
         return int(checkpoint_relative_path.split('_Step')[0])
+
+
+def get_credentials_expiry(session):
+    """
+    :return: Time the temporary credentials of the boto3 session expire, in seconds since the epoch, None if they do
+             not expire
+    """
+    credentials = session.get_credentials()
+    # Only set on temporary credentials, e.g. the ones of an assumed role or of the container
+    expiry_time = getattr(credentials, "_expiry_time", None)
+    return expiry_time.timestamp() if expiry_time else None
+
+
+class _StreamReader(object):
+    """
+    Non seekable file object counting the bytes read from it, so that boto3 uploads it as a stream
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.num_bytes = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.num_bytes += len(data)
+        return data
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def close(self):
+        self.fileobj.close()
@@ -0,0 +1,127 @@
+"""
+Sampled, rate limited logging of structured per-step records, written by a background thread
+"""
+import atexit
+import collections
+import json
+import queue
+import sys
+import threading
+import time
+
+WRITE_QUEUE_SIZE = 1000
+
+
+class StepLogger(object):
+    """
+    log_step() only stores the raw field values: the last ring_size records are kept in memory and every
+    sample_every-th step, at most max_records_per_second times a second, the record is handed to a writer
+    thread that formats it as a JSON line. dump() writes the records of the ring that were not written
+    yet, e.g. at the end of an episode or on an error. With sample_every=0 and ring_size=0 log_step()
+    returns right away.
+    """
+    def __init__(self, fields, sample_every=1, max_records_per_second=0, ring_size=0, stream=None):
+        """
+        :param fields: Names of the values passed to log_step(), in order
+        :param sample_every: Write every n-th step record, 0 to write none
+        :param max_records_per_second: Maximum number of step records written per second, 0 for no limit
+        :param ring_size: Number of most recent step records kept for dump()
+        :param stream: File to write the records to, defaults to sys.stdout
+        """
+        self.fields = tuple(fields)
+        self.sample_every = sample_every
+        self.min_interval = 1.0 / max_records_per_second if max_records_per_second else 0
+        self.stream = stream
+        self.num_dropped = 0
+        self._ring = collections.deque(maxlen=ring_size) if ring_size else None
+        self._count = 0
+        self._last_write_time = 0
+        self._queue = queue.Queue(WRITE_QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._run, name="step-logger")
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def log_step(self, *values):
+        """
+        :param values: One value per field
+        """
+        if not self.sample_every and self._ring is None:
+            return
+        self._count += 1
+        write = False
+        if self.sample_every and self._count % self.sample_every == 0:
+            now = time.time()
+            if now - self._last_write_time >= self.min_interval:
+                self._last_write_time = now
+                write = True
+        if self._ring is not None:
+            self._ring.append([values, write])
+        if write:
+            self._write(values)
+
+    def log_event(self, message, **fields):
+        """
+        Write a one-off event, e.g. the reason an episode ended, regardless of the sampling
+        """
+        fields['event'] = message
+        self._write(fields)
+
+    def dump(self, reason):
+        """
+        Write the records of the ring that were sampled out and clear the ring
+        :param reason: Why the ring is dumped, e.g. "episode_end" or "error"
+        """
+        if not self._ring:
+            return
+        records = [values for values, written in self._ring if not written]
+        self._ring.clear()
+        if records:
+            self.log_event("dump", reason=reason, records=len(records))
+            for values in records:
+                self._write(values)
+
+    def close(self, timeout=5):
+        """
+        Write everything that is queued and stop the writer thread
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def _write(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.num_dropped += 1
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            lines = []
+            # Write everything that piled up with a single flush
+            while record is not None:
+                if isinstance(record, dict):
+                    lines.append(json.dumps(record, default=_json_default))
+                else:
+                    lines.append(json.dumps(dict(zip(self.fields, record)), default=_json_default))
+                try:
+                    record = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            stream = self.stream or sys.stdout
+            if lines:
+                stream.write("\n".join(lines) + "\n")
+                stream.flush()
+            if record is None:
+                return
+
+
+def _json_default(value):
+    """
+    :return: NumPy scalars as floats and anything else JSON does not know as a string
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return str(value)
@@ -2,12 +2,16 @@
 # SPDX-License-Identifier: Apache-2.0
 import os
 import logging
-import time
 import tensorflow as tf
+from markov.polling import Poller
+from markov.graph_export import FROZEN_GRAPH_FILENAME, fold_input_normalization, get_input_normalization, \
+    get_output_heads
 
 
 logger = logging.getLogger(__name__)
 
+CHECKPOINT_RETRY_INTERVAL_IN_SECOND = 10
+
 """
 Helper function to determine in a checkpoint is present in the checkpoint_dir
 """
@@ -25,29 +29,34 @@ def has_checkpoint(checkpoint_dir):
 
 def wait_for_checkpoint(checkpoint_dir, data_store=None, retries=10):
     """
-    block until there is a checkpoint in checkpoint_dir
+    block until there is a checkpoint in checkpoint_dir, for at most retries times 10 seconds
     """
-    for i in range(retries):
+    def is_checkpoint_ready():
         if data_store:
             data_store.load_from_store()
+        return has_checkpoint(checkpoint_dir)
 
-        if has_checkpoint(checkpoint_dir):
-            return
-        time.sleep(10)
+    poller = Poller("checkpoint in {}".format(checkpoint_dir))
+    if poller.poll(is_checkpoint_ready, timeout_in_second=retries * CHECKPOINT_RETRY_INTERVAL_IN_SECOND):
+        return
 
     raise ValueError((
-        'Tried {retries} times, but checkpoint never found in '
+        'Waited {seconds} seconds ({checks} checks), but checkpoint never found in '
         '{checkpoint_dir}'
     ).format(
-        retries=retries,
+        seconds=int(poller.wait_time_in_second),
+        checks=poller.num_checks,
         checkpoint_dir=checkpoint_dir,
     ))
 
 def write_frozen_graph(graph_manager, local_path):
+    """
+    Synchronously export the frozen graph, see graph_export.FrozenGraphExporter to export it off the training thread
+    """
     if not os.path.exists(local_path):
         os.makedirs(local_path)
-    # TODO: Supports only PPO
-    output_head = ['main_level/agent/main/online/network_1/ppo_head_0/policy']
-    frozen = tf.graph_util.convert_variables_to_constants(graph_manager.sess, graph_manager.sess.graph_def, output_head)
-    tf.train.write_graph(frozen, local_path, 'model.pb', as_text=False)
+    output_heads = get_output_heads(graph_manager)
+    frozen = tf.graph_util.convert_variables_to_constants(graph_manager.sess, graph_manager.sess.graph_def, output_heads)
+    frozen = fold_input_normalization(frozen, get_input_normalization(graph_manager))
+    tf.train.write_graph(frozen, local_path, FROZEN_GRAPH_FILENAME, as_text=False)
     print("Saved TF frozen graph!")
\ No newline at end of file
@@ -0,0 +1,100 @@
+"""
+Batching, flushing and spilling of the background CloudWatch publisher, against a fake client
+"""
+import json
+import threading
+import time
+from markov.cloudwatch import CloudWatchMetricsPublisher
+
+NAMESPACE = "Test"
+REGION = "us-east-1"
+
+
+class FakeCloudWatchClient(object):
+    """
+    Records the put_metric_data calls, failing them if fail is set and blocking them until release is set
+    """
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.requests = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def put_metric_data(self, MetricData, Namespace):
+        self.release.wait()
+        if self.fail:
+            raise RuntimeError("endpoint unavailable")
+        self.requests.append((Namespace, list(MetricData)))
+
+
+def make_datums(count):
+    return [{'MetricName': 'Reward', 'Unit': 'None', 'Value': float(index)} for index in range(count)]
+
+
+def make_publisher(client, **kwargs):
+    return CloudWatchMetricsPublisher(NAMESPACE, REGION, create_client=lambda: client, **kwargs)
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_batches_up_to_the_request_limit():
+    client = FakeCloudWatchClient()
+    publisher = make_publisher(client, max_metric_data_per_request=1000, max_queue_size=5000)
+    publisher.put_metrics(make_datums(2500))
+    publisher.close()
+    assert [len(metric_data) for _, metric_data in client.requests] == [1000, 1000, 500]
+    assert all(namespace == NAMESPACE for namespace, _ in client.requests)
+    assert publisher.num_sent == 2500
+    assert publisher.num_dropped == publisher.num_spilled == 0
+
+
+def test_flushes_on_the_interval():
+    client = FakeCloudWatchClient()
+    publisher = make_publisher(client, flush_interval_in_second=0.1)
+    publisher.put_metrics(make_datums(3))
+    # Sent by the timer, well before the batch is full and without closing the publisher
+    assert wait_until(lambda: publisher.num_sent == 3)
+    publisher.close()
+    assert len(client.requests) == 1
+
+
+def test_does_not_modify_the_datums():
+    client = FakeCloudWatchClient()
+    publisher = make_publisher(client)
+    datums = make_datums(2)
+    publisher.put_metrics(datums)
+    publisher.close()
+    assert datums == make_datums(2)
+    assert all('Timestamp' in datum for datum in client.requests[0][1])
+
+
+def test_spills_failed_requests(tmpdir):
+    spill_file = str(tmpdir.join("metrics.jsonl"))
+    publisher = make_publisher(FakeCloudWatchClient(fail=True), spill_file=spill_file)
+    publisher.put_metrics(make_datums(5))
+    publisher.close()
+    with open(spill_file) as f:
+        spilled = [json.loads(line) for line in f]
+    assert [datum['Value'] for datum in spilled] == [float(index) for index in range(5)]
+    assert (publisher.num_sent, publisher.num_spilled, publisher.num_dropped) == (0, 5, 0)
+
+
+def test_drops_when_the_endpoint_is_slow():
+    client = FakeCloudWatchClient()
+    client.release.clear()
+    publisher = make_publisher(client, max_queue_size=10, max_metric_data_per_request=1)
+    publisher.put_metrics(make_datums(1))
+    # The publisher thread is stuck in the first request, the queue fills up and put_metrics never blocks
+    assert wait_until(lambda: publisher._queue.empty())
+    start_time = time.time()
+    publisher.put_metrics(make_datums(15))
+    assert time.time() - start_time < 1
+    assert publisher.num_dropped == 5
+    client.release.set()
+    publisher.close()
+    assert publisher.num_sent == 11
@@ -0,0 +1,92 @@
+"""
+Compares the NumPy downsampling of the camera frames to PIL
+"""
+from math import gcd
+import numpy as np
+import pytest
+from PIL import Image
+from markov.environments.preprocessing import FrameDownsampler, RESIZE_METHOD_AREA, RESIZE_METHOD_STRIDE
+
+# Camera resolutions of the rover and the training image size
+CAMERA_RESOLUTIONS = [(360, 240), (640, 480)]
+OUT_WIDTH, OUT_HEIGHT = 160, 120
+# Mean absolute difference, in levels, allowed between the area average and PIL ANTIALIAS
+MAX_MEAN_DIFFERENCE_TO_ANTIALIAS = 4.0
+
+
+def make_frame(width, height, seed=0):
+    """
+    :return: Camera-like height x width x 3 uint8 frame, smooth gradients with some shapes and noise
+    """
+    rng = np.random.RandomState(seed)
+    rows, cols = np.mgrid[0:height, 0:width].astype(np.float32)
+    frame = np.stack([255 * cols / width, 255 * rows / height, 128 + 64 * np.sin(cols / 17.0 + rows / 23.0)], axis=-1)
+    for _ in range(8):
+        left, top = rng.randint(0, width - 40), rng.randint(0, height - 40)
+        frame[top:top + rng.randint(10, 40), left:left + rng.randint(10, 40)] = rng.randint(0, 256, size=3)
+    frame += rng.normal(0, 4, size=frame.shape)
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+
+def pil_resize(frame, size, resample, crop=None):
+    height, width = frame.shape[:2]
+    image = Image.frombytes('RGB', (width, height), frame.tobytes(), 'raw', 'RGB', 0, 1)
+    if crop:
+        image = image.crop(crop)
+    return np.array(image.resize(size, resample))
+
+
+@pytest.mark.parametrize("width,height", CAMERA_RESOLUTIONS)
+@pytest.mark.parametrize("crop", [None, (20, 40, 340, 232)])
+def test_area_is_close_to_antialias(width, height, crop):
+    frame = make_frame(width, height)
+    downsampler = FrameDownsampler(OUT_WIDTH, OUT_HEIGHT, crop=crop, method=RESIZE_METHOD_AREA)
+    out = downsampler(frame.tobytes(), width, height)
+    # LANCZOS is the filter PIL calls ANTIALIAS
+    expected = pil_resize(frame, (OUT_WIDTH, OUT_HEIGHT), Image.LANCZOS, crop)
+    assert out.shape == expected.shape
+    assert np.abs(out.astype(np.int16) - expected).mean() < MAX_MEAN_DIFFERENCE_TO_ANTIALIAS
+
+
+def area_average(frame, out_width, out_height):
+    """
+    :return: Exact float area average, each pixel is repeated so that the output pixels cover whole blocks
+    """
+    height, width = frame.shape[:2]
+    upsampled = frame.astype(np.float64)
+    upsampled = upsampled.repeat(out_height // gcd(height, out_height), axis=0)
+    upsampled = upsampled.repeat(out_width // gcd(width, out_width), axis=1)
+    block_height, block_width = upsampled.shape[0] // out_height, upsampled.shape[1] // out_width
+    return upsampled.reshape(out_height, block_height, out_width, block_width, -1).mean(axis=(1, 3))
+
+
+@pytest.mark.parametrize("width,height", CAMERA_RESOLUTIONS)
+def test_area_matches_the_exact_area_average(width, height):
+    # PIL's BOX filter weighs source pixels by their center only, so it is not an exact area average
+    frame = make_frame(width, height)
+    out = FrameDownsampler(OUT_WIDTH, OUT_HEIGHT, method=RESIZE_METHOD_AREA)(frame.tobytes(), width, height)
+    # Rounded to the nearest level, up to the float32 error of the weights
+    assert np.abs(out - area_average(frame, OUT_WIDTH, OUT_HEIGHT)).max() < 0.51
+
+
+@pytest.mark.parametrize("width,height", CAMERA_RESOLUTIONS)
+def test_stride_matches_nearest(width, height):
+    frame = make_frame(width, height)
+    out = FrameDownsampler(OUT_WIDTH, OUT_HEIGHT, method=RESIZE_METHOD_STRIDE)(frame.tobytes(), width, height)
+    expected = pil_resize(frame, (OUT_WIDTH, OUT_HEIGHT), Image.NEAREST)
+    np.testing.assert_array_equal(out, expected)
+
+
+def test_reuses_the_output_buffer():
+    downsampler = FrameDownsampler(OUT_WIDTH, OUT_HEIGHT)
+    first = downsampler(make_frame(360, 240, seed=1).tobytes(), 360, 240)
+    second = downsampler(make_frame(360, 240, seed=2).tobytes(), 360, 240)
+    assert first is second
+    # A new source resolution prepares new buffers but keeps writing into the same output
+    assert downsampler(make_frame(640, 480).tobytes(), 640, 480) is first
+
+
+def test_rejects_a_crop_outside_the_frame():
+    downsampler = FrameDownsampler(OUT_WIDTH, OUT_HEIGHT, crop=(0, 0, 400, 240))
+    with pytest.raises(ValueError):
+        downsampler(make_frame(360, 240).tobytes(), 360, 240)
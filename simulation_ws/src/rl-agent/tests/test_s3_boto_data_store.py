@@ -0,0 +1,229 @@
+"""
+Publish protocol of the S3 data store against a stubbed S3 client: the pointer is written after every file of the
+checkpoint, and only the files whose content is not in S3 yet are uploaded
+"""
+import io
+import json
+import os
+import threading
+import types
+from datetime import datetime, timedelta, timezone
+import pytest
+from botocore.exceptions import ClientError
+from markov import s3_boto_data_store
+from markov.s3_boto_data_store import S3BotoDataStore, S3BotoDataStoreParameters, CHECKPOINT_POINTER_FILENAME
+
+BUCKET = "bucket"
+S3_FOLDER = "run"
+MODEL_PREFIX = S3_FOLDER + "/model/"
+POINTER_KEY = MODEL_PREFIX + CHECKPOINT_POINTER_FILENAME
+CHECKPOINT_SUFFIXES = (".index", ".meta", ".data-00000-of-00001")
+
+
+class FakeS3Client(object):
+    """
+    In-memory bucket recording the keys written, in order
+    """
+    def __init__(self):
+        self.objects = {}
+        self.writes = []
+        self._lock = threading.Lock()
+
+    def _put(self, operation, key, body):
+        with self._lock:
+            self.objects[key] = body
+            self.writes.append((operation, key))
+
+    def upload_file(self, Filename, Bucket, Key, Config=None):
+        with open(Filename, 'rb') as f:
+            self._put("upload", Key, f.read())
+
+    def copy(self, CopySource, Bucket, Key, Config=None):
+        self._put("copy", Key, self.objects[CopySource["Key"]])
+
+    def put_object(self, Bucket, Key, Body):
+        self._put("put", Key, Body)
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        etag = '"%s"' % hash(self.objects[Key])
+        if IfNoneMatch == etag:
+            raise ClientError({"Error": {"Code": "304"}}, "GetObject")
+        return {"Body": io.BytesIO(self.objects[Key]), "ETag": etag, "ContentLength": len(self.objects[Key])}
+
+    def download_file(self, Bucket, Key, Filename, Config=None):
+        with open(Filename, 'wb') as f:
+            f.write(self.get_object(Bucket, Key)["Body"].read())
+
+    def get_paginator(self, operation):
+        client = self
+
+        class Paginator(object):
+            def paginate(self, Bucket, Prefix):
+                with client._lock:
+                    keys = sorted(key for key in client.objects if key.startswith(Prefix))
+                yield {"Contents": [{"Key": key} for key in keys]}
+
+        return Paginator()
+
+    def delete_objects(self, Bucket, Delete):
+        with self._lock:
+            for obj in Delete["Objects"]:
+                self.objects.pop(obj["Key"], None)
+        return {}
+
+    def get_pointer(self):
+        return json.loads(self.objects[POINTER_KEY].decode())
+
+
+class FakeSession(object):
+    """
+    :param expiry_time: Time the credentials of the session expire, None for credentials that do not expire
+    """
+    def __init__(self, client, expiry_time=None):
+        self._client = client
+        self._expiry_time = expiry_time
+
+    def client(self, *args, **kwargs):
+        return self._client
+
+    def get_credentials(self):
+        return types.SimpleNamespace(_expiry_time=self._expiry_time)
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    client = FakeS3Client()
+    monkeypatch.setattr(s3_boto_data_store.boto3.session, "Session", lambda: FakeSession(client))
+    return client
+
+
+def make_data_store(checkpoint_dir, keep_last=0):
+    data_store = S3BotoDataStore(S3BotoDataStoreParameters(bucket_name=BUCKET, s3_folder=S3_FOLDER,
+                                                           checkpoint_dir=checkpoint_dir, keep_last=keep_last))
+    data_store.graph_manager = None
+    return data_store
+
+
+def write_checkpoint(checkpoint_dir, number, contents=None):
+    """
+    Write the files of a checkpoint and point the metadata file at it
+    :param contents: Dict mapping the suffixes of the files to their content, defaults to content unique to the
+                     checkpoint
+    :return: Name of the checkpoint
+    """
+    name = "%s_Step-%s.ckpt" % (number, number * 100)
+    contents = contents or {}
+    for suffix in CHECKPOINT_SUFFIXES:
+        with open(os.path.join(checkpoint_dir, name + suffix), 'wb') as f:
+            f.write(contents.get(suffix, (name + suffix).encode()))
+    with open(os.path.join(checkpoint_dir, "checkpoint"), 'w') as f:
+        f.write('model_checkpoint_path: "%s"\nall_model_checkpoint_paths: "%s"\n' % (name, name))
+    return name
+
+
+def save(data_store):
+    data_store.save_to_store()
+    # Wait for the background deletion of old checkpoints
+    data_store._retention_executor.submit(lambda: None).result()
+
+
+def test_pointer_is_written_last(tmpdir, s3_client):
+    checkpoint_dir = str(tmpdir.mkdir("checkpoint"))
+    data_store = make_data_store(checkpoint_dir)
+    name = write_checkpoint(checkpoint_dir, 1)
+    save(data_store)
+
+    assert s3_client.writes[-1] == ("put", POINTER_KEY)
+    written = set(key for _, key in s3_client.writes[:-1])
+    assert set(MODEL_PREFIX + name + suffix for suffix in CHECKPOINT_SUFFIXES) <= written
+    pointer = s3_client.get_pointer()
+    assert pointer["checkpoint"] == name
+    assert sorted(pointer["files"]) == sorted(name + suffix for suffix in CHECKPOINT_SUFFIXES)
+    assert MODEL_PREFIX + pointer["checkpoint"] + ".manifest.json" in written
+
+
+def test_uploads_only_new_content(tmpdir, s3_client):
+    checkpoint_dir = str(tmpdir.mkdir("checkpoint"))
+    data_store = make_data_store(checkpoint_dir)
+    write_checkpoint(checkpoint_dir, 1, {".meta": b"graph"})
+    save(data_store)
+
+    # The graph did not change, the meta file of the next checkpoint is copied within the bucket
+    del s3_client.writes[:]
+    name = write_checkpoint(checkpoint_dir, 2, {".meta": b"graph"})
+    save(data_store)
+    uploaded = [key for operation, key in s3_client.writes if operation == "upload"]
+    copied = [key for operation, key in s3_client.writes if operation == "copy"]
+    assert copied == [MODEL_PREFIX + name + ".meta"]
+    assert MODEL_PREFIX + name + ".index" in uploaded
+    # The files of the first checkpoint are not uploaded again
+    assert not [key for key in uploaded + copied if key.startswith(MODEL_PREFIX + "1_Step")]
+    assert s3_client.writes[-1] == ("put", POINTER_KEY)
+
+
+def test_restarted_trainer_knows_what_is_in_s3(tmpdir, s3_client):
+    checkpoint_dir = str(tmpdir.mkdir("checkpoint"))
+    name = write_checkpoint(checkpoint_dir, 1)
+    save(make_data_store(checkpoint_dir))
+
+    # A new data store reads the digests of the published files from the manifest of the latest checkpoint
+    del s3_client.writes[:]
+    save(make_data_store(checkpoint_dir))
+    assert not [key for operation, key in s3_client.writes if operation in ("upload", "copy")
+                and key.startswith(MODEL_PREFIX + name)]
+
+    # Same names, different content: the files are uploaded again
+    del s3_client.writes[:]
+    write_checkpoint(checkpoint_dir, 1, {suffix: b"restarted" + suffix.encode() for suffix in CHECKPOINT_SUFFIXES})
+    save(make_data_store(checkpoint_dir))
+    assert sorted(key for operation, key in s3_client.writes if operation == "upload" and
+                  key.startswith(MODEL_PREFIX + name)) == sorted(MODEL_PREFIX + name + suffix
+                                                                 for suffix in CHECKPOINT_SUFFIXES)
+
+
+def test_reader_loads_the_published_checkpoint(tmpdir, s3_client):
+    checkpoint_dir = str(tmpdir.mkdir("checkpoint"))
+    name = write_checkpoint(checkpoint_dir, 1)
+    save(make_data_store(checkpoint_dir))
+
+    reader_dir = str(tmpdir.join("reader"))
+    reader = make_data_store(reader_dir)
+    assert reader.load_from_store(expected_checkpoint_number=1)
+    for suffix in CHECKPOINT_SUFFIXES:
+        with open(os.path.join(reader_dir, name + suffix), 'rb') as f:
+            assert f.read() == (name + suffix).encode()
+    assert reader.get_current_checkpoint_number() == 1
+
+
+def test_client_is_rebuilt_before_the_credentials_expire(tmpdir, monkeypatch):
+    client = FakeS3Client()
+    expiry_times = [datetime.now(timezone.utc) + timedelta(seconds=60), datetime.now(timezone.utc) + timedelta(hours=1)]
+    monkeypatch.setattr(s3_boto_data_store.boto3.session, "Session",
+                        lambda: FakeSession(client, expiry_times.pop(0)))
+    data_store = make_data_store(str(tmpdir))
+    # The first credentials expire within the margin, the client is built again with the next ones
+    data_store._get_client()
+    data_store._get_client()
+    data_store._get_client()
+    assert (data_store.num_clients_created, data_store.num_client_cache_hits) == (2, 1)
+
+
+def test_evaluation_summary_outlives_the_checkpoints(tmpdir, s3_client):
+    checkpoint_dir = str(tmpdir.mkdir("checkpoint"))
+    # Only the latest checkpoint is kept
+    data_store = make_data_store(checkpoint_dir, keep_last=1)
+    write_checkpoint(checkpoint_dir, 1)
+    save(data_store)
+    summary_filename = str(tmpdir.join("evaluation_1.json"))
+    with open(summary_filename, 'w') as f:
+        json.dump({"trials": 10}, f)
+    data_store.store_evaluation_summary(summary_filename)
+    assert json.loads(s3_client.objects[MODEL_PREFIX + "evaluation_1.json"].decode()) == {"trials": 10}
+
+    # The next checkpoint deletes the first one, not its summary
+    write_checkpoint(checkpoint_dir, 2)
+    save(data_store)
+    assert not [key for key in s3_client.objects if key.startswith(MODEL_PREFIX + "1_Step")]
+    assert MODEL_PREFIX + "evaluation_1.json" in s3_client.objects
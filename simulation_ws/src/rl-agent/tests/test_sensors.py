@@ -0,0 +1,63 @@
+"""
+Step synchronization on the sensor stamps, driven by an in-process fake publisher instead of ROS
+"""
+import threading
+import time
+from markov.environments.sensors import SensorSync, STEP_SYNC_TOPICS, SCAN_TOPIC, IMAGE_TOPIC, ODOM_TOPIC
+
+ACTION_STAMP = 10.0
+# Wall time the fake publisher waits before publishing, and the deadline of the waits that must time out
+PUBLISH_DELAY_IN_SECOND = 0.05
+TIMEOUT_IN_SECOND = 0.2
+
+
+def publish(sensor_sync, stamps, delay=PUBLISH_DELAY_IN_SECOND):
+    """
+    Publish a message stamped stamps[topic] on every topic from another thread, after the delay
+    :return: The publisher thread
+    """
+    def run():
+        time.sleep(delay)
+        for topic, stamp in stamps.items():
+            sensor_sync.update(topic, stamp)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def test_returns_once_every_topic_is_fresh():
+    sensor_sync = SensorSync()
+    publisher = publish(sensor_sync, {topic: ACTION_STAMP + 0.1 for topic in STEP_SYNC_TOPICS})
+    start_time = time.time()
+    assert sensor_sync.wait_for_fresh_data(ACTION_STAMP, timeout=5)
+    # Woken up by the publisher, not by the deadline
+    assert time.time() - start_time < 1
+    publisher.join()
+
+
+def test_times_out_without_data():
+    sensor_sync = SensorSync()
+    start_time = time.time()
+    assert not sensor_sync.wait_for_fresh_data(ACTION_STAMP, timeout=TIMEOUT_IN_SECOND)
+    assert time.time() - start_time >= TIMEOUT_IN_SECOND
+
+
+def test_times_out_when_a_topic_is_stale():
+    sensor_sync = SensorSync()
+    stamps = {SCAN_TOPIC: ACTION_STAMP + 0.1, IMAGE_TOPIC: ACTION_STAMP + 0.1, ODOM_TOPIC: ACTION_STAMP}
+    publisher = publish(sensor_sync, stamps)
+    assert not sensor_sync.wait_for_fresh_data(ACTION_STAMP, timeout=TIMEOUT_IN_SECOND)
+    publisher.join()
+    # Only the topics waited for count
+    assert sensor_sync.wait_for_fresh_data(ACTION_STAMP, timeout=0, topics=(SCAN_TOPIC, IMAGE_TOPIC))
+
+
+def test_reset_forgets_the_stamps():
+    sensor_sync = SensorSync()
+    for topic in STEP_SYNC_TOPICS:
+        sensor_sync.update(topic, ACTION_STAMP + 0.1)
+    assert sensor_sync.get_stamp(ODOM_TOPIC) == ACTION_STAMP + 0.1
+    sensor_sync.reset()
+    assert sensor_sync.get_stamp(ODOM_TOPIC) is None
+    assert not sensor_sync.wait_for_fresh_data(ACTION_STAMP, timeout=0)
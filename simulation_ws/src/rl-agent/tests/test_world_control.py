@@ -0,0 +1,128 @@
+"""
+Paused physics stepping against a fake Gazebo world standing in for the pause, unpause and world properties services
+"""
+import importlib
+import sys
+import types
+import pytest
+
+TIME_STEP = 0.001
+TICKS_PER_STEP = 20
+# Period, in ticks, of the slowest sensor of the fake world, longer than a step
+SENSOR_PERIOD_IN_TICKS = 50
+
+# Attributes of the ROS modules world_control reads when it is imported, only faked when ROS is not installed
+ROS_MODULES = {
+    "rospy": {"sleep": None, "ServiceException": Exception,
+              "exceptions": types.SimpleNamespace(TransportException=Exception)},
+    "std_srvs": {},
+    "std_srvs.srv": {"Empty": object},
+    "gazebo_msgs": {},
+    "gazebo_msgs.srv": {"GetPhysicsProperties": object, "GetWorldProperties": object},
+}
+
+
+@pytest.fixture(scope="module")
+def world_control():
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        for name, attributes in ROS_MODULES.items():
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                module = types.ModuleType(name)
+                module.__dict__.update(attributes)
+                monkeypatch.setitem(sys.modules, name, module)
+        monkeypatch.delitem(sys.modules, "markov.environments.world_control", raising=False)
+        yield importlib.import_module("markov.environments.world_control")
+
+
+class FakeWorld(object):
+    """
+    Simulation clock that only advances while the physics is unpaused. The pause request reaches the world
+    overshoot_ticks ticks after the sleep ended, and a sensor publishes every sensor_period_ticks ticks.
+    """
+    def __init__(self, overshoot_ticks=0, sensor_period_ticks=SENSOR_PERIOD_IN_TICKS):
+        self.overshoot_ticks = overshoot_ticks
+        self.sensor_period_ticks = sensor_period_ticks
+        self.ticks = 0
+        self.paused = False
+        self.calls = []
+
+    def pause(self):
+        self.calls.append("pause")
+        if not self.paused:
+            self.ticks += self.overshoot_ticks
+        self.paused = True
+
+    def unpause(self):
+        self.calls.append("unpause")
+        self.paused = False
+
+    def sleep(self, duration):
+        assert not self.paused
+        self.ticks += int(round(duration / TIME_STEP))
+
+    def get_sim_time(self):
+        return self.ticks * TIME_STEP
+
+    def get_sensor_stamp(self):
+        """
+        :return: Stamp of the last message of the sensor
+        """
+        return (self.ticks // self.sensor_period_ticks) * self.sensor_period_ticks * TIME_STEP
+
+
+def make_world_control(world_control, world):
+    return world_control.WorldControl(TICKS_PER_STEP, pause_physics=world.pause, unpause_physics=world.unpause,
+                                      time_step=TIME_STEP, get_sim_time=world.get_sim_time, sleep=world.sleep)
+
+
+def test_starts_paused(world_control):
+    world = FakeWorld()
+    make_world_control(world_control, world)
+    assert world.calls == ["pause"]
+
+
+def test_counts_ticks(world_control):
+    world = FakeWorld()
+    control = make_world_control(world_control, world)
+    assert control.step() == TICKS_PER_STEP
+    assert control.step_for(0.005) == 5
+    assert world.calls == ["pause", "unpause", "pause", "unpause", "pause"]
+    assert (control.num_steps, control.last_requested_ticks, control.last_ticks) == (2, 5, 5)
+    assert (control.total_requested_ticks, control.total_ticks) == (TICKS_PER_STEP + 5, TICKS_PER_STEP + 5)
+    assert control.mean_overshoot == 0
+
+
+def test_measures_overshoot(world_control):
+    world = FakeWorld(overshoot_ticks=3)
+    control = make_world_control(world_control, world)
+    for _ in range(4):
+        assert control.step() == TICKS_PER_STEP + 3
+    assert control.last_requested_ticks == TICKS_PER_STEP
+    assert control.total_ticks - control.total_requested_ticks == 12
+    assert control.mean_overshoot == 3
+
+
+def test_steps_until_the_sensor_published(world_control):
+    world = FakeWorld()
+    control = make_world_control(world_control, world)
+    action_stamp = world.get_sim_time()
+    control.step()
+    # A step is shorter than the period of the sensor, so the world has to run further
+    assert control.step_until(lambda: world.get_sensor_stamp() > action_stamp, max_ticks=100, ticks=5)
+    assert world.ticks == SENSOR_PERIOD_IN_TICKS
+    assert (control.num_retry_steps, control.last_retry_ticks) == (6, SENSOR_PERIOD_IN_TICKS - TICKS_PER_STEP)
+    assert control.last_ticks == TICKS_PER_STEP
+    # The next step starts without retry ticks
+    control.step()
+    assert control.last_retry_ticks == 0
+
+
+def test_gives_up_after_max_ticks(world_control):
+    world = FakeWorld()
+    control = make_world_control(world_control, world)
+    control.step()
+    assert not control.step_until(lambda: False, max_ticks=10, ticks=4)
+    assert (control.num_retry_steps, control.last_retry_ticks) == (3, 12)
+    assert world.paused